@@ -0,0 +1,50 @@
+''' list endpoint throughput of postgres backends on the configured database '''
+''' run from src dir: python -m bench.backends [seconds] [concurrency] '''
+import asyncio
+import statistics
+import sys
+import time
+
+from recipes.backends import BACKENDS
+from recipes.db import init_pg, close_pg, get_recipe_list
+from recipes.settings import CONFIG
+
+
+PAGE_SIZES = (20, 100)
+
+
+async def worker(dbengine, limit, deadline, timings):
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        await get_recipe_list(dbengine, pagination={'limit': limit}, assembly=CONFIG['recipe_assembly'])
+        timings.append((time.perf_counter() - started) * 1000)
+
+
+async def measure(backend, limit, seconds, concurrency):
+    app = {'config': dict(CONFIG, postgres=dict(CONFIG['postgres'], backend=backend))}
+    dbengine = await init_pg(app)
+    try:
+        # warm up pool and statement caches
+        await asyncio.gather(*[worker(dbengine, limit, time.perf_counter() + 1, []) for _ in range(concurrency)])
+        timings = []
+        deadline = time.perf_counter() + seconds
+        await asyncio.gather(*[worker(dbengine, limit, deadline, timings) for _ in range(concurrency)])
+    finally:
+        await close_pg(app)
+    return timings
+
+
+async def run(seconds, concurrency):
+    print(f'{"page size":>10} {"backend":>10} {"req/s":>10} {"mean ms":>10} {"p95 ms":>10}')
+    for limit in PAGE_SIZES:
+        for backend in BACKENDS:
+            timings = sorted(await measure(backend, limit, seconds, concurrency))
+            p95 = timings[int(len(timings) * 0.95) - 1]
+            print(f'{limit:>10} {backend:>10} {len(timings) / seconds:>10.1f} '
+                  f'{statistics.mean(timings):>10.2f} {p95:>10.2f}')
+
+
+if __name__ == '__main__':
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else CONFIG['postgres']['maxsize']
+    asyncio.get_event_loop().run_until_complete(run(seconds, concurrency))
@@ -0,0 +1,49 @@
+''' serializers on 300 recipes payload, the one recipes_nonapi renders, from the configured database '''
+''' run from src dir: python -m bench.json_serializer [rounds] '''
+import asyncio
+import json
+import statistics
+import sys
+import time
+
+from recipes.db import init_pg, close_pg, get_recipe_list
+from recipes.settings import CONFIG
+from recipes.utils import SERIALIZERS
+
+
+def default_str_dumps(thing):
+    # previous json_str_dumps + encoding done by web.json_response
+    return json.dumps(thing, default=str).encode()
+
+
+async def load_payload():
+    app = {'config': CONFIG}
+    dbengine = await init_pg(app)
+    try:
+        recipes, count = await get_recipe_list(dbengine, pagination={'limit': 300},
+                                               assembly=CONFIG['recipe_assembly'])
+    finally:
+        await close_pg(app)
+    return {'count': count, 'next': None, 'prev': None, 'results': recipes}
+
+
+def run(payload, rounds):
+    serializers = dict(SERIALIZERS, default_str=default_str_dumps)
+    print(f'{len(payload["results"])} recipes')
+    print(f'{"serializer":>12} {"mean ms":>10} {"p95 ms":>10} {"bytes":>10}')
+    for name, dumps in serializers.items():
+        dumps(payload)  # warm up
+        timings = []
+        for _ in range(rounds):
+            started = time.perf_counter()
+            body = dumps(payload)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        p95 = timings[int(len(timings) * 0.95) - 1]
+        print(f'{name:>12} {statistics.mean(timings):>10.3f} {p95:>10.3f} {len(body):>10}')
+
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    payload = asyncio.get_event_loop().run_until_complete(load_payload())
+    run(payload, rounds)
@@ -0,0 +1,67 @@
+''' /api/recipes latency while logins hammer the same server '''
+''' run from src dir against running app: python -m bench.login_storm [base_url] [storm_concurrency] '''
+import asyncio
+import sys
+import time
+
+import aiohttp
+
+
+USERNAME = 'bench_user'
+PASSWORD = 'bench_password'
+DURATION = 10  # seconds per phase
+
+
+def percentile(timings, percent):
+    timings = sorted(timings)
+    return timings[max(int(len(timings) * percent / 100) - 1, 0)]
+
+
+async def read_recipes(session, base_url, until):
+    timings = []
+    while time.monotonic() < until:
+        started = time.perf_counter()
+        async with session.get(f'{base_url}/api/recipes') as response:
+            await response.read()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+async def login_storm(session, base_url, until):
+    statuses = {}
+    while time.monotonic() < until:
+        async with session.post(f'{base_url}/api/login',
+                                json={'username': USERNAME, 'password': PASSWORD}) as response:
+            await response.read()
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+    return statuses
+
+
+async def phase(session, base_url, storm_concurrency):
+    until = time.monotonic() + DURATION
+    storms = [login_storm(session, base_url, until) for _ in range(storm_concurrency)]
+    results = await asyncio.gather(read_recipes(session, base_url, until), *storms)
+    statuses = {}
+    for storm_statuses in results[1:]:
+        for status, number in storm_statuses.items():
+            statuses[status] = statuses.get(status, 0) + number
+    return results[0], statuses
+
+
+async def run(base_url, storm_concurrency):
+    connector = aiohttp.TCPConnector(limit=storm_concurrency + 1)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await session.post(f'{base_url}/api/register',
+                           json={'username': USERNAME, 'password': PASSWORD, 'email': 'bench@bench.bench'})
+
+        print(f'{"phase":>12} {"reads":>8} {"p50 ms":>8} {"p99 ms":>8}  login statuses')
+        for name, concurrency in (('idle', 0), ('login storm', storm_concurrency)):
+            timings, statuses = await phase(session, base_url, concurrency)
+            print(f'{name:>12} {len(timings):>8} {percentile(timings, 50):>8.1f} '
+                  f'{percentile(timings, 99):>8.1f}  {statuses}')
+
+
+if __name__ == '__main__':
+    base_url = sys.argv[1] if len(sys.argv) > 1 else 'http://127.0.0.1:8080'
+    storm_concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    asyncio.get_event_loop().run_until_complete(run(base_url, storm_concurrency))
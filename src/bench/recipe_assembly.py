@@ -0,0 +1,42 @@
+''' compares recipe list assembly engines on the configured database '''
+''' run from src dir: python -m bench.recipe_assembly [rounds] '''
+import asyncio
+import statistics
+import sys
+import time
+
+from recipes.db import init_pg, close_pg, get_recipe_list
+from recipes.settings import CONFIG
+
+
+PAGE_SIZES = (20, 100, 300)
+ASSEMBLIES = ('queries', 'json')
+
+
+async def measure(dbengine, assembly, limit, rounds):
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        await get_recipe_list(dbengine, pagination={'limit': limit}, assembly=assembly)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+async def run(rounds):
+    app = {'config': CONFIG}
+    dbengine = await init_pg(app)
+    try:
+        print(f'{"page size":>10} {"assembly":>10} {"mean ms":>10} {"p95 ms":>10}')
+        for limit in PAGE_SIZES:
+            for assembly in ASSEMBLIES:
+                await measure(dbengine, assembly, limit, 3)  # warm up
+                timings = sorted(await measure(dbengine, assembly, limit, rounds))
+                p95 = timings[int(len(timings) * 0.95) - 1]
+                print(f'{limit:>10} {assembly:>10} {statistics.mean(timings):>10.2f} {p95:>10.2f}')
+    finally:
+        await close_pg(app)
+
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    asyncio.get_event_loop().run_until_complete(run(rounds))
@@ -0,0 +1,94 @@
+''' /api/recipes throughput of the pre-fork server by number of workers, configured db and redis are used '''
+''' run from src dir: python -m bench.workers [workers,...] [seconds] [load_processes] [concurrency] '''
+''' load processes share the machine w workers, leave them cores or the scaling is capped by load generation '''
+import asyncio
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+from .login_storm import percentile
+from .ws_load import free_port, wait_listening, HOST
+
+
+WARMUP = 2  # seconds of load before measuring, all workers get ready and warm caches
+
+
+async def load(url, seconds, concurrency):
+    timings = []
+    errors = 0
+
+    async def client(session, deadline):
+        nonlocal errors
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                async with session.get(url) as response:
+                    await response.read()
+                    if response.status != 200:
+                        errors += 1
+                        continue
+            except aiohttp.ClientError:
+                errors += 1
+                continue
+            timings.append((time.perf_counter() - started) * 1000)
+
+    # connections are not reused, kernel spreads new ones over workers listening on the port
+    connector = aiohttp.TCPConnector(limit=0, force_close=True)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[client(session, time.monotonic() + WARMUP) for _ in range(concurrency)])
+        timings.clear()
+        await asyncio.gather(*[client(session, time.monotonic() + seconds) for _ in range(concurrency)])
+    return timings, errors
+
+
+def load_process(args):
+    return asyncio.new_event_loop().run_until_complete(load(*args))
+
+
+def start_server(workers, port):
+    env = dict(os.environ, WORKERS=str(workers), AIO_HOST=HOST, AIO_PORT=str(port))
+    return subprocess.Popen([sys.executable, '-m', 'recipes'], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def measure(workers, seconds, load_processes, concurrency):
+    port = free_port()
+    server = start_server(workers, port)
+    try:
+        asyncio.get_event_loop().run_until_complete(wait_listening(port, timeout=120))
+        args = (f'http://{HOST}:{port}/api/recipes', seconds, concurrency)
+        with multiprocessing.Pool(load_processes) as pool:
+            results = pool.map(load_process, [args] * load_processes)
+    finally:
+        # master stops workers gracefully
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+    timings = [timing for process_timings, _ in results for timing in process_timings]
+    errors = sum(process_errors for _, process_errors in results)
+    return timings, errors
+
+
+def run(steps, seconds, load_processes, concurrency):
+    print(f'{"workers":>8} {"req/s":>10} {"speedup":>8} {"per worker":>11} {"p50 ms":>8} {"p99 ms":>8} {"errors":>7}')
+    base = None
+    for workers in steps:
+        timings, errors = measure(workers, seconds, load_processes, concurrency)
+        throughput = len(timings) / seconds
+        base = base or throughput / workers
+        print(f'{workers:>8} {throughput:>10.1f} {throughput / base:>8.2f} {throughput / workers / base:>11.0%} '
+              f'{percentile(timings, 50):>8.1f} {percentile(timings, 99):>8.1f} {errors:>7}')
+
+
+if __name__ == '__main__':
+    cpus = os.cpu_count()
+    default_steps = sorted({1, 2, 4, cpus // 2 or 1, cpus})
+    steps = [int(step) for step in sys.argv[1].split(',')] if len(sys.argv) > 1 else default_steps
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    load_processes = int(sys.argv[3]) if len(sys.argv) > 3 else max(cpus // 4, 1)
+    concurrency = int(sys.argv[4]) if len(sys.argv) > 4 else 32
+    run(steps, seconds, load_processes, concurrency)
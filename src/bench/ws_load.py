@@ -0,0 +1,175 @@
+''' recipe page websockets of one worker: connect rate, memory per connection, chat broadcast latency and cpu '''
+''' run from src dir: python -m bench.ws_load [connections,...] [room_size] [rounds], app runs on local CONFIG db '''
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import time
+import timeit
+
+import aiohttp
+from aiohttp import web
+from faker import Faker
+
+from recipes.main import init_app
+from recipes.settings import CONFIG
+from recipes.utils import get_random_name
+
+from .login_storm import percentile
+
+
+HOST = '127.0.0.1'
+CONNECT_CONCURRENCY = 100
+ROUND_INTERVAL = 0.05  # seconds between broadcasts of a room, send queues must keep up
+SETTLE = 1  # seconds for join messages to drain before measuring
+DELIVERY_TIMEOUT = 10
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def serve(port):
+    # testing skips logstash and redis, no network needed besides local postgres
+    web.run_app(init_app(testing=True, config=CONFIG), host=HOST, port=port, print=None, access_log=None)
+
+
+def process_rss(pid):
+    ''' bytes '''
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+
+
+def process_cpu(pid):
+    ''' user + system seconds '''
+    with open(f'/proc/{pid}/stat') as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+async def wait_listening(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(HOST, port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+        else:
+            writer.close()
+            return
+
+
+async def read_messages(ws, latencies):
+    # 'sent' chat messages carry perf_counter of the sender, it is the same clock
+    # all clients share this process, latency includes their parsing as real browsers would not
+    async for msg in ws:
+        if msg.type != aiohttp.WSMsgType.TEXT:
+            break
+        data = json.loads(msg.data)
+        if data['action'] == 'sent':
+            latencies.append((time.perf_counter() - float(data['text'])) * 1000)
+
+
+async def connect(session, url, semaphore):
+    async with semaphore:
+        ws = await session.ws_connect(url)
+        await ws.receive()  # connect message w name
+    return ws
+
+
+async def measure(connections, room_size, rounds):
+    port = free_port()
+    server = multiprocessing.Process(target=serve, args=(port,), daemon=True)
+    server.start()
+    try:
+        await wait_listening(port)
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            # first request warms up db pool and templates
+            async with session.get(f'http://{HOST}:{port}/recipes/1') as response:
+                await response.read()
+            rss_before = process_rss(server.pid)
+
+            semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+            urls = [f'http://{HOST}:{port}/recipes/{number // room_size + 1}' for number in range(connections)]
+            started = time.perf_counter()
+            sockets = await asyncio.gather(*[connect(session, url, semaphore) for url in urls])
+            connect_rate = connections / (time.perf_counter() - started)
+
+            latencies = []
+            readers = [asyncio.ensure_future(read_messages(ws, latencies)) for ws in sockets]
+            await asyncio.sleep(SETTLE)
+            memory = (process_rss(server.pid) - rss_before) / connections
+
+            # first socket of every room is its sender, the rest receive
+            senders = sockets[::room_size]
+            expected = rounds * (connections - len(senders))
+            cpu_before = process_cpu(server.pid)
+            for _ in range(rounds):
+                for ws in senders:
+                    await ws.send_str(repr(time.perf_counter()))
+                await asyncio.sleep(ROUND_INTERVAL)
+            deadline = time.monotonic() + DELIVERY_TIMEOUT
+            while len(latencies) < expected and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            cpu = process_cpu(server.pid) - cpu_before
+
+            await asyncio.gather(*[ws.close() for ws in sockets])
+            await asyncio.gather(*readers)
+    finally:
+        server.terminate()
+        server.join()
+    return {
+        'connect_rate': connect_rate,
+        'memory': memory,
+        'latencies': latencies,
+        'expected': expected,
+        # cpu of the whole broadcast phase, incl. receiving chat messages and sending them on
+        'cpu_per_message': cpu / max(len(latencies), 1),
+        'cpu_per_broadcast': cpu / (rounds * len(senders)),
+    }
+
+
+def faker_costs(number=200):
+    ''' ms per connection, Faker instance per name vs get_random_name '''
+    per_instance = timeit.timeit(lambda: Faker().name(), number=number) / number * 1000
+    current = timeit.timeit(get_random_name, number=number) / number * 1000
+    return per_instance, current
+
+
+async def run(steps, room_size, rounds):
+    per_instance, current = faker_costs()
+    print(f'name per connection: get_random_name {current:.3f} ms, new Faker {per_instance:.3f} ms')
+    print(f'{"conns":>7} {"rooms":>6} {"conn/s":>8} {"KiB/conn":>9} {"p50 ms":>8} {"p99 ms":>8} '
+          f'{"cpu us/msg":>11} {"cpu us/bcast":>13} {"delivered":>10}')
+    for connections in steps:
+        result = await measure(connections, room_size, rounds)
+        latencies = result['latencies'] or [float('nan')]
+        print(f'{connections:>7} {-(-connections // room_size):>6} {result["connect_rate"]:>8.0f} '
+              f'{result["memory"] / 1024:>9.1f} {percentile(latencies, 50):>8.2f} {percentile(latencies, 99):>8.2f} '
+              f'{result["cpu_per_message"] * 1e6:>11.1f} {result["cpu_per_broadcast"] * 1e6:>13.1f} '
+              f'{len(result["latencies"]) / result["expected"]:>10.1%}')
+
+
+if __name__ == '__main__':
+    steps = [int(step) for step in sys.argv[1].split(',')] if len(sys.argv) > 1 else [1000, 2000, 5000]
+    room_size = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    fd_limit = raise_fd_limit()
+    if max(steps) + 100 > fd_limit:  # server and clients are separate processes
+        sys.exit(f'open files limit {fd_limit} is too low for {max(steps)} connections')
+    asyncio.get_event_loop().run_until_complete(run(steps, room_size, rounds))
@@ -1,3 +1,4 @@
+import sys
 import json
 from datetime import datetime, timedelta
 
@@ -5,7 +6,9 @@ from sqlalchemy import create_engine, MetaData
 
 from recipes.settings import BASE_DIR, CONFIG, TEST_CONFIG
 
-from recipes.db_tables import users, source, category, ingredient, ingredient_item, recipe, comment, vote
+from recipes.db_tables import (
+    users, source, category, ingredient, ingredient_item, recipe, comment, vote, RECIPE_SEARCH_VECTOR
+)
 
 
 DSN = "postgresql://{user}:{password}@{host}:{port}/{database}"
@@ -52,6 +55,8 @@ def teardown_db(config):
 
 
 def create_tables(engine=test_engine):
+    # trigram index on recipe title needs the extension
+    engine.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
     meta = MetaData()
     meta.create_all(bind=engine, tables=[users, source, category, ingredient, ingredient_item, recipe, comment, vote])
 
@@ -61,6 +66,47 @@ def drop_tables(engine=test_engine):
     meta.drop_all(bind=engine, tables=[users, source, category, ingredient, ingredient_item, recipe, comment, vote])
 
 
+def upgrade_tables(engine=test_engine):
+    ''' brings tables created by older create_tables up to date, safe to run repeatedly '''
+    ''' python init_db.py upgrade_tables, once after deploying a version w schema changes over an existing db '''
+    conn = engine.connect()
+    conn.execute('ALTER TABLE recipe ADD COLUMN IF NOT EXISTS likes integer NOT NULL DEFAULT 0')
+    conn.execute("CREATE INDEX IF NOT EXISTS recipe_seek_idx ON recipe (coalesce(pub_date, '0001-01-01'::date), id)")
+    conn.execute(f'ALTER TABLE recipe ADD COLUMN IF NOT EXISTS search_vector tsvector '
+                 f'GENERATED ALWAYS AS ({RECIPE_SEARCH_VECTOR}) STORED')
+    conn.execute('CREATE INDEX IF NOT EXISTS recipe_search_idx ON recipe USING gin (search_vector)')
+    conn.execute('CREATE INDEX IF NOT EXISTS recipe_title_trgm_idx ON recipe USING gin (title gin_trgm_ops)')
+    # duplicate votes from before the unique index, the latest one stays; reconcile_likes after that
+    result = conn.execute('''
+        DELETE FROM vote older
+        USING vote newer
+        WHERE older.user_id = newer.user_id AND older.recipe_id = newer.recipe_id AND older.id < newer.id
+        ''')
+    if result.rowcount:
+        print(f'{result.rowcount} duplicate votes removed, run reconcile_likes')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS vote_user_recipe_key ON vote (user_id, recipe_id)')
+    conn.close()
+
+
+def reconcile_likes(engine=test_engine):
+    ''' recounts recipe.likes counter from votes, e.g. after adding the column to existing db '''
+    conn = engine.connect()
+    result = conn.execute('''
+        UPDATE recipe
+        SET likes = counted.likes
+        FROM (
+          SELECT r.id, count(v.id) AS likes
+          FROM recipe r
+          LEFT JOIN vote v
+            ON v.recipe_id = r.id AND v.value
+          GROUP BY r.id
+        ) counted
+        WHERE recipe.id = counted.id AND recipe.likes <> counted.likes
+        ''')
+    print(f'likes reconciled for {result.rowcount} recipes')
+    conn.close()
+
+
 def insert_from_fixtures(conn, fixture_filenames):
     for filename in fixture_filenames:
         table = eval(filename.split('.')[0])
@@ -98,6 +144,17 @@ def sample_data(engine=test_engine):
 
 
 if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+
+    # tables of an older version are upgraded on demand, not on every start
+    if command == 'upgrade_tables':
+        upgrade_tables(engine=user_engine)
+        sys.exit()
+
+    if command == 'reconcile_likes':
+        upgrade_tables(engine=user_engine)
+        reconcile_likes(engine=user_engine)
+        sys.exit()
 
     #setup_db(USER_CONFIG['postgres'])
     create_tables(engine=user_engine)
@@ -1,3 +1,4 @@
+import asyncio
 import os
 
 from aiohttp import web
@@ -5,94 +6,233 @@ from aiohttp import web
 from scrape import collect_recipes
 
 from . import db
-from .utils import json_str_dumps
-from .exceptions import BadRequest_Important, AppException
+from .cache import cached_response, recipe_list_tags, recipe_detail_tags, conditional_response, \
+    recipe_list_versions, recipe_detail_versions, fill_ttl, COUNT_TTL
+from .events import recipe_voted, recipe_commented, user_updated
+from .utils import json_response, ndjson_line
+from .exceptions import BadRequest, BadRequest_Important, AppException, RecordNotFound, TooManyRequests
 from .helpers import prepare_filter_parameters, prepare_recipes_response, log_string, log_exception, \
-    generate_userpic_filename, run_sync
-from .middlewares import login_required  # TODO find another location
+    generate_userpic_filename, run_sync, parse_since
+from .middlewares import login_required, load_user  # TODO find another location
+from .vote_buffer import apply_pending_votes
 
 
 async def register(request):
     data = await request.json()
     try:
-        await db.register(request.app['db'], data)
+        await db.register(request.app['db'], data, request.app['hasher'])
         log_string(request.app, 'new registration!', extra={'username': data['username']})
         return web.Response(status=web.HTTPCreated.status_code)
+    except TooManyRequests as e:
+        return json_response(str(e), status=web.HTTPTooManyRequests.status_code)
     except AppException as e:
-        return web.json_response(str(e), status=web.HTTPBadRequest.status_code)
+        return json_response(str(e), status=web.HTTPBadRequest.status_code)
     except Exception as e:
         log_exception(request.app, e)
-        return web.json_response(str(e), status=web.HTTPBadRequest.status_code)
+        return json_response(str(e), status=web.HTTPBadRequest.status_code)
 
 
 async def login(request):
     data = await request.json()
     try:
-        token = await db.login(request.app['db'], data, request.app['config']['jwt'])
+        token = await db.login(await db.read_engine(request.app), data, request.app['config']['jwt'],
+                               request.app['hasher'], primary=request.app['db'])
         log_string(request.app, 'new auth!', extra={'username': data['username']})
-        return web.json_response({'token': token.decode('utf-8')})
+        return json_response({'token': token.decode('utf-8')})
+    except TooManyRequests as e:
+        log_string(request.app, f'auth attempt: {e}', extra={'username': data['username']})
+        return json_response(str(e), status=web.HTTPTooManyRequests.status_code)
     except AppException as e:
-        return web.json_response(str(e), status=web.HTTPBadRequest.status_code)
+        return json_response(str(e), status=web.HTTPBadRequest.status_code)
     except BadRequest_Important as e:
         log_string(request.app, f'auth attempt: {e}', extra={'username': data['username']})
-        return web.json_response(str(e), status=web.HTTPBadRequest.status_code)
+        return json_response(str(e), status=web.HTTPBadRequest.status_code)
     except Exception as e:
         log_exception(request.app, e)
-        return web.json_response(str(e), status=web.HTTPBadRequest.status_code)
+        return json_response(str(e), status=web.HTTPBadRequest.status_code)
 
 
+@conditional_response(recipe_list_versions)
+@cached_response
 async def recipes(request):
     try:
         pagination, filters = prepare_filter_parameters(request.query)
-        recipes, count = await db.get_recipe_list(request.app['db'], pagination, filters, request.user)
-        response = prepare_recipes_response(recipes, count, request.rel_url)
-        return web.json_response(response, dumps=json_str_dumps)
+        dbengine = await db.read_engine(request.app, request.user)
+        recipes, count = await db.get_recipe_list(dbengine, pagination, filters, request.user,
+                                                  assembly=request.app['config']['recipe_assembly'],
+                                                  redis=request.app.get('redis'),
+                                                  count_ttl=await fill_ttl(request.app, recipe_list_tags([], filters),
+                                                                           COUNT_TTL))
+        recipes = await apply_pending_votes(request.app, recipes, request.user)
+        response = json_response(prepare_recipes_response(recipes, count, request.rel_url, pagination))
+        response['cache_tags'] = recipe_list_tags(recipes, filters)
+        return response
+    except AppException as e:
+        return json_response(str(e), status=web.HTTPBadRequest.status_code)
+    except Exception as e:
+        log_exception(request.app, e)
+        return web.Response(body=str(e), status=web.HTTPBadRequest.status_code)
+
+
+@cached_response
+async def search(request):
+    try:
+        q = request.query.get('q', '').strip()
+        if not q:
+            raise BadRequest('Missed required param "q"')
+        pagination, filters = prepare_filter_parameters(request.query)
+        dbengine = await db.read_engine(request.app, request.user)
+        recipes, count = await db.search_recipes(dbengine, q, pagination, filters, request.user)
+        recipes = await apply_pending_votes(request.app, recipes, request.user)
+        response = json_response(prepare_recipes_response(recipes, count, request.rel_url))
+        response['cache_tags'] = recipe_list_tags(recipes, filters)
+        return response
     except AppException as e:
-        return web.json_response(str(e), status=web.HTTPBadRequest.status_code)
+        return json_response(str(e), status=web.HTTPBadRequest.status_code)
     except Exception as e:
         log_exception(request.app, e)
         return web.Response(body=str(e), status=web.HTTPBadRequest.status_code)
 
 
+async def by_ingredients(request):
+    ''' recipes ranked by how many of their ingredients user has, served from ingredient_index '''
+    try:
+        tokens = request.query.get('ingredients', '').split(',')
+        limit = int(request.query.get('limit', 20))
+        offset = int(request.query.get('offset', 0))
+        assert limit > 0 and offset >= 0
+        index = request.app['ingredient_index']
+        await index.ensure_built(request.app['db_read'])
+        ingredient_ids, unknown = index.resolve(tokens)
+        if not ingredient_ids and not unknown:
+            raise BadRequest('Missed required param "ingredients"')
+        count, results = index.query(ingredient_ids, limit, offset)
+        return json_response({'count': count, 'unknown': unknown, 'results': results})
+    except AppException as e:
+        return json_response(str(e), status=web.HTTPBadRequest.status_code)
+    except Exception as e:
+        log_exception(request.app, e)
+        return web.Response(body=str(e), status=web.HTTPBadRequest.status_code)
+
+
+async def export(request):
+    ''' full catalog w ingredients as ndjson, category and date filters + since=<id or dd-mm-yyyy> '''
+    try:
+        _, filters = prepare_filter_parameters(request.query)
+        since_id, since_date = parse_since(request.query.get('since'))
+    except AppException as e:
+        return json_response(str(e), status=web.HTTPBadRequest.status_code)
+    except Exception as e:
+        log_exception(request.app, e)
+        return web.Response(body=str(e), status=web.HTTPBadRequest.status_code)
+
+    slots, stats = request.app['export_slots'], request.app['export_stats']
+    if slots.locked():
+        stats['rejected'] += 1
+        return json_response('Too many exports, try again later', status=web.HTTPTooManyRequests.status_code)
+    async with slots:
+        stats['active'] += 1
+        try:
+            return await stream_export(request, filters, since_id, since_date)
+        finally:
+            stats['active'] -= 1
+
+
+async def stream_export(request, filters, since_id, since_date):
+    config, stats = request.app['config'], request.app['export_stats']
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson; charset=utf-8'})
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    chunks = db.export_recipes(request.app['db_read'], filters, since_id, since_date,
+                               chunk_size=config['export_chunk_size'])
+    try:
+        async for recipes in chunks:
+            body = b''.join(ndjson_line(recipe) for recipe in recipes)
+            await asyncio.wait_for(response.write(body), config['export_write_timeout'])
+    except asyncio.TimeoutError:
+        # slow client would keep db connection and transaction
+        stats['timed_out'] += 1
+        log_string(request.app, 'export cut, client is too slow')
+        if request.transport is not None:
+            request.transport.abort()
+        return response
+    finally:
+        # releases connection if client went away in the middle
+        await chunks.aclose()
+    await response.write_eof()
+    return response
+
+
+def setup_export(app):
+    app['export_slots'] = asyncio.Semaphore(app['config']['export_max_concurrent'])
+    stats = app['export_stats'] = {'active': 0, 'rejected': 0, 'timed_out': 0}
+    app['metrics']['export'] = lambda: dict(stats)
+
+
 @login_required
 async def favored(request):
     try:
         pagination, filters = prepare_filter_parameters(request.query)
-        recipes, count = await db.get_recipe_list(request.app['db'], pagination, filters, request.user, favored=True)
-        response = prepare_recipes_response(recipes, count, request.rel_url)
-        return web.json_response(response, dumps=json_str_dumps)
+        dbengine = await db.read_engine(request.app, request.user)
+        recipes, count = await db.get_recipe_list(dbengine, pagination, filters, request.user, favored=True,
+                                                  assembly=request.app['config']['recipe_assembly'])
+        recipes = await apply_pending_votes(request.app, recipes, request.user)
+        response = prepare_recipes_response(recipes, count, request.rel_url, pagination)
+        return json_response(response)
     except AppException as e:
-        return web.json_response(str(e), status=web.HTTPBadRequest.status_code)
+        return json_response(str(e), status=web.HTTPBadRequest.status_code)
     except Exception as e:
         log_exception(request.app, e)
         return web.Response(body=str(e), status=web.HTTPBadRequest.status_code)
 
 
+@conditional_response(recipe_detail_versions)
+@cached_response
 async def recipe_detail(request):
     ''' detail view '''
     recipe_id = request.match_info['recipe_id']
     try:
-        recipe = await db.get_recipe_list(request.app['db'],
-                                          filters=recipe_id,
-                                          usr=request.user,
-                                          many=False)
-        return web.json_response(recipe, dumps=json_str_dumps)
+        recipe = await db.get_recipe_detail(await db.read_engine(request.app, request.user, recipe_id),
+                                            recipe_id,
+                                            usr=request.user,
+                                            assembly=request.app['config']['recipe_assembly'],
+                                            detail_cache=request.app.get('recipe_cache'))
+        recipe = (await apply_pending_votes(request.app, [recipe], request.user))[0]
+        request.app['versions'].add_slug(recipe['recipe_slug'], recipe['recipe_id'])
+        response = json_response(recipe)
+        response['cache_tags'] = recipe_detail_tags(recipe)
+        return response
     except AppException as e:
-        return web.json_response(str(e), status=web.HTTPBadRequest.status_code)
+        return json_response(str(e), status=web.HTTPBadRequest.status_code)
     except Exception as e:
         log_exception(request.app, e)
         return web.Response(body=str(e), status=web.HTTPBadRequest.status_code)
 
 
+# POST toggles the vote, PUT and DELETE set and unset it
+VOTE_MODES = {'POST': 'toggle', 'PUT': 'set', 'DELETE': 'unset'}
+
+
 @login_required
 async def vote_recipe(request):
     ''' detail view '''
     recipe_id = request.match_info['recipe_id']
     try:
-        await db.vote_recipe(request.app['db'], recipe_id, request.user)
-        return web.Response(status=web.HTTPCreated.status_code)
+        buffer = request.app.get('vote_buffer')
+        if buffer is not None:
+            likes = await buffer.vote(request.app['db'], recipe_id, request.user, VOTE_MODES[request.method])
+        else:
+            likes = await db.vote_recipe(request.app['db'], recipe_id, request.user, VOTE_MODES[request.method])
+        # None if vote already was as asked
+        if likes is not None:
+            await recipe_voted(request.app, recipe_id, request.user, likes)
+        if request.method == 'POST':
+            return web.Response(status=web.HTTPCreated.status_code)
+        return web.Response(status=web.HTTPNoContent.status_code)
+    except TooManyRequests as e:
+        return json_response(str(e), status=web.HTTPTooManyRequests.status_code)
     except AppException as e:
-        return web.json_response(str(e), status=web.HTTPBadRequest.status_code)
+        return json_response(str(e), status=web.HTTPBadRequest.status_code)
     except Exception as e:
         log_exception(request.app, e)
         return web.Response(body=str(e), status=web.HTTPBadRequest.status_code)
@@ -104,13 +244,14 @@ async def comment_recipe(request):
     data = await request.json()
     recipe_id = request.match_info['recipe_id']
     try:
-        await db.comment_recipe(request.app['db'], data, recipe_id, request.user)
+        comment = await db.comment_recipe(request.app['db'], data, recipe_id, request.user)
+        await recipe_commented(request.app, recipe_id, request.user, comment)
         log_string(request.app, 'new comment!', extra={'user': request.user['id'],
                                                        'recipe': recipe_id,
                                                        'body': data['body']})
         return web.Response(status=web.HTTPCreated.status_code)
     except AppException as e:
-        return web.json_response(str(e), status=web.HTTPBadRequest.status_code)
+        return json_response(str(e), status=web.HTTPBadRequest.status_code)
     except Exception as e:
         log_exception(request.app, e)
         return web.Response(body=str(e), status=web.HTTPBadRequest.status_code)
@@ -119,13 +260,14 @@ async def comment_recipe(request):
 @login_required
 async def collect(request):
     ''' collect API handler '''
-    if not request.user.get('superuser'):
+    user = await load_user(request)
+    if not (user and user['superuser']):
         recently_collected = await request.app['redis'].exists('collected')
         if recently_collected:
             ttl = await request.app['redis'].ttl('collected')
             log_string(request.app, 'collect request denied', extra={'user': request.user['id'], 'ttl': ttl})
-            return web.json_response({'message': 'Collection cannot be performed', 'ttl': ttl},
-                                     status=web.HTTPForbidden.status_code)
+            return json_response({'message': 'Collection cannot be performed', 'ttl': ttl},
+                                 status=web.HTTPForbidden.status_code)
     log_string(request.app, 'collect successful request', extra={'user': request.user['id']})
     await collect_recipes(request)
     await request.app['redis'].set('collected', 'placeholder', expire=60 * 60 * 6)  # 6 hours
@@ -151,23 +293,35 @@ async def userpic_upload(request):
 
         filename = await run_sync(generate_userpic_filename, request.user, request_filename, path)
         user = await db.set_userpic(request.app['db'], filename, request.user)
+        await user_updated(request.app, user['id'])
 
         log_string(request.app, f'uploaded userpic', extra={'user': user['id']})
-        return web.json_response(user, dumps=json_str_dumps)
+        return json_response(user)
 
     except BadRequest_Important as e:
         log_string(request.app, f'userpic upload denied: {e}', extra={'user': request.user['id'],
                                                                       'request_filename': request_filename})
-        return web.json_response(str(e), status=web.HTTPBadRequest.status_code)
+        return json_response(str(e), status=web.HTTPBadRequest.status_code)
     except Exception as e:
-        return web.json_response(str(e), status=web.HTTPBadRequest.status_code)
+        return json_response(str(e), status=web.HTTPBadRequest.status_code)
 
 
 @login_required
 async def current_user(request):
     ''' returns current logged user model '''
     try:
-        user = await db.user_by_id(request.app['db'], request.user['id'])
-        return web.json_response(user)
+        user = await load_user(request)
+        if not user:
+            raise RecordNotFound('Error while retrieve user record')
+        return json_response(user)
     except Exception as e:
         return web.Response(body=str(e), status=web.HTTPBadRequest.status_code)
+
+
+@login_required
+async def metrics(request):
+    ''' cache and background task counters, superusers only '''
+    user = await load_user(request)
+    if not (user and user['superuser']):
+        return json_response({'message': 'Superuser required'}, status=web.HTTPForbidden.status_code)
+    return json_response({name: collect() for name, collect in request.app['metrics'].items()})
@@ -0,0 +1,65 @@
+''' postgres engines, all w aiopg.sa interface used by recipes.db and scrape.db '''
+''' engine.acquire() -> conn, conn.execute(query, params) -> result w fetchone/fetchall, conn.begin() '''
+
+import itertools
+
+BACKENDS = ('aiopg', 'asyncpg')
+
+# e.g. vote for recipe that does not exist
+FOREIGN_KEY_VIOLATION = '23503'
+
+
+def connect_kwargs(conf):
+    ''' replicas are given by dsn, other connection parameters would override its parts '''
+    if conf.get('dsn'):
+        return {'dsn': conf['dsn']}
+    return {
+        'database': conf['database'],
+        'user': conf['user'],
+        'password': conf['password'],
+        'host': conf['host'],
+        'port': conf['port'],
+    }
+
+
+def sqlstate(exc):
+    ''' postgres error code of driver exception, psycopg2 has it as pgcode, asyncpg as sqlstate '''
+    return getattr(exc, 'pgcode', None) or getattr(exc, 'sqlstate', None)
+
+
+async def create_engine(conf):
+    backend = conf.get('backend', 'aiopg')
+    if backend == 'aiopg':
+        from .pg_aiopg import create_engine as create
+    elif backend == 'asyncpg':
+        from .pg_asyncpg import create_engine as create
+    else:
+        raise ValueError(f'Unknown postgres backend "{backend}", expected one of {BACKENDS}')
+    return await create(conf)
+
+
+class RoundRobinEngine:
+    ''' engine interface over several engines, each acquire() goes to the next one '''
+
+    def __init__(self, engines):
+        self.engines = engines
+        self._next = itertools.cycle(engines)
+
+    @property
+    def size(self):
+        return sum(engine.size for engine in self.engines)
+
+    @property
+    def freesize(self):
+        return sum(engine.freesize for engine in self.engines)
+
+    def acquire(self):
+        return next(self._next).acquire()
+
+    def close(self):
+        for engine in self.engines:
+            engine.close()
+
+    async def wait_closed(self):
+        for engine in self.engines:
+            await engine.wait_closed()
@@ -0,0 +1,12 @@
+import aiopg.sa
+
+from . import connect_kwargs
+
+
+async def create_engine(conf):
+    ''' psycopg2 text protocol, RowProxy rows '''
+    return await aiopg.sa.create_engine(
+        minsize=conf['minsize'],
+        maxsize=conf['maxsize'],
+        **connect_kwargs(conf)
+    )
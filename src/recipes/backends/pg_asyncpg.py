@@ -0,0 +1,167 @@
+''' asyncpg engine w the subset of aiopg.sa interface the app uses '''
+''' binary protocol, statements are prepared and cached per connection by asyncpg itself '''
+import asyncio
+import json
+import re
+from functools import lru_cache
+
+import asyncpg
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import ClauseElement
+
+from . import connect_kwargs
+
+
+class Compiler(postgresql.psycopg2.PGCompiler_psycopg2):
+    ''' column defaults go into params as aiopg.sa does, there is no execution context to run them '''
+
+    def construct_params(self, *args, **kwargs):
+        params = super().construct_params(*args, **kwargs)
+        for column in self.prefetch:
+            default = column.default
+            params[column.key] = default.arg(self.dialect) if default.is_callable else default.arg
+        return params
+
+
+# same sql and params as aiopg.sa gets, placeholders are rewritten for asyncpg
+_dialect = postgresql.psycopg2.dialect()
+_dialect.statement_compiler = Compiler
+
+PLACEHOLDER_RE = re.compile(r'%\((\w+)\)s|%s|%%')
+
+
+@lru_cache(maxsize=1024)
+def to_positional(sql):
+    ''' psycopg2 %(name)s / %s placeholders to $n, returns sql and param names (None for %s) '''
+    names = []
+    numbers = {}
+
+    def replace(match):
+        token = match.group(0)
+        if token == '%%':
+            return '%'
+        name = match.group(1)
+        if name is None:
+            names.append(None)
+            return f'${len(names)}'
+        if name not in numbers:
+            names.append(name)
+            numbers[name] = len(names)
+        return f'${numbers[name]}'
+
+    return PLACEHOLDER_RE.sub(replace, sql), tuple(names)
+
+
+def prepare_query(query, params=None):
+    if isinstance(query, ClauseElement):
+        compiled = query.compile(dialect=_dialect)
+        query, params = compiled.string, compiled.construct_params(params)
+    elif params is None:
+        # psycopg2 leaves sql w/o params as is, %% included
+        return query, ()
+    sql, names = to_positional(query)
+    if isinstance(params, dict):
+        return sql, tuple(params[name] for name in names)
+    return sql, tuple(params)
+
+
+async def init_connection(conn):
+    # psycopg2 returns json decoded, so do we
+    for typename in ('json', 'jsonb'):
+        await conn.set_type_codec(typename, encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+
+class ResultProxy:
+    ''' all rows are fetched by execute, asyncpg Record supports both record['name'] and record[0] '''
+
+    def __init__(self, records):
+        self._records = records
+        self._position = 0
+        self.rowcount = len(records)
+
+    async def fetchone(self):
+        if self._position >= len(self._records):
+            return None
+        record = self._records[self._position]
+        self._position += 1
+        return record
+
+    async def fetchall(self):
+        records = self._records[self._position:]
+        self._position = len(self._records)
+        return records
+
+    async def first(self):
+        return self._records[0] if self._records else None
+
+    async def scalar(self):
+        record = await self.first()
+        return record[0] if record is not None else None
+
+    def close(self):
+        pass
+
+
+class SAConnection:
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def execute(self, query, *multiparams, **params):
+        sql, args = prepare_query(query, multiparams[0] if multiparams else (params or None))
+        return ResultProxy(await self.connection.fetch(sql, *args))
+
+    async def scalar(self, query, *multiparams, **params):
+        result = await self.execute(query, *multiparams, **params)
+        return await result.scalar()
+
+    def begin(self):
+        return self.connection.transaction()
+
+
+class _AcquireContext:
+    def __init__(self, pool):
+        self._pool = pool
+        self._connection = None
+
+    async def __aenter__(self):
+        self._connection = await self._pool.acquire()
+        return SAConnection(self._connection)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._pool.release(self._connection)
+        self._connection = None
+
+
+class Engine:
+    def __init__(self, pool):
+        self._pool = pool
+        self._closing = None
+
+    @property
+    def size(self):
+        return self._pool.get_size()
+
+    @property
+    def freesize(self):
+        return self._pool.get_idle_size()
+
+    def acquire(self):
+        return _AcquireContext(self._pool)
+
+    def close(self):
+        # aiopg engine closes synchronously and is awaited in wait_closed
+        self._closing = asyncio.ensure_future(self._pool.close())
+
+    async def wait_closed(self):
+        if self._closing is not None:
+            await self._closing
+
+
+async def create_engine(conf):
+    pool = await asyncpg.create_pool(
+        min_size=conf['minsize'],
+        max_size=conf['maxsize'],
+        init=init_connection,
+        **connect_kwargs(conf)
+    )
+    return Engine(pool)
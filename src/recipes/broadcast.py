@@ -0,0 +1,315 @@
+''' recipe page websockets, comment and likes updates go to sockets open on the same recipe '''
+''' every socket has bounded send queue and own writer task, broadcast does not wait for any client '''
+import asyncio
+from uuid import uuid4
+
+from aioredis import RedisError
+from aioredis.pubsub import Receiver
+
+from .cache import evict_local
+from .helpers import log_exception
+from .utils import json_dumps
+
+# policy violation, client may reconnect and refetch the page
+CLOSE_SLOW_CONSUMER = 1008
+CHANNEL_PREFIX = 'ws:room:'
+# keys of in-process caches to evict in every worker, see evict_local
+EVICT_CHANNEL = 'cache:evict'
+RESUBSCRIBE_DELAY = 1  # seconds between attempts while redis is unreachable
+
+
+class WsClient:
+    ''' messages go through queue, only writer task sends to the socket '''
+
+    def __init__(self, ws, name, recipe_id, queue_size):
+        self.id = uuid4().hex
+        self.ws = ws
+        self.name = name
+        self.recipe_id = recipe_id
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.closing = False
+        self.close_code = None  # set for slow consumer
+        self.writer = asyncio.ensure_future(self._write())
+
+    def send(self, payload):
+        ''' False if there is no room for payload '''
+        if self.closing:
+            return True
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def send_json(self, data):
+        return self.send(json_dumps(data).decode())
+
+    async def _write(self):
+        while True:
+            payload = await self.queue.get()
+            try:
+                await self.ws.send_str(payload)
+            except (ConnectionError, RuntimeError):
+                # socket is gone, handler gets closed message and removes the client
+                self.closing = True
+                return
+
+    async def close(self):
+        self.closing = True
+        self.writer.cancel()
+        if self.close_code is None:
+            await self.ws.close()
+        else:
+            await self.ws.close(code=self.close_code, message=b'Slow consumer')
+
+
+class MemoryBroadcast:
+    ''' single process, messages go straight to local rooms '''
+    name = 'memory'
+
+    def __init__(self, app):
+        self.app = app
+
+    async def join(self, room):
+        pass
+
+    async def leave(self, room):
+        pass
+
+    async def publish(self, room, payload, exclude=None):
+        deliver(self.app, room, payload, exclude)
+
+    async def evict(self, key):
+        evict_local(self.app, key)
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class RedisBroadcast:
+    ''' payload is published once to channel of the room, every worker delivers it to own clients of the room '''
+    ''' worker is subscribed to channels of rooms it has clients in, one subscription per room; subscriptions lost
+    w pub/sub connection are made again on a new one, messages published in between are not delivered '''
+    ''' w/o shared_rooms only cache evictions go over redis, rooms are local as w MemoryBroadcast '''
+
+    def __init__(self, app, redis, shared_rooms=True):
+        self.app = app
+        self.redis = redis
+        self.shared_rooms = shared_rooms
+        self.name = 'redis' if shared_rooms else 'memory'
+        # receiver stays open w/o channels, rooms come and go
+        self.receiver = Receiver(on_close=self._channel_closed)
+        self.rooms = {}  # channel name -> room
+        self.subscriptions = {}  # channel name -> subscribe future, joins of the same room wait for it
+        self.lost = set()  # channel names to subscribe again
+        self.resubscriber = None
+        self.closed = False
+        self.counters = {'published': 0, 'received': 0, 'resubscribed': 0, 'evictions': 0}
+        self.reader = asyncio.ensure_future(self._read())
+
+    async def start(self):
+        await self.redis.subscribe(self.receiver.channel(EVICT_CHANNEL))
+
+    @staticmethod
+    def channel_name(room):
+        return f'{CHANNEL_PREFIX}{room}'
+
+    async def join(self, room):
+        if self.closed or not self.shared_rooms:
+            return
+        name = self.channel_name(room)
+        if name not in self.subscriptions:
+            self.rooms[name] = room
+            self.subscriptions[name] = asyncio.ensure_future(self.redis.subscribe(self.receiver.channel(name)))
+        await asyncio.shield(self.subscriptions[name])
+
+    async def leave(self, room):
+        name = self.channel_name(room)
+        self.rooms.pop(name, None)
+        if self.subscriptions.pop(name, None) is not None and not self.closed:
+            try:
+                await self.redis.unsubscribe(name)
+            except (OSError, RedisError) as e:
+                # subscription is gone w connection anyway
+                log_exception(self.app, e)
+
+    async def publish(self, room, payload, exclude=None):
+        if not self.shared_rooms:
+            deliver(self.app, room, payload, exclude)
+            return
+        if self.closed:
+            return
+        # sender connection id goes before payload, payload is not parsed again on the way
+        await self.redis.publish(self.channel_name(room), f'{exclude or ""}\n{payload}')
+        self.counters['published'] += 1
+
+    async def evict(self, key):
+        ''' here at once, in other workers when they get it '''
+        evict_local(self.app, key)
+        if not self.closed:
+            await self.redis.publish(EVICT_CHANNEL, key)
+
+    async def _read(self):
+        ''' ends on close only, receiver is not stopped by lost channels '''
+        async for channel, message in self.receiver.iter():
+            name = channel.name.decode()
+            if name == EVICT_CHANNEL:
+                self.counters['evictions'] += 1
+                evict_local(self.app, message.decode())
+                continue
+            room = self.rooms.get(name)
+            if room is None:
+                continue  # left while message was on the way
+            self.counters['received'] += 1
+            exclude, _, payload = message.partition(b'\n')
+            deliver(self.app, room, payload.decode(), exclude.decode() or None)
+
+    def _wanted(self, name):
+        return name in self.rooms or name == EVICT_CHANNEL
+
+    def _channel_closed(self, channel, exc=None):
+        ''' aioredis closes unsubscribed channels and all channels of a lost connection '''
+        name = channel.name.decode()
+        if self.closed or not self._wanted(name):
+            return  # room was left
+        self.lost.add(name)
+        if self.resubscriber is None or self.resubscriber.done():
+            self.resubscriber = asyncio.ensure_future(self._resubscribe())
+
+    async def _resubscribe(self):
+        while self.lost and not self.closed:
+            names = [name for name in self.lost if self._wanted(name)]
+            self.lost.clear()
+            if not names:
+                return
+            try:
+                # pool opens new pub/sub connection
+                await self.redis.subscribe(*[self.receiver.channel(name) for name in names])
+                self.counters['resubscribed'] += len(names)
+            except (OSError, RedisError) as e:
+                log_exception(self.app, e)
+                self.lost.update(names)
+                await asyncio.sleep(RESUBSCRIBE_DELAY)
+
+    async def close(self):
+        self.closed = True
+        if self.resubscriber is not None:
+            self.resubscriber.cancel()
+        try:
+            await self.redis.unsubscribe(EVICT_CHANNEL, *self.subscriptions)
+        except (OSError, RedisError) as e:
+            log_exception(self.app, e)
+        self.subscriptions.clear()
+        self.receiver.stop()
+        await self.reader
+
+    def stats(self):
+        return dict(self.counters, subscriptions=len(self.subscriptions), lost=len(self.lost))
+
+
+def setup_broadcast(app):
+    app['websockets'] = {}  # rooms, recipe_id -> {connection id -> WsClient}
+    app['broadcast'] = MemoryBroadcast(app)  # init_broadcast replaces it w redis one if configured
+    stats = app['ws_stats'] = {'broadcasts': 0, 'queued': 0, 'dropped': 0, 'disconnected': 0, 'max_depth': 0}
+    app['metrics']['websockets'] = lambda: ws_stats(app)
+
+
+async def init_broadcast(app):
+    ''' rooms are shared by workers w redis backend, each worker has only own rooms w memory one '''
+    ''' cache evictions go to all workers w redis whatever the backend, workers never serve each other's stale ones '''
+    redis = app.get('redis')
+    if redis is None:
+        yield
+        return
+    shared_rooms = app['config']['websockets']['backend'] == 'redis'
+    backend = app['broadcast'] = RedisBroadcast(app, redis, shared_rooms)
+    await backend.start()
+    yield
+    await backend.close()
+
+
+def all_clients(app):
+    return [client for room in app['websockets'].values() for client in room.values()]
+
+
+def ws_stats(app):
+    rooms = app['websockets']
+    depths = [client.queue.qsize() for client in all_clients(app)]
+    backend = app['broadcast']
+    return dict(app['ws_stats'], clients=len(depths), rooms=len(rooms),
+                largest_room=max(map(len, rooms.values())) if rooms else 0,
+                depth=sum(depths), largest_depth=max(depths) if depths else 0,
+                backend=backend.name, **backend.stats())
+
+
+async def add_client(app, ws, name, recipe_id):
+    ''' client gets messages published to the room after it returns '''
+    conf = app['config']['websockets']
+    client = WsClient(ws, name, recipe_id, conf['send_queue_size'])
+    app['websockets'].setdefault(recipe_id, {})[client.id] = client
+    await app['broadcast'].join(recipe_id)
+    return client
+
+
+async def remove_client(app, client):
+    rooms = app['websockets']
+    room = rooms.get(client.recipe_id, {})
+    room.pop(client.id, None)
+    if not room:
+        rooms.pop(client.recipe_id, None)
+        await app['broadcast'].leave(client.recipe_id)
+    # closed by handler on return otherwise, w normal code
+    await client.close()
+
+
+def deliver(app, recipe_id, payload, exclude=None):
+    ''' serialized payload is queued for every local client in the recipe room but excluded connection id '''
+    room = app['websockets'].get(recipe_id, {})
+    clients = [client for client in room.values() if client.id != exclude and not client.closing]
+    if not clients:
+        return
+    stats = app['ws_stats']
+    stats['broadcasts'] += 1
+    disconnect = app['config']['websockets']['slow_consumer'] == 'disconnect'
+    for client in clients:
+        if client.send(payload):
+            stats['queued'] += 1
+            stats['max_depth'] = max(stats['max_depth'], client.queue.qsize())
+            continue
+        stats['dropped'] += 1
+        if disconnect:
+            stats['disconnected'] += 1
+            client.closing = True
+            client.close_code = CLOSE_SLOW_CONSUMER
+            # closing handshake waits for the client, broadcast does not
+            asyncio.ensure_future(client.close())
+
+
+def fan_out(app, recipe_id, event, exclude=None):
+    ''' to local clients of the room only '''
+    deliver(app, recipe_id, json_dumps(event).decode(), exclude.id if exclude else None)
+
+
+async def publish(app, recipe_id, event, exclude=None):
+    ''' to clients of the room in all workers, event is serialized once '''
+    await app['broadcast'].publish(recipe_id, json_dumps(event).decode(), exclude.id if exclude else None)
+
+
+async def evict(app, key):
+    ''' in-process cache entry of all workers sharing the backend, see evict_local '''
+    await app['broadcast'].evict(key)
+
+
+async def publish_recipe_event(app, recipe_id, event):
+    await publish(app, recipe_id, event)
+
+
+def comment_event(recipe_id, comment):
+    return {'action': 'comment', 'recipe_id': recipe_id, 'comment': comment}
+
+
+def likes_event(recipe_id, likes):
+    return {'action': 'likes', 'recipe_id': recipe_id, 'likes': likes}
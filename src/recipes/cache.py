@@ -0,0 +1,447 @@
+import sys
+import json
+import math
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+from aiohttp import web, hdrs
+
+
+# serialized api responses for anonymous users, tag sets keep response keys to drop on invalidation
+# a response is a hash of body per encoding, identity plus compressed variants added on demand
+RESPONSE_KEY_PREFIX = 'response_variants:'
+RESPONSE_TAG_PREFIX = 'response_tag:'
+RESPONSE_TTL = 60 * 5
+# invalidation counter, generation of its last invalidation per tag; a response computed before it is not stored
+RESPONSE_GENERATION = 'response_generation'
+RESPONSE_TAG_GENERATION_PREFIX = 'response_tag_generation:'
+
+# recipe list counts by filter signature, the set keeps keys to drop on invalidation
+COUNT_KEY_PREFIX = 'recipes:count:'
+COUNT_KEYS = 'recipes:count_keys'
+COUNT_TTL = 60 * 10
+COUNT_GENERATION = 'recipes:count_generation'
+
+# version + modification time per recipe and for the whole collection, etags are built from them
+VERSION_KEY_PREFIX = 'version:'
+COLLECTION_VERSION = 'recipes'
+SLUGS_MAXSIZE = 10000
+SLUGS_TTL = 60 * 60 * 24
+
+
+def filter_signature(filters):
+    ''' same filters in any order or format give the same signature '''
+    signature = {}
+    if filters:
+        category = filters.get('category')
+        if category:
+            signature['category'] = sorted({int(cat) for cat in category.split(',')})
+        prep_time = filters.get('prep_time')
+        if prep_time:
+            signature['prep_time'] = int(prep_time)
+        date = filters.get('date')
+        if date:
+            signature['date'] = {key: value for key, value in date.items() if value}
+    return json.dumps(signature, sort_keys=True, separators=(',', ':'))
+
+
+async def get_cached_count(redis, filters):
+    ''' count or None and generation to pass to set_cached_count '''
+    count, generation = await redis.mget(COUNT_KEY_PREFIX + filter_signature(filters), COUNT_GENERATION)
+    return int(count) if count is not None else None, int(generation or 0)
+
+
+# count computed before an invalidation is not stored after it
+SET_COUNT_SCRIPT = '''
+if tonumber(redis.call('get', KEYS[3]) or '0') ~= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('set', KEYS[1], ARGV[1], 'ex', ARGV[3])
+redis.call('sadd', KEYS[2], KEYS[1])
+return 1
+'''
+
+
+async def set_cached_count(redis, filters, count, generation, ttl=COUNT_TTL):
+    key = COUNT_KEY_PREFIX + filter_signature(filters)
+    await redis.eval(SET_COUNT_SCRIPT, keys=[key, COUNT_KEYS, COUNT_GENERATION], args=[count, generation, ttl])
+
+
+async def invalidate_counts(redis):
+    await redis.incr(COUNT_GENERATION)
+    keys = await redis.smembers(COUNT_KEYS)
+    await redis.delete(COUNT_KEYS, *keys)
+
+
+def replica_lag(app):
+    ''' seconds a replica may miss a write for, 0 w/o replicas '''
+    conf = app['config']['postgres']
+    return conf['pin_seconds'] if conf['replicas'] else 0
+
+
+async def fill_ttl(app, tags, ttl):
+    ''' ttl for shared cache fill of data w tags, read from replica it may miss a write of lag seconds ago '''
+    ''' then it is kept for that long only, see db.mark_written '''
+    lag = replica_lag(app)
+    if lag and tags and await app['db_pins'].any(tags, app.get('redis')):
+        return min(ttl, lag)
+    return ttl
+
+
+def setup_response_cache(app):
+    stats = app['response_cache_stats'] = {'hits': 0, 'misses': 0, 'variant_hits': 0, 'stale_skips': 0}
+    app['metrics']['response_cache'] = lambda: dict(stats)
+
+
+def response_cache_key(request):
+    return RESPONSE_KEY_PREFIX + request.path + '?' + urlencode(sorted(request.query.items()))
+
+
+def recipe_list_tags(recipes, filters):
+    ''' list page changes w its recipes or w new recipes in its categories '''
+    tags = [f'recipe:{one_recipe["recipe_id"]}' for one_recipe in recipes]
+    category = filters.get('category') if filters else None
+    if category:
+        tags += [f'category:{int(cat)}' for cat in category.split(',')]
+    else:
+        tags.append('list')
+    return tags
+
+
+def recipe_detail_tags(one_recipe):
+    return [f'recipe:{one_recipe["recipe_id"]}']
+
+
+def cached_response(handler):
+    ''' serves anonymous GET responses from redis, handler sets response['cache_tags'] to get cached '''
+    # request['encoding'] comes from compression_middleware, it adds compressed variants by response['cache_key']
+    async def wrapper(request):
+        redis = request.app.get('redis')
+        if redis is None or request.user or request.method != 'GET':
+            return await handler(request)
+
+        stats = request.app['response_cache_stats']
+        key = response_cache_key(request)
+        encoding = request.get('encoding')
+        body, variant = await redis.hmget(key, 'identity', encoding or 'identity')
+        if body is not None:
+            stats['hits'] += 1
+            if encoding and variant is not None:
+                stats['variant_hits'] += 1
+                return web.Response(body=variant, content_type='application/json', charset='utf-8',
+                                    headers={hdrs.CONTENT_ENCODING: encoding, hdrs.VARY: hdrs.ACCEPT_ENCODING})
+            response = web.Response(body=body, content_type='application/json', charset='utf-8')
+            response['cache_key'] = key
+            return response
+
+        stats['misses'] += 1
+        # read before handler runs, tags invalidated after it are not stored
+        generation = int(await redis.get(RESPONSE_GENERATION) or 0)
+        response = await handler(request)
+        tags = response.get('cache_tags')
+        if response.status == web.HTTPOk.status_code and tags:
+            ttl = await fill_ttl(request.app, tags, RESPONSE_TTL)
+            if await store_response(redis, key, response.body, tags, generation, ttl):
+                response['cache_key'] = key
+            else:
+                stats['stale_skips'] += 1
+        return response
+    return wrapper
+
+
+# KEYS: response key, then tag set and tag generation key per tag; ARGV: body, generation, ttl, tag set ttl
+STORE_RESPONSE_SCRIPT = '''
+for i = 2, #KEYS, 2 do
+    if tonumber(redis.call('get', KEYS[i + 1]) or '0') > tonumber(ARGV[2]) then
+        return 0
+    end
+end
+redis.call('del', KEYS[1])
+redis.call('hset', KEYS[1], 'identity', ARGV[1])
+redis.call('expire', KEYS[1], ARGV[3])
+for i = 2, #KEYS, 2 do
+    redis.call('sadd', KEYS[i], KEYS[1])
+    redis.call('expire', KEYS[i], ARGV[4])
+end
+return 1
+'''
+
+
+async def store_response(redis, key, body, tags, generation, ttl=RESPONSE_TTL):
+    ''' False if a tag was invalidated after generation, body might be older than the change '''
+    keys = [key]
+    for tag in tags:
+        keys += [RESPONSE_TAG_PREFIX + tag, RESPONSE_TAG_GENERATION_PREFIX + tag]
+    # tag sets outlive any response in them
+    return bool(await redis.eval(STORE_RESPONSE_SCRIPT, keys=keys, args=[body, generation, ttl, RESPONSE_TTL]))
+
+
+# variant goes only into a response still cached, invalidated ones are not brought back w/o ttl
+STORE_VARIANT_SCRIPT = '''
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+end
+return 0
+'''
+
+
+async def store_response_variant(redis, key, encoding, body):
+    await redis.eval(STORE_VARIANT_SCRIPT, keys=[key], args=[encoding, body])
+
+
+async def invalidate_tags(redis, tags):
+    generation = await redis.incr(RESPONSE_GENERATION)
+    transaction = redis.multi_exec()
+    for tag in tags:
+        # outlives any response computed before it
+        transaction.set(RESPONSE_TAG_GENERATION_PREFIX + tag, generation, expire=RESPONSE_TTL)
+    await transaction.execute()
+    tag_keys = [RESPONSE_TAG_PREFIX + tag for tag in tags]
+    response_keys = set()
+    for tag_key in tag_keys:
+        response_keys.update(await redis.smembers(tag_key))
+    await redis.delete(*tag_keys, *response_keys)
+
+
+def add_vary(response, header):
+    vary = response.headers.get(hdrs.VARY)
+    response.headers[hdrs.VARY] = f'{vary}, {header}' if vary else header
+
+
+def deep_sizeof(value):
+    ''' rough memory size of json-like value '''
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_sizeof(key) + deep_sizeof(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(deep_sizeof(item) for item in value)
+    return size
+
+
+class LRUCache:
+    ''' bounded in-process cache w ttl, least recently used entries go first '''
+
+    def __init__(self, maxsize, ttl, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.memory = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value, size)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self.pop(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        self.pop(key)
+        size = deep_sizeof(value)
+        self._entries[key] = (time.monotonic() + self.ttl, value, size)
+        self.memory += size
+        while len(self._entries) > self.maxsize:
+            self.pop(next(iter(self._entries)))
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.memory -= entry[2]
+            if self.on_evict:
+                self.on_evict(key, entry[1])
+        return entry[1] if entry else None
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / requests if requests else 0,
+            'entries': len(self._entries),
+            'memory': self.memory,
+        }
+
+
+class RecipeDetailCache:
+    ''' anonymous recipe detail by id, slugs resolve to the same entry '''
+
+    def __init__(self, maxsize, ttl):
+        self._recipes = LRUCache(maxsize, ttl, on_evict=self._drop_slug)
+        self._slugs = {}
+
+    def _drop_slug(self, recipe_id, one_recipe):
+        self._slugs.pop(one_recipe['recipe_slug'], None)
+
+    def get(self, recipe_id_or_slug):
+        if recipe_id_or_slug.isdigit():
+            return self._recipes.get(int(recipe_id_or_slug))
+        recipe_id = self._slugs.get(recipe_id_or_slug)
+        if recipe_id is None:
+            self._recipes.misses += 1
+            return None
+        return self._recipes.get(recipe_id)
+
+    def set(self, one_recipe):
+        self._recipes.set(one_recipe['recipe_id'], one_recipe)
+        if one_recipe['recipe_slug']:
+            self._slugs[one_recipe['recipe_slug']] = one_recipe['recipe_id']
+
+    def evict(self, recipe_id):
+        self._recipes.pop(int(recipe_id))
+
+    def stats(self):
+        return self._recipes.stats()
+
+
+def evict_local(app, key):
+    ''' recipe:<id> from detail cache or user:<id> from user cache of this worker '''
+    kind, _, key_id = key.partition(':')
+    if kind == 'recipe' and app.get('recipe_cache') is not None:
+        app['recipe_cache'].evict(key_id)
+    elif kind == 'user' and app.get('user_cache') is not None:
+        app['user_cache'].pop(int(key_id))
+
+
+def setup_recipe_cache(app):
+    conf = app['config']['recipe_cache']
+    cache = app['recipe_cache'] = RecipeDetailCache(maxsize=conf['maxsize'], ttl=conf['ttl'])
+    app['metrics']['recipe_cache'] = cache.stats
+
+
+def recipe_version(recipe_id):
+    return f'recipe:{int(recipe_id)}'
+
+
+def initial_version():
+    # ms since epoch, so counters started after a restart never repeat issued etags
+    now = time.time()
+    return int(now * 1000), now
+
+
+class Versions:
+    ''' counters bumped on recipe changes, in redis to be shared by workers, in process w/o redis '''
+
+    def __init__(self):
+        self._local = {}  # key -> (version, modified)
+        self.slugs = LRUCache(maxsize=SLUGS_MAXSIZE, ttl=SLUGS_TTL)  # slug -> recipe id
+
+    def add_slug(self, slug, recipe_id):
+        if slug:
+            self.slugs.set(slug, int(recipe_id))
+
+    async def get(self, keys, redis=None):
+        ''' combined version and latest modification time of keys '''
+        if redis is None:
+            values = [self._local.setdefault(key, initial_version()) for key in keys]
+        else:
+            version, modified = initial_version()
+            transaction = redis.multi_exec()
+            for key in keys:
+                transaction.hsetnx(VERSION_KEY_PREFIX + key, 'version', version)
+                transaction.hsetnx(VERSION_KEY_PREFIX + key, 'modified', modified)
+                transaction.hmget(VERSION_KEY_PREFIX + key, 'version', 'modified')
+            results = await transaction.execute()
+            values = [(int(result[0]), float(result[1])) for result in results[2::3]]
+        return '.'.join(str(value[0]) for value in values), max(value[1] for value in values)
+
+    async def bump(self, keys, redis=None):
+        if redis is None:
+            for key in keys:
+                version = self._local.get(key, initial_version())[0]
+                self._local[key] = (version + 1, time.time())
+            return
+        version, modified = initial_version()
+        transaction = redis.multi_exec()
+        for key in keys:
+            transaction.hsetnx(VERSION_KEY_PREFIX + key, 'version', version)
+            transaction.hincrby(VERSION_KEY_PREFIX + key, 'version', 1)
+            transaction.hset(VERSION_KEY_PREFIX + key, 'modified', modified)
+        await transaction.execute()
+
+
+def setup_versions(app):
+    app['versions'] = Versions()
+    stats = app['conditional_stats'] = {'not_modified': 0, 'modified': 0}
+    app['metrics']['conditional'] = lambda: dict(stats)
+
+
+def recipe_list_versions(request):
+    return [COLLECTION_VERSION]
+
+
+def recipe_detail_versions(request):
+    ''' None for slugs not seen yet, response goes w/o etag then '''
+    recipe_id = request.match_info['recipe_id']
+    if not recipe_id.isdigit():
+        recipe_id = request.app['versions'].slugs.get(recipe_id)
+        if recipe_id is None:
+            return None
+    return [recipe_version(recipe_id)]
+
+
+def etag_matches(if_none_match, etag):
+    ''' weak comparison, W/ prefixes are ignored '''
+    if if_none_match.strip() == '*':
+        return True
+    candidates = (candidate.strip() for candidate in if_none_match.split(','))
+    return any((candidate[2:] if candidate.startswith('W/') else candidate) == etag for candidate in candidates)
+
+
+def conditional_response(version_keys):
+    ''' weak etag and last-modified from versions of version_keys(request), 304 w/o running handler '''
+    def decorator(handler):
+        async def wrapper(request):
+            keys = version_keys(request) if request.method == 'GET' else None
+            if not keys:
+                return await handler(request)
+
+            # read before handler runs, a change in between makes etag older than body, never newer
+            version, modified = await request.app['versions'].get(keys, request.app.get('redis'))
+            # liked flags make authenticated responses differ per user
+            etag = f'"{version}-{request.user["id"]}"' if request.user else f'"{version}"'
+            # second resolution, rounded up; a date sent before its second is over would match later changes
+            # in the same second too, so it is sent only after that and If-Modified-Since is safe to trust
+            last_modified = datetime.fromtimestamp(math.ceil(modified), timezone.utc)
+            if time.time() < math.ceil(modified):
+                last_modified = None
+            headers = {
+                hdrs.ETAG: 'W/' + etag,
+                hdrs.CACHE_CONTROL: 'private, no-cache' if request.user else 'no-cache',
+            }
+
+            if_none_match = request.headers.get(hdrs.IF_NONE_MATCH)
+            if if_none_match is not None:
+                not_modified = etag_matches(if_none_match, etag)
+            else:
+                since = request.if_modified_since
+                not_modified = since is not None and last_modified is not None and last_modified <= since
+            stats = request.app['conditional_stats']
+            if not_modified:
+                stats['not_modified'] += 1
+                response = web.Response(status=web.HTTPNotModified.status_code, headers=headers)
+                response.last_modified = last_modified
+                add_vary(response, 'authorization_jwt')
+                return response
+
+            stats['modified'] += 1
+            response = await handler(request)
+            # body read from replica right after the change may miss it, it must not be revalidated as current
+            fresh = time.time() - modified >= replica_lag(request.app)
+            if response.status == web.HTTPOk.status_code and fresh:
+                response.headers.update(headers)
+                response.last_modified = last_modified
+                add_vary(response, 'authorization_jwt')
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,98 @@
+''' gzip / brotli response compression negotiated by Accept-Encoding '''
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web, hdrs
+
+from .cache import store_response_variant, add_vary
+from .helpers import run_sync
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# preferred first, brotli wins over gzip at equal q
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def negotiate_encoding(accept_encoding):
+    ''' best supported encoding for Accept-Encoding header or None for identity '''
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[coding.strip().lower()] = weight
+    best, best_weight = None, 0.0
+    for encoding in ENCODINGS:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def compress(body, encoding, conf):
+    if encoding == 'br':
+        return brotli.compress(body, quality=conf['brotli_quality'])
+    # no mtime in header unlike gzip.compress, same body gives same bytes
+    compressor = zlib.compressobj(conf['gzip_level'], zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def compressible(response, conf):
+    # streamed responses are sent by the time they get here
+    return (isinstance(response, web.Response)
+            and response.status == web.HTTPOk.status_code
+            and hdrs.CONTENT_ENCODING not in response.headers
+            and response.content_type in conf['content_types']
+            and isinstance(response.body, (bytes, bytearray))
+            and len(response.body) >= conf['min_size'])
+
+
+@web.middleware
+async def compression_middleware(request, handler):
+    ''' cached_response reads negotiated encoding from request['encoding'] to serve stored variants '''
+    encoding = request['encoding'] = negotiate_encoding(request.headers.get(hdrs.ACCEPT_ENCODING))
+    response = await handler(request)
+    conf = request.app['config']['compression']
+    if not compressible(response, conf):
+        return response
+    add_vary(response, hdrs.ACCEPT_ENCODING)
+    if encoding is None:
+        return response
+
+    body = response.body
+    if len(body) >= conf['executor_size']:
+        compressed = await run_sync(compress, body, encoding, conf, executor=request.app['compression_executor'])
+    else:
+        compressed = compress(body, encoding, conf)
+    stats = request.app['compression_stats']
+    stats['compressed'] += 1
+    stats['bytes_in'] += len(body)
+    stats['bytes_out'] += len(compressed)
+
+    response.body = compressed
+    response.headers[hdrs.CONTENT_ENCODING] = encoding
+    cache_key = response.get('cache_key')
+    redis = request.app.get('redis')
+    if cache_key and redis is not None:
+        await store_response_variant(redis, cache_key, encoding, compressed)
+    return response
+
+
+async def init_compression(app):
+    conf = app['config']['compression']
+    app['compression_executor'] = ThreadPoolExecutor(max_workers=conf['workers'])
+    stats = app['compression_stats'] = {'compressed': 0, 'bytes_in': 0, 'bytes_out': 0}
+    app['metrics']['compression'] = lambda: dict(stats)
+    yield
+    app['compression_executor'].shutdown(wait=True)
@@ -1,79 +1,219 @@
 from datetime import datetime, timedelta
 
-import aiopg.sa
+import json
 
 import jwt
 import sqlalchemy as sa
-from passlib.hash import sha256_crypt
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import ARRAY
 
+from .backends import create_engine, RoundRobinEngine, sqlstate, FOREIGN_KEY_VIOLATION
+from .cache import get_cached_count, set_cached_count, LRUCache, COUNT_TTL
 from .helpers import make_where_list_recipes
-from .exceptions import RecordNotFound
-from .validators import validate_comment, validate_recipe, validate_login, validate_register
+from .exceptions import RecordNotFound, BadRequest
+from .statements import statements, execute_cached, bind_values, where_shape
+from .validators import (
+    validate_comment, validate_recipe, validate_recipe_id, validate_login, validate_register, check_credentials
+)
 from .db_tables import (
     users, source, category, ingredient, ingredient_item,
-    recipe, comment, vote
+    recipe, comment, vote, recipe_seek_date, recipe_list_columns
 )
 
+# keys of PrimaryPins are response cache tags of what was written
+PIN_KEY_PREFIX = 'pin:'
+
+
+class PrimaryPins:
+    ''' keys read from primary for a while, in redis w ttl to be shared by workers, in process w/o redis '''
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._local = LRUCache(maxsize=10000, ttl=ttl)
+
+    def __len__(self):
+        return len(self._local)
+
+    async def set(self, keys, redis=None):
+        if redis is None:
+            for key in keys:
+                self._local.set(key, True)
+            return
+        transaction = redis.multi_exec()
+        for key in keys:
+            transaction.set(PIN_KEY_PREFIX + key, 1, expire=self.ttl)
+        await transaction.execute()
+
+    async def any(self, keys, redis=None):
+        if redis is None:
+            return any(self._local.get(key) for key in keys)
+        return any(await redis.mget(*[PIN_KEY_PREFIX + key for key in keys]))
+
 
 async def init_pg(app):
+    ''' app['db'] is primary for writes and scraping, app['db_read'] is a separate pool for API reads '''
     conf = app['config']['postgres']
-    engine = await aiopg.sa.create_engine(
-        database=conf['database'],
-        user=conf['user'],
-        password=conf['password'],
-        host=conf['host'],
-        port=conf['port'],
-        minsize=conf['minsize'],
-        maxsize=conf['maxsize'],
-    )
+    engine = await create_engine(conf)
     app['db'] = engine
+
+    read_conf = dict(conf, minsize=conf['read_minsize'], maxsize=conf['read_maxsize'])
+    if conf['replicas']:
+        app['db_read'] = RoundRobinEngine([await create_engine(dict(read_conf, dsn=dsn)) for dsn in conf['replicas']])
+    else:
+        # same server, but scraper writes can't take connections of API reads
+        app['db_read'] = await create_engine(read_conf)
+    # user:<id> and recipe:<id> while their reads go to primary, list and category:<id> while cache fills of lists
+    # get shorter ttl, see fill_ttl; lists stay on replicas
+    app['db_pins'] = PrimaryPins(ttl=conf['pin_seconds'])
     return engine
 
 
 async def close_pg(app):
-    app['db'].close()
-    await app['db'].wait_closed()
-
-
-async def get_recipe_list(dbengine, pagination=None, filters=None, usr=None, many=True, favored=False):
+    for engine in (app['db_read'], app['db']):
+        engine.close()
+        await engine.wait_closed()
+
+
+async def read_engine(app, usr=None, recipe_id=None):
+    ''' engine for API reads, primary for a user pinned by pin_to_primary and for recipe (id or slug) changed by
+    mark_written '''
+    if not app['config']['postgres']['replicas']:
+        return app['db_read']  # nothing lags, pins are not set
+    keys = [f'user:{usr["id"]}'] if usr else []
+    if recipe_id is not None:
+        if not str(recipe_id).isdigit():
+            slugs = app['versions'].slugs if 'versions' in app else None
+            slug = recipe_id
+            recipe_id = slugs.get(slug) if slugs is not None else None
+            if recipe_id is None:
+                recipe_id = await get_recipe_id(app['db_read'], slug)
+            if recipe_id is None:
+                return app['db']  # new recipe might not be on replica yet
+        keys.append(f'recipe:{int(recipe_id)}')
+    if keys and await app['db_pins'].any(keys, app.get('redis')):
+        return app['db']
+    return app['db_read']
+
+
+async def pin_to_primary(app, user_id):
+    ''' read-your-writes, replica might not have user's vote or comment yet '''
+    if app['config']['postgres']['replicas']:
+        await app['db_pins'].set([f'user:{user_id}'], app.get('redis'))
+
+
+async def mark_written(app, recipe_id, category_id=None):
+    ''' recipe is read from primary for a while, so caches are not refilled from a lagging replica; category_id is
+    for a new or moved recipe, lists it shows up in are still read from replica, w short-lived cache fills '''
+    if app['config']['postgres']['replicas']:
+        keys = [f'recipe:{int(recipe_id)}']
+        if category_id is not None:
+            keys += ['list', f'category:{int(category_id)}']
+        await app['db_pins'].set(keys, app.get('redis'))
+
+
+def pool_stats(app):
+    return {
+        'primary': {'size': app['db'].size, 'free': app['db'].freesize},
+        'read': {'size': app['db_read'].size, 'free': app['db_read'].freesize},
+        'replicas': len(app['config']['postgres']['replicas']),
+        'local_pins': len(app['db_pins']),  # w/o redis
+    }
+
+
+async def get_recipe_list(dbengine, pagination=None, filters=None, usr=None, many=True, favored=False,
+                          assembly='queries', redis=None, count_ttl=COUNT_TTL):
     if pagination:
         limit = pagination['limit'] if 'limit' in pagination else 20
         offset = pagination['offset'] if 'offset' in pagination else 0
+        cursor = pagination['cursor'] if 'cursor' in pagination else None
+        count_mode = pagination['count'] if 'count' in pagination else 'exact'
     else:
-        limit, offset = 20, 0
+        limit, offset, cursor, count_mode = 20, 0, None, 'exact'
     where_list = make_where_list_recipes(filters, many)
 
+    # favored counts are per user and cheap, only full list counts are cached
+    count_cache = redis if many and not favored else None
+    count = count_generation = None
+    if count_cache is not None:
+        count, count_generation = await get_cached_count(count_cache, filters)
+    count_was_cached = count is not None
+
     async with dbengine.acquire() as conn:
-        recipes = await get_pure_recipe_list(conn, limit, offset, where_list, usr, many, favored)
-        # fetch related ingredient item list for recipes
-        recipes = await fetch_ingredients_for_recipes(conn,recipes)
-        # fetch related comment list for recipes
-        recipes = await fetch_comments_for_recipes(conn, recipes)
+        if assembly == 'json':
+            # recipes w nested ingredients, comments and count in one statement
+            with_count = count is None and count_mode == 'exact'
+            recipes, assembled_count = await get_assembled_recipe_list(conn, limit, offset, where_list, usr, many,
+                                                                       favored, cursor, with_count)
+            count = count if assembled_count is None else assembled_count
+        else:
+            recipes = await get_pure_recipe_list(conn, limit, offset, where_list, usr, many, favored, cursor)
+            # fetch related ingredient item list for recipes
+            recipes = await fetch_ingredients_for_recipes(conn,recipes)
+            # fetch related comment list for recipes
+            recipes = await fetch_comments_for_recipes(conn, recipes)
         if many:
-            # fetch count for full filtered recipe list
-            count = await get_recipe_list_count(conn, where_list, favored, usr)
+            if count is None and count_mode == 'estimate' and not favored:
+                return recipes, await get_recipe_list_count_estimate(conn, where_list)
+            if count is None:
+                # fetch count for full filtered recipe list
+                count = await get_recipe_list_count(conn, where_list, favored, usr)
+            if count_cache is not None and not count_was_cached:
+                await set_cached_count(count_cache, filters, count, count_generation, count_ttl)
             return recipes, count
         return recipes[0]
 
 
+async def get_recipe_detail(dbengine, recipe_id, usr=None, assembly='queries', detail_cache=None):
+    ''' recipe by id or slug, cached entries are shared by users and liked is fetched on top '''
+    if detail_cache is None:
+        return await get_recipe_list(dbengine, filters=recipe_id, usr=usr, many=False, assembly=assembly)
+
+    one_recipe = detail_cache.get(recipe_id)
+    if one_recipe is None:
+        one_recipe = await get_recipe_list(dbengine, filters=recipe_id, many=False, assembly=assembly)
+        detail_cache.set(one_recipe)
+    if usr:
+        liked = await get_recipe_liked(dbengine, one_recipe['recipe_id'], usr)
+        one_recipe = dict(one_recipe, liked=liked)
+    return one_recipe
+
+
+async def get_recipe_liked(dbengine, recipe_id, usr):
+    async with dbengine.acquire() as conn:
+        cursor = await execute_cached(
+            conn, ('recipe_liked',),
+            lambda: sa.select([sa.exists().where(sa.and_(
+                vote.c.recipe_id == sa.bindparam('recipe_id'),
+                vote.c.value == True,
+                vote.c.user_id == sa.bindparam('user_id')))]),
+            {'recipe_id': recipe_id, 'user_id': usr['id']})
+        return (await cursor.fetchone())[0]
+
+
+def group_by_recipe(records):
+    grouped = {}
+    for record in records:
+        grouped.setdefault(record['recipe_id'], []).append(record)
+    return grouped
+
+
 async def fetch_comments_for_recipes(conn, recipes):
-    comments = await get_pure_comment_list(conn, recipes)
+    comments = group_by_recipe(await get_pure_comment_list(conn, recipes))
     for _recipe in recipes:
-        comment_list = []
-        for _comment in comments:
-            if _comment['recipe_id'] == _recipe['recipe_id']:
-                comment_list.append(_comment)
-        _recipe.update({'comments': comment_list})
+        _recipe.update({'comments': comments.get(_recipe['recipe_id'], [])})
     return recipes
 
 
 async def get_pure_comment_list(conn, recipes):
+    if not recipes:
+        return []
     recipe_ids = [recipe['recipe_id'] for recipe in recipes]
-    query = sa.select([comment.c.recipe_id, comment.c.body, comment.c.pub_date, users.c.username]).\
+    # = any(array) keeps one statement for any number of recipes, in_() would not
+    query = lambda: sa.select([comment.c.recipe_id, comment.c.body, comment.c.pub_date, users.c.username]).\
         select_from(
         comment.join(users, users.c.id == comment.c.user_id)
-    ).where(comment.c.recipe_id.in_(recipe_ids))
-    cursor = await conn.execute(query)
+    ).where(comment.c.recipe_id == sa.any_(sa.bindparam('recipe_ids', type_=ARRAY(sa.Integer))))
+    cursor = await execute_cached(conn, ('comment_list',), query, {'recipe_ids': recipe_ids})
     comment_records = await cursor.fetchall()
     comments = [dict(q) for q in comment_records]
     return comments
@@ -81,175 +221,476 @@ async def get_pure_comment_list(conn, recipes):
 
 async def fetch_ingredients_for_recipes(conn, recipes):
     ''' selects related ingredient for ingredient_item '''
-    ingredient_items = await get_pure_ingredient_items_list(conn, recipes)
+    ingredient_items = group_by_recipe(await get_pure_ingredient_items_list(conn, recipes))
     # adding ingredient_items to recipes
     for _recipe in recipes:
-        ingredient_item_list = []
-        for _ingredient_item in ingredient_items:
-            if _ingredient_item['recipe_id'] == _recipe['recipe_id']:
-                ingredient_item_list.append(_ingredient_item)
-        _recipe.update({'ingredients': ingredient_item_list})
+        _recipe.update({'ingredients': ingredient_items.get(_recipe['recipe_id'], [])})
     return recipes
 
 
 async def get_pure_ingredient_items_list(conn, recipes):
     if recipes:
-        recipe_ids = str(tuple(recipe['recipe_id'] for recipe in recipes)).replace(',)', ')')
-        raw = f'''
-            select ii.recipe_id, ii.qty, ingr.name
-            from ingredient_item ii
-            join ingredient ingr
-              on ingr.id = ii.ingredient_id
-            where ii.recipe_id in {recipe_ids}
-            '''
-        # query = sa.select([ingredient_item.c.recipe_id, ingredient_item.c.qty, ingredient.c.name]).\
-        #     select_from(
-        #     ingredient_item.join(ingredient, ingredient.c.id == ingredient_item.c.ingredient_id)
-        # ).where(ingredient_item.c.recipe_id.in_(recipe_ids))
-
-        cursor = await conn.execute(raw)
+        recipe_ids = [recipe['recipe_id'] for recipe in recipes]
+        query = lambda: sa.select([ingredient_item.c.recipe_id, ingredient_item.c.qty, ingredient.c.name]).\
+            select_from(
+            ingredient_item.join(ingredient, ingredient.c.id == ingredient_item.c.ingredient_id)
+        ).where(ingredient_item.c.recipe_id == sa.any_(sa.bindparam('recipe_ids', type_=ARRAY(sa.Integer))))
+
+        cursor = await execute_cached(conn, ('ingredient_item_list',), query, {'recipe_ids': recipe_ids})
         ingredient_item_records = await cursor.fetchall()
         ingredient_items = [dict(q) for q in ingredient_item_records]
         return ingredient_items
     return []
 
 
-async def get_pure_recipe_list(conn, limit, offset, where_list, usr, many, favored):
+def make_recipe_select(usr, favored):
     ''' selects related source and category for recipe '''
-    ''' gets number of value=True votes to likes field '''
+    ''' likes field is the recipe.likes counter kept by vote_recipe '''
     ''' gets liked=True if user liked for recipe '''
+    columns = recipe_list_columns + [source, category, recipe.c.likes.label('likes')]
+    if usr:
+        liked = sa.exists().where(sa.and_(
+            vote.c.recipe_id == recipe.c.id,
+            vote.c.value == True,
+            vote.c.user_id == sa.bindparam('user_id', usr['id'])))
+        columns.append(liked.label('liked'))
+
+    query = sa.select(columns, use_labels=True).\
+        select_from(
+            recipe.join(source, source.c.id == recipe.c.source_id)
+            .join(category, category.c.id == recipe.c.category_id)
+        )
 
     # we fetch only liked recipes if favored is true otherwise full list
-    fetch_all_recipes = False if favored else True
+    if favored:
+        query = query.where(liked)
+    return query
+
+
+def recipe_list_shape(where_list, usr, many, favored, cursor=None):
+    ''' everything make_recipe_list_query sql depends on, besides bind parameter values '''
+    direction = None
+    if many and cursor:
+        direction = 'reverse' if cursor['reverse'] else 'forward'
+    return where_shape(where_list), bool(usr), many, favored, direction
 
+
+def recipe_list_params(limit, offset, where_list, usr, cursor=None):
+    params = bind_values(where_list)
+    params.update({'limit': int(limit), 'offset': int(offset)})
     if usr:
-        alias1 = vote.alias('alias1')
-        alias2 = vote.alias('alias2')
-        query = sa.select([recipe, source, category, alias2.c.value.label('liked'), sa.func.count(alias1.c.recipe_id).label('likes')], use_labels=True).\
-            select_from(
-                recipe.join(source, source.c.id == recipe.c.source_id)
-                .join(category, category.c.id == recipe.c.category_id)
-                .join(
-                    alias1,
-                    sa.and_(alias1.c.recipe_id == recipe.c.id, alias1.c.value == True),
-                    isouter=fetch_all_recipes)
-                .join(
-                    alias2,
-                    sa.and_(alias2.c.recipe_id == recipe.c.id, alias2.c.value == True, alias2.c.user_id == usr['id']),
-                    isouter=fetch_all_recipes)
-            ).group_by(recipe.c.id, source.c.id, category.c.id, alias2.c.value)
-    else:
-        query = sa.select([recipe, source, category, sa.func.count(vote.c.recipe_id).label('likes')], use_labels=True).\
-            select_from(
-                recipe.join(source, source.c.id == recipe.c.source_id)
-                .join(category, category.c.id == recipe.c.category_id)
-                .join(vote, sa.and_(vote.c.recipe_id == recipe.c.id, vote.c.value == True), isouter=True)
-            ).group_by(recipe.c.id, source.c.id, category.c.id)
+        params['user_id'] = usr['id']
+    if cursor:
+        params.update({'cursor_pub_date': cursor['pub_date'], 'cursor_id': cursor['id']})
+    return params
+
+
+def make_recipe_list_query(limit, offset, where_list, usr, many, favored, cursor=None):
+    ''' pages by offset or by (pub_date, id) seek key if cursor is passed '''
+    query = make_recipe_select(usr, favored)
 
     for where in where_list:
         query = query.where(where)
 
     if not many:
-        cursor = await conn.execute(query)
-        recipe_record = await cursor.fetchone()
+        return query
+
+    # newest first, id makes the order stable for recipes w same pub_date
+    reverse = cursor['reverse'] if cursor else False
+    if cursor:
+        seek_key = sa.tuple_(recipe_seek_date, recipe.c.id)
+        # placeholder is applied in sql, asyncpg would send date.min as -infinity
+        cursor_pub_date = sa.bindparam('cursor_pub_date', cursor['pub_date'], type_=sa.Date)
+        cursor_key = sa.tuple_(sa.func.coalesce(cursor_pub_date, sa.text("'0001-01-01'::date")),
+                               sa.bindparam('cursor_id', cursor['id'], type_=sa.Integer))
+        if reverse:
+            query = query.where(seek_key > cursor_key)
+        else:
+            query = query.where(seek_key < cursor_key)
+    limit = sa.bindparam('limit', int(limit), type_=sa.Integer)
+    if reverse:
+        query = query.order_by(recipe_seek_date.asc(), recipe.c.id.asc()).limit(limit)
+    else:
+        query = query.order_by(recipe_seek_date.desc(), recipe.c.id.desc()).limit(limit)
+    if not cursor:
+        query = query.offset(sa.bindparam('offset', int(offset), type_=sa.Integer))
+    return query
+
+
+async def get_pure_recipe_list(conn, limit, offset, where_list, usr, many, favored, cursor=None):
+    records_cursor = await execute_cached(
+        conn, ('recipe_list',) + recipe_list_shape(where_list, usr, many, favored, cursor),
+        lambda: make_recipe_list_query(limit, offset, where_list, usr, many, favored, cursor),
+        recipe_list_params(limit, offset, where_list, usr, cursor))
+
+    if not many:
+        recipe_record = await records_cursor.fetchone()
         if not recipe_record:
             raise RecordNotFound('No recipe with such id')
         rec = dict(recipe_record)
         return [rec]
 
-    query = query.limit(limit).offset(offset)
-
-    cursor = await conn.execute(query)
-    recipe_records = await cursor.fetchall()
+    recipe_records = await records_cursor.fetchall()
     recipes = [dict(q) for q in recipe_records]
+    if cursor and cursor['reverse']:
+        recipes.reverse()
     return recipes
 
 
-async def get_recipe_list_count(conn, where_list, favored=False, usr=None):
+def make_recipe_search_condition(q, fuzzy=False):
+    ''' full-text match or trigram word similarity for typos, w rank to order by '''
+    if fuzzy:
+        # %% is psycopg2 escape for pg_trgm <% operator
+        return sa.literal(q).op('<%%')(recipe.c.title), sa.func.word_similarity(q, recipe.c.title)
+    ts_query = sa.func.websearch_to_tsquery('russian', q)
+    return recipe.c.search_vector.op('@@')(ts_query), sa.func.ts_rank(recipe.c.search_vector, ts_query)
+
+
+async def search_recipes(dbengine, q, pagination=None, filters=None, usr=None):
+    ''' recipes ranked by full-text match, trigram title match if there are no full-text matches '''
+    if pagination:
+        limit = pagination['limit'] if 'limit' in pagination else 20
+        offset = pagination['offset'] if 'offset' in pagination else 0
+    else:
+        limit, offset = 20, 0
+    where_list = make_where_list_recipes(filters)
+
+    async with dbengine.acquire() as conn:
+        for fuzzy in (False, True):
+            match, rank = make_recipe_search_condition(q, fuzzy)
+            count_query = sa.select([sa.func.count()]).select_from(recipe).where(match)
+            for where in where_list:
+                count_query = count_query.where(where)
+            cursor = await conn.execute(count_query)
+            count = (await cursor.fetchone())[0]
+            if count:
+                break
+
+        if not count:
+            return [], 0
+
+        query = make_recipe_select(usr, False).column(rank.label('rank')).where(match)
+        for where in where_list:
+            query = query.where(where)
+        query = query.order_by(rank.desc(), recipe.c.id.desc()).limit(limit).offset(offset)
+        cursor = await conn.execute(query)
+        recipes = [dict(record) for record in await cursor.fetchall()]
+        recipes = await fetch_ingredients_for_recipes(conn, recipes)
+        recipes = await fetch_comments_for_recipes(conn, recipes)
+        return recipes, count
+
+
+def make_recipe_export_query(where_list, since_id=None, since_date=None):
+    query = make_recipe_select(None, False)
+    for where in where_list:
+        query = query.where(where)
+    if since_id is not None:
+        query = query.where(recipe.c.id > sa.bindparam('since_id', type_=sa.Integer))
+    if since_date is not None:
+        query = query.where(recipe.c.pub_date >= sa.bindparam('since_date', type_=sa.Date))
+    return query.order_by(recipe.c.id)
+
+
+async def export_recipes(dbengine, filters=None, since_id=None, since_date=None, chunk_size=500):
+    ''' yields lists of recipes w ingredients, id order, since_id and since_date are for incremental pulls '''
+    ''' rows come from server-side cursor chunk by chunk, so memory doesn't depend on catalog size '''
+    where_list = make_where_list_recipes(filters)
+    params = dict(bind_values(where_list), since_id=since_id, since_date=since_date)
+    compiled = statements.get(
+        ('recipe_export', where_shape(where_list), since_id is not None, since_date is not None),
+        lambda: make_recipe_export_query(where_list, since_id, since_date))
+
+    async with dbengine.acquire() as conn:
+        # cursor lives until the end of transaction, DECLARE works the same way for every backend
+        async with conn.begin():
+            await conn.execute(f'DECLARE recipe_export NO SCROLL CURSOR FOR {compiled.string}',
+                               compiled.construct_params(params))
+            while True:
+                cursor = await conn.execute(f'FETCH FORWARD {int(chunk_size)} FROM recipe_export')
+                recipes = [dict(record) for record in await cursor.fetchall()]
+                if not recipes:
+                    break
+                yield await fetch_ingredients_for_recipes(conn, recipes)
+
+
+async def get_assembled_recipe_list(conn, limit, offset, where_list, usr, many, favored, cursor=None,
+                                    with_count=True):
+    ''' same as get_pure_recipe_list + fetch_*_for_recipes + count, but in one round trip '''
+    ''' ingredients and comments are aggregated to json arrays by correlated subqueries '''
+    records_cursor = await execute_cached(
+        conn, ('recipe_assembled', with_count) + recipe_list_shape(where_list, usr, many, favored, cursor),
+        lambda: make_assembled_recipe_list_query(limit, offset, where_list, usr, many, favored, cursor, with_count),
+        recipe_list_params(limit, offset, where_list, usr, cursor))
+    recipe_records = await records_cursor.fetchall()
+    recipes = [dict(q) for q in recipe_records]
+    if not many and not recipes:
+        raise RecordNotFound('No recipe with such id')
+
+    # empty page has no rows to carry the count, get_recipe_list fetches it separately then
+    count = recipes[0]['total_count'] if many and with_count and recipes else None
+    for _recipe in recipes:
+        _recipe.pop('total_count', None)
+    if cursor and cursor['reverse']:
+        recipes.reverse()
+    return recipes, count
+
+
+def make_assembled_recipe_list_query(limit, offset, where_list, usr, many, favored, cursor=None, with_count=True):
+    page = make_recipe_list_query(limit, offset, where_list, usr, many, favored, cursor).alias('page')
+    # json keys are sql literals, asyncpg can't infer type of a parameter passed to json_build_object
+
+    ingredients = sa.select([
+        sa.func.coalesce(
+            sa.func.json_agg(sa.func.json_build_object(
+                sa.literal_column("'recipe_id'"), ingredient_item.c.recipe_id,
+                sa.literal_column("'qty'"), ingredient_item.c.qty,
+                sa.literal_column("'name'"), ingredient.c.name)),
+            sa.text("'[]'::json"))]).\
+        select_from(
+            ingredient_item.join(ingredient, ingredient.c.id == ingredient_item.c.ingredient_id)
+        ).where(ingredient_item.c.recipe_id == page.c.recipe_id).as_scalar()
+
+    comments = sa.select([
+        sa.func.coalesce(
+            sa.func.json_agg(sa.func.json_build_object(
+                sa.literal_column("'recipe_id'"), comment.c.recipe_id,
+                sa.literal_column("'body'"), comment.c.body,
+                sa.literal_column("'pub_date'"), comment.c.pub_date,
+                sa.literal_column("'username'"), users.c.username)),
+            sa.text("'[]'::json"))]).\
+        select_from(
+            comment.join(users, users.c.id == comment.c.user_id)
+        ).where(comment.c.recipe_id == page.c.recipe_id).as_scalar()
+
+    columns = [page, ingredients.label('ingredients'), comments.label('comments')]
+    if many and with_count:
+        columns.append(make_recipe_count_query(where_list, favored, usr).as_scalar().label('total_count'))
+    query = sa.select(columns)
+    if many:
+        # subquery order is not guaranteed to survive the outer select
+        page_seek_date = sa.func.coalesce(page.c.recipe_pub_date, sa.text("'0001-01-01'::date"))
+        if cursor and cursor['reverse']:
+            query = query.order_by(page_seek_date.asc(), page.c.recipe_id.asc())
+        else:
+            query = query.order_by(page_seek_date.desc(), page.c.recipe_id.desc())
+    return query
+
+
+def make_recipe_count_query(where_list, favored=False, usr=None):
     if favored:
         query = sa.select([sa.func.count()]).\
             select_from(
             recipe.join(vote, sa.and_(
                             vote.c.recipe_id == recipe.c.id,
                             vote.c.value == True,
-                            vote.c.user_id == usr['id'])))
+                            vote.c.user_id == sa.bindparam('user_id', usr['id']))))
     else:
         query = sa.select([sa.func.count()]).select_from(recipe)
     for where in where_list:
         query = query.where(where)
-    cursor = await conn.execute(query)
+    return query
+
+
+async def get_recipe_list_count(conn, where_list, favored=False, usr=None):
+    params = bind_values(where_list)
+    if favored:
+        params['user_id'] = usr['id']
+    cursor = await execute_cached(
+        conn, ('recipe_count', favored, where_shape(where_list)),
+        lambda: make_recipe_count_query(where_list, favored, usr), params)
     count_record = await cursor.fetchone()
     return count_record[0]
 
 
+async def get_recipe_list_count_estimate(conn, where_list):
+    ''' row count from planner statistics, exact count if table was never analyzed '''
+    if not where_list:
+        cursor = await conn.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = 'recipe'::regclass")
+        estimate = (await cursor.fetchone())[0]
+    else:
+        query = sa.select([recipe.c.id])
+        for where in where_list:
+            query = query.where(where)
+        compiled = query.compile(dialect=postgresql.dialect())
+        cursor = await conn.execute(f'EXPLAIN (FORMAT JSON) {compiled}', compiled.params)
+        plan = (await cursor.fetchone())[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        estimate = plan[0]['Plan']['Plan Rows']
+    if estimate < 0:
+        return await get_recipe_list_count(conn, where_list)
+    return int(estimate)
+
+
+def make_comment_insert_query():
+    ''' new comment in the shape of recipe comments list '''
+    inserted = (comment.insert()
+                .values(user_id=sa.bindparam('user_id'),
+                        recipe_id=sa.bindparam('recipe_id'),
+                        body=sa.bindparam('body'),
+                        pub_date=sa.bindparam('pub_date'))
+                .returning(comment.c.user_id, comment.c.recipe_id, comment.c.body, comment.c.pub_date)
+                .cte('inserted'))
+    return (sa.select([inserted.c.recipe_id, inserted.c.body, inserted.c.pub_date, users.c.username])
+            .select_from(inserted.join(users, users.c.id == inserted.c.user_id)))
+
+
 async def comment_recipe(dbengine, data, recipe_id, user):
+    recipe_id = validate_recipe_id(recipe_id)
     async with dbengine.acquire() as conn:
         await validate_recipe(conn, recipe_id)
         validate_comment(data)
-        cursor = await conn.execute(
-            comment.insert()
-                .values(user_id=user['id'],
-                        recipe_id=recipe_id,
-                        body=data['body'],
-                        pub_date=datetime.now().date())
-                .returning(comment.c.id))
+        cursor = await execute_cached(
+            conn, ('comment_insert',), make_comment_insert_query,
+            {'user_id': user['id'], 'recipe_id': recipe_id, 'body': data['body'], 'pub_date': datetime.now().date()})
         comment_record = await cursor.fetchone()
 
         if not comment_record:
             raise RecordNotFound('Error while creating new comment')
+        return dict(comment_record)
 
 
-async def vote_recipe(dbengine, recipe_id, user):
-    async with dbengine.acquire() as conn:
-        await validate_recipe(conn, recipe_id)
-        cursor = await conn.execute(
-            vote.select()
-                .where(vote.c.recipe_id == recipe_id)
-                .where(vote.c.user_id == user['id']))
-        vote_record = await cursor.fetchone()
-        # creates new vote record if there is first vote
-        if not vote_record:
-            cursor = await conn.execute(
-                vote.insert()
-                    .values(recipe_id=recipe_id,
-                            user_id=user['id'],
-                            value=True)
-                    .returning(vote.c.id))
-            vote_record = await cursor.fetchone()
-            cursor.close()
+def make_vote_query(mode):
+    ''' vote change and likes delta in one statement, no rows if vote already was as asked '''
+    if mode == 'unset':
+        changed = (vote.update()
+                   .where(vote.c.user_id == sa.bindparam('user_id'))
+                   .where(vote.c.recipe_id == sa.bindparam('recipe_id'))
+                   .where(vote.c.value)
+                   .values(value=False))
+    else:
+        # missing recipe fails on recipe_id foreign key
+        changed = postgresql.insert(vote).values(user_id=sa.bindparam('user_id'),
+                                                 recipe_id=sa.bindparam('recipe_id'),
+                                                 value=True)
+        conflict = [vote.c.user_id, vote.c.recipe_id]
+        if mode == 'toggle':
+            changed = changed.on_conflict_do_update(index_elements=conflict, set_={'value': sa.not_(vote.c.value)})
         else:
-            value = False if vote_record['value'] else True
-            cursor = await conn.execute(
-                vote.update()
-                    .where(vote.c.recipe_id == recipe_id)
-                    .where(vote.c.user_id == user['id'])
-                    .values(value=value)
-                    .returning(vote.c.id))
-            vote_record = await cursor.fetchone()
-            cursor.close()
-
-        if not vote_record:
-            raise RecordNotFound('Error while creating new vote')
+            changed = changed.on_conflict_do_update(index_elements=conflict, set_={'value': True},
+                                                    where=sa.not_(vote.c.value))
+    changed = changed.returning(vote.c.recipe_id, vote.c.value).cte('changed')
+    # conflicting upserts wait on the vote row, likes += delta is exact under concurrency
+    return (recipe.update()
+            .where(recipe.c.id == changed.c.recipe_id)
+            .values(likes=recipe.c.likes + sa.case([(changed.c.value, sa.literal_column('1'))],
+                                                   else_=sa.literal_column('-1')))
+            .returning(changed.c.value, recipe.c.likes))
+
+
+async def vote_recipe(dbengine, recipe_id, user, mode='toggle'):
+    ''' toggles, sets or unsets user vote, returns new likes count or None if nothing changed '''
+    recipe_id = validate_recipe_id(recipe_id)
+    async with dbengine.acquire() as conn:
+        try:
+            cursor = await execute_cached(conn, ('vote', mode), lambda: make_vote_query(mode),
+                                          {'recipe_id': recipe_id, 'user_id': user['id']})
+        except Exception as e:
+            if sqlstate(e) == FOREIGN_KEY_VIOLATION:
+                raise BadRequest('No recipe with such id')
+            raise
+        record = await cursor.fetchone()
+        if record is None and mode == 'unset':
+            # unset touches no foreign key, nothing changed might be a missing recipe
+            cursor = await execute_cached(conn, ('recipe_exists',), make_recipe_exists_query, {'recipe_id': recipe_id})
+            if not (await cursor.fetchone())[0]:
+                raise BadRequest('No recipe with such id')
+        return record['likes'] if record else None
+
+
+def make_recipe_exists_query():
+    return sa.select([sa.exists().where(recipe.c.id == sa.bindparam('recipe_id'))])
+
+
+def make_vote_state_query():
+    return (sa.select([recipe.c.likes, vote.c.value])
+            .select_from(recipe.outerjoin(vote, sa.and_(vote.c.recipe_id == recipe.c.id,
+                                                        vote.c.user_id == sa.bindparam('user_id'))))
+            .where(recipe.c.id == sa.bindparam('recipe_id')))
+
+
+async def get_vote_state(dbengine, recipe_id, user):
+    ''' stored vote value of user for recipe (False w/o vote) and likes, BadRequest for missing recipe '''
+    recipe_id = validate_recipe_id(recipe_id)
+    async with dbengine.acquire() as conn:
+        cursor = await execute_cached(conn, ('vote_state',), make_vote_state_query,
+                                      {'recipe_id': recipe_id, 'user_id': user['id']})
+        record = await cursor.fetchone()
+    if record is None:
+        raise BadRequest('No recipe with such id')
+    return bool(record[1]), record[0]
+
+
+def make_vote_flush_query():
+    ''' batch of final vote values, likes change by votes that actually changed, so replay is harmless '''
+    return sa.text('''
+        WITH batch AS (
+          SELECT b.user_id, b.recipe_id, b.value
+          FROM unnest(CAST(:user_ids AS integer[]), CAST(:recipe_ids AS integer[]), CAST(:vote_values AS boolean[]))
+            AS b (user_id, recipe_id, value)
+          -- recipes and users deleted since the vote are skipped instead of failing the batch
+          JOIN recipe ON recipe.id = b.recipe_id
+          JOIN users ON users.id = b.user_id
+        ),
+        set_votes AS (
+          INSERT INTO vote (user_id, recipe_id, value)
+          SELECT user_id, recipe_id, true FROM batch WHERE value
+          ON CONFLICT (user_id, recipe_id) DO UPDATE SET value = true WHERE vote.value IS NOT TRUE
+          RETURNING recipe_id, 1 AS delta
+        ),
+        unset_votes AS (
+          UPDATE vote SET value = false
+          FROM batch
+          WHERE vote.user_id = batch.user_id AND vote.recipe_id = batch.recipe_id AND NOT batch.value AND vote.value
+          RETURNING vote.recipe_id, -1 AS delta
+        )
+        UPDATE recipe SET likes = recipe.likes + deltas.delta
+        FROM (
+          SELECT recipe_id, sum(delta) AS delta
+          FROM (SELECT * FROM set_votes UNION ALL SELECT * FROM unset_votes) changed
+          GROUP BY recipe_id
+        ) deltas
+        WHERE recipe.id = deltas.recipe_id
+        ''')
+
+
+async def flush_votes(dbengine, votes, batch_size):
+    ''' votes are (user_id, recipe_id, value), one statement per batch_size of them '''
+    async with dbengine.acquire() as conn:
+        for start in range(0, len(votes), batch_size):
+            batch = votes[start:start + batch_size]
+            await execute_cached(conn, ('vote_flush',), make_vote_flush_query, {
+                'user_ids': [user_id for user_id, _, _ in batch],
+                'recipe_ids': [recipe_id for _, recipe_id, _ in batch],
+                'vote_values': [value for _, _, value in batch],
+            })
 
 
-async def login(dbengine, data, jwt_config):
+async def login(dbengine, data, jwt_config, hasher, primary=None):
+    ''' user is looked up on dbengine, on primary if it is not there, registration may not be replicated yet '''
     async with dbengine.acquire() as conn:
-        user = await validate_login(conn, data)
-        JWT_SECRET = jwt_config['secret']
-        JWT_ALGORITHM = jwt_config['algo']
-        JWT_EXP_DELTA_SECONDS = jwt_config['exp']
-        payload = {
-            'user_id': user['id'],
-            'exp': datetime.utcnow() + timedelta(seconds=JWT_EXP_DELTA_SECONDS)
-        }
-        jwt_token = jwt.encode(payload, JWT_SECRET, JWT_ALGORITHM)
-        return jwt_token
-
-
-async def register(dbengine, data):
+        user_record = await validate_login(conn, data)
+    if user_record is None and primary is not None and primary is not dbengine:
+        async with primary.acquire() as conn:
+            user_record = await validate_login(conn, data)
+    user = await check_credentials(hasher, user_record, data['password'])
+    JWT_SECRET = jwt_config['secret']
+    JWT_ALGORITHM = jwt_config['algo']
+    JWT_EXP_DELTA_SECONDS = jwt_config['exp']
+    payload = {
+        'user_id': user['id'],
+        'exp': datetime.utcnow() + timedelta(seconds=JWT_EXP_DELTA_SECONDS)
+    }
+    jwt_token = jwt.encode(payload, JWT_SECRET, JWT_ALGORITHM)
+    return jwt_token
+
+
+async def register(dbengine, data, hasher):
     async with dbengine.acquire() as conn:
         await validate_register(conn, data)
-        password_hash = sha256_crypt.hash(data['password'])
+    # connection goes back to pool while password is hashed
+    password_hash = await hasher.hash(data['password'])
+    async with dbengine.acquire() as conn:
         query = users.insert().values(username=data['username'], passwd=password_hash, email=data['email']).returning(users.c.id)
         cursor = await conn.execute(query)
         user_record = await cursor.fetchone()
@@ -272,15 +713,28 @@ async def set_userpic(dbengine, filename, user):
         return dict(user_record)
 
 
-async def user_by_id(dbengine, user_id):
-    raw = f'''
-        select u.id, u.username, u.email, u.superuser, u.userpic 
-        from users u
-        where u.id = {user_id}
-        '''
+def make_recipe_id_by_slug_query():
+    return sa.select([recipe.c.id]).where(recipe.c.slug == sa.bindparam('slug'))
+
+
+async def get_recipe_id(dbengine, recipe_id_or_slug):
+    ''' recipe id for id or slug from url, None if there is no recipe w such slug '''
+    if recipe_id_or_slug.isdigit():
+        return int(recipe_id_or_slug)
+    async with dbengine.acquire() as conn:
+        cursor = await execute_cached(conn, ('recipe_id_by_slug',), make_recipe_id_by_slug_query,
+                                      {'slug': recipe_id_or_slug})
+        record = await cursor.fetchone()
+    return record[0] if record else None
+
 
+async def user_by_id(dbengine, user_id):
     async with dbengine.acquire() as conn:
-        cursor = await conn.execute(raw)
+        cursor = await execute_cached(
+            conn, ('user_by_id',),
+            lambda: sa.select([users.c.id, users.c.username, users.c.email, users.c.superuser, users.c.userpic])
+                .where(users.c.id == sa.bindparam('user_id')),
+            {'user_id': user_id})
         user_record = await cursor.fetchone()
         if not user_record:
             raise RecordNotFound('Error while retrieve user record')
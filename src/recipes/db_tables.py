@@ -1,11 +1,17 @@
 from sqlalchemy import (
-    MetaData, Table, Column, ForeignKey,
-    Integer, String, Date, Text, Interval, Boolean
+    MetaData, Table, Column, ForeignKey, Index, Computed,
+    Integer, String, Date, Text, Interval, Boolean,
+    func, text
 )
+from sqlalchemy.dialects.postgresql import TSVECTOR
 
 
 meta = MetaData()
 
+# full-text search document of recipe, title ranks higher than description
+RECIPE_SEARCH_VECTOR = ("setweight(to_tsvector('russian', coalesce(title, '')), 'A') || "
+                        "setweight(to_tsvector('russian', coalesce(descr, '')), 'B')")
+
 
 users = Table(
     'users', meta,
@@ -71,9 +77,24 @@ recipe = Table(
            ForeignKey('source.id', ondelete='CASCADE')),
     Column('category_id',
            Integer,
-           ForeignKey('category.id', ondelete='CASCADE'))
+           ForeignKey('category.id', ondelete='CASCADE')),
+    # number of value=True votes, kept by vote_recipe
+    Column('likes', Integer, nullable=False, server_default='0'),
+    Column('search_vector', TSVECTOR, Computed(RECIPE_SEARCH_VECTOR, persisted=True))
 )
 
+# full-text index and trigram index for typo-tolerant title search (needs pg_trgm)
+Index('recipe_search_idx', recipe.c.search_vector, postgresql_using='gin')
+Index('recipe_title_trgm_idx', recipe.c.title,
+      postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'})
+
+# recipe columns for api responses, likes goes as separate 'likes' field
+recipe_list_columns = [column for column in recipe.c if column.name not in ('likes', 'search_vector')]
+
+# seek key for keyset (cursor) pagination, recipes w/o pub_date go last
+recipe_seek_date = func.coalesce(recipe.c.pub_date, text("'0001-01-01'::date"))
+Index('recipe_seek_idx', recipe_seek_date, recipe.c.id)
+
 comment = Table(
     'comment', meta,
 
@@ -101,4 +122,7 @@ vote = Table(
            ForeignKey('recipe.id', ondelete='CASCADE')),
     Column('value',
            Boolean)
-)
\ No newline at end of file
+)
+
+# one vote per user and recipe, vote upsert conflicts on it
+Index('vote_user_recipe_key', vote.c.user_id, vote.c.recipe_id, unique=True)
@@ -0,0 +1,64 @@
+''' keeps caches in line w recipe changes, called after the change is committed '''
+from .cache import invalidate_counts, invalidate_tags, recipe_version, COLLECTION_VERSION
+from .db import pin_to_primary, mark_written
+from .broadcast import evict, publish_recipe_event, likes_event, comment_event
+
+
+async def evict_recipe(app, recipe_id):
+    ''' detail cache of every worker, redis pub/sub carries it to the others '''
+    await evict(app, f'recipe:{int(recipe_id)}')
+
+
+async def bump_versions(app, recipe_id, slug=None):
+    versions = app.get('versions')
+    if versions is not None:
+        versions.add_slug(slug, recipe_id)
+        await versions.bump([COLLECTION_VERSION, recipe_version(recipe_id)], app.get('redis'))
+
+
+async def recipe_saved(app, recipe_id, category_id, title=None, slug=None):
+    await mark_written(app, recipe_id, category_id)
+    await evict_recipe(app, recipe_id)
+    await bump_versions(app, recipe_id, slug)
+    index = app.get('ingredient_index')
+    if index is not None:
+        index.add_recipe(recipe_id, title, slug)
+    redis = app.get('redis')
+    if redis is not None:
+        await invalidate_counts(redis)
+        await invalidate_tags(redis, ['list', f'category:{category_id}'])
+
+
+async def recipe_voted(app, recipe_id, user, likes=None):
+    await pin_to_primary(app, user['id'])
+    await mark_written(app, recipe_id)
+    await evict_recipe(app, recipe_id)
+    await bump_versions(app, recipe_id)
+    redis = app.get('redis')
+    if redis is not None:
+        await invalidate_tags(redis, [f'recipe:{recipe_id}'])
+    if likes is not None:
+        await publish_recipe_event(app, int(recipe_id), likes_event(int(recipe_id), likes))
+
+
+async def recipe_commented(app, recipe_id, user, comment=None):
+    await pin_to_primary(app, user['id'])
+    await mark_written(app, recipe_id)
+    await evict_recipe(app, recipe_id)
+    await bump_versions(app, recipe_id)
+    redis = app.get('redis')
+    if redis is not None:
+        await invalidate_tags(redis, [f'recipe:{recipe_id}'])
+    if comment is not None:
+        await publish_recipe_event(app, int(recipe_id), comment_event(int(recipe_id), comment))
+
+
+def ingredient_item_saved(app, recipe_id, ingredient_id, ingredient_name):
+    index = app.get('ingredient_index')
+    if index is not None:
+        index.add(recipe_id, ingredient_id, ingredient_name)
+
+
+async def user_updated(app, user_id):
+    await pin_to_primary(app, user_id)
+    await evict(app, f'user:{user_id}')
@@ -10,5 +10,9 @@ class BadRequest(AppException):
     """ Bad request """
 
 
+class TooManyRequests(AppException):
+    """ Request rejected to protect the server from overload """
+
+
 class BadRequest_Important(Exception):
     """ Bad request supposed to log """
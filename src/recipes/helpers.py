@@ -1,22 +1,39 @@
 from datetime import datetime, timedelta
 import os
+import json
+import base64
 import logging
 import asyncio
 import imghdr
 
 import aioredis
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ARRAY
 from aiologstash import create_tcp_handler
 
 from .db_tables import recipe
-from .exceptions import BadRequest_Important
+from .exceptions import BadRequest, BadRequest_Important
 
 
 async def shutdown_ws(app):
-    for ws in app['websockets'].values():
-        await ws.close()
+    # closing handshake waits for each client, they are closed at once
+    clients = [client for room in app['websockets'].values() for client in room.values()]
+    await asyncio.gather(*[client.close() for client in clients], return_exceptions=True)
     app['websockets'].clear()
 
 
+def parse_since(since):
+    ''' since=<recipe id> or since=<dd-mm-yyyy pub_date>, returns (since_id, since_date) '''
+    if not since:
+        return None, None
+    if since.isdigit():
+        return int(since), None
+    try:
+        return None, datetime.strptime(since, '%d-%m-%Y').date()
+    except ValueError:
+        raise BadRequest('Invalid since, expected recipe id or dd-mm-yyyy date')
+
+
 def prepare_filter_parameters(query):
     # validating and combining filters w pagination
     filters = {}
@@ -49,10 +66,38 @@ def prepare_filter_parameters(query):
     if offset:
         assert int(offset) > 0
         pagination.update({'offset': offset})
+    count = query.get('count')
+    if count:
+        assert count in ('exact', 'estimate')
+        pagination.update({'count': count})
+    if 'cursor' in query:
+        # keyset pagination, empty cursor means the first page
+        cursor = query.get('cursor')
+        pagination.update({'cursor': decode_cursor(cursor) if cursor else None})
     return pagination, filters
 
 
-def prepare_recipes_response(recipes, count, rel_url):
+def encode_cursor(recipe, reverse=False):
+    ''' opaque cursor from (pub_date, id) seek key of the recipe '''
+    pub_date = recipe['recipe_pub_date']
+    key = [pub_date.isoformat() if pub_date else None, recipe['recipe_id'], reverse]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        pub_date, recipe_id, reverse = json.loads(raw.decode())
+        # None for recipes w/o pub_date, query puts recipe_seek_date placeholder in its place
+        pub_date = datetime.strptime(pub_date, '%Y-%m-%d').date() if pub_date else None
+        return {'pub_date': pub_date, 'id': int(recipe_id), 'reverse': bool(reverse)}
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise BadRequest('Invalid cursor')
+
+
+def prepare_recipes_response(recipes, count, rel_url, pagination=None):
+    if pagination and 'cursor' in pagination:
+        return prepare_cursor_response(recipes, count, rel_url, pagination)
     # creates DRF-like paginated response
     if not len(rel_url.query_string):
         next_request = str(rel_url) + '?offset=20'
@@ -66,7 +111,28 @@ def prepare_recipes_response(recipes, count, rel_url):
     return {'count': count, 'next': next_request, 'results': recipes}
 
 
+def prepare_cursor_response(recipes, count, rel_url, pagination):
+    # next/prev links carry cursors of the last/first recipe on the page
+    cursor = pagination['cursor']
+    limit = int(pagination.get('limit', 20))
+    reverse = cursor['reverse'] if cursor else False
+    full_page = len(recipes) == limit
+
+    next_request, prev_request = None, None
+    if recipes:
+        if full_page or reverse:
+            next_request = str(rel_url.update_query(cursor=encode_cursor(recipes[-1])))
+        if cursor and (full_page or not reverse):
+            prev_request = str(rel_url.update_query(cursor=encode_cursor(recipes[0], reverse=True)))
+    elif reverse:
+        # nothing before the requested recipe, forward from it is the first page
+        next_request = str(rel_url.update_query(cursor=''))
+
+    return {'count': count, 'next': next_request, 'prev': prev_request, 'results': recipes}
+
+
 def make_where_list_recipes(filters, many=True):
+    ''' values go to named bind parameters, so sql of the list depends only on which filters are set '''
     where_list = []
 
     if not filters:
@@ -74,28 +140,30 @@ def make_where_list_recipes(filters, many=True):
     elif not many:
         # detail view w id or slug
         if filters.isdigit():  # recipe_id
-            where_list.append(recipe.c.id == filters)  # we pass recipe_id through
+            where_list.append(recipe.c.id == sa.bindparam('recipe_id', int(filters)))
         else:
-            where_list.append(recipe.c.slug == filters)
+            where_list.append(recipe.c.slug == sa.bindparam('slug', filters))
         return where_list
     else:
         category = filters.get('category')
         if category:
-            where_list.append(recipe.c.category_id.in_([int(cat) for cat in category.split(',')]))
+            category_ids = [int(cat) for cat in category.split(',')]
+            where_list.append(recipe.c.category_id == sa.any_(
+                sa.bindparam('category_ids', category_ids, type_=ARRAY(sa.Integer))))
         prep_time = filters.get('prep_time')
         if prep_time:
             interval = timedelta(minutes=int(prep_time))
-            where_list.append(recipe.c.prep_time <= interval)
+            where_list.append(recipe.c.prep_time <= sa.bindparam('prep_time', interval))
         date = filters.get('date')
         if date:
             _from = date.get('from')
             if _from:
                 from_date = datetime.strptime(_from, '%d-%m-%Y')
-                where_list.append(recipe.c.pub_date >= from_date)
+                where_list.append(recipe.c.pub_date >= sa.bindparam('date_from', from_date))
             to = date.get('to')
             if to:
                 to_date = datetime.strptime(to, '%d-%m-%Y')
-                where_list.append(recipe.c.pub_date <= to_date)
+                where_list.append(recipe.c.pub_date <= sa.bindparam('date_to', to_date))
         return where_list
 
 
@@ -137,8 +205,8 @@ def log_string(app, string, extra=None):
 async def init_redis(app):
     conf = app['config']['redis']
     pool = await aioredis.create_redis_pool(address=f'redis://{conf["server"]}:{conf["port"]}',
-                                            minsize=10,
-                                            maxsize=20,
+                                            minsize=conf['minsize'],
+                                            maxsize=conf['maxsize'],
                                             timeout=10)
     app['redis'] = pool
     yield
@@ -146,9 +214,9 @@ async def init_redis(app):
     await pool.wait_closed()
 
 
-async def run_sync(blocking_io, *args):
+async def run_sync(blocking_io, *args, executor=None):
     loop = asyncio._get_running_loop()
-    return await loop.run_in_executor(None, blocking_io, *args)
+    return await loop.run_in_executor(executor, blocking_io, *args)
 
 
 def generate_userpic_filename(user, filename, path):
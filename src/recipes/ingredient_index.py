@@ -0,0 +1,190 @@
+''' in-memory inverted index ingredient -> recipes for "cook with what I have" queries '''
+import asyncio
+
+import numpy as np
+import sqlalchemy as sa
+
+from .db_tables import ingredient, ingredient_item, recipe
+from .helpers import log_exception
+
+
+EMPTY = np.empty(0, dtype=np.int64)
+
+
+class IngredientIndex:
+    ''' postings are sorted unique recipe id arrays, queries never touch the database '''
+
+    def __init__(self):
+        self.postings = {}  # ingredient id -> sorted recipe ids
+        self.names = {}  # lowercased ingredient name -> ingredient id
+        self.recipes = {}  # recipe id -> (title, slug)
+        self.totals = {}  # recipe id -> number of distinct ingredients
+        self._total_ids = EMPTY  # sorted recipe ids and totals aligned, rebuilt from totals when stale
+        self._total_counts = EMPTY
+        self._totals_stale = False
+        self._built = False
+        self.builds = 0
+        self._lock = asyncio.Lock()
+        # updates during a build may be missing from what it read, they are replayed on top of it
+        self._building = False
+        self._pending = []
+
+    async def ensure_built(self, dbengine):
+        if self._built:
+            return
+        async with self._lock:
+            if not self._built:
+                await self.build(dbengine)
+
+    async def rebuild(self, dbengine):
+        ''' queries use the previous index until the new one is ready '''
+        async with self._lock:
+            await self.build(dbengine)
+
+    async def build(self, dbengine):
+        self._building = True
+        try:
+            await self._build(dbengine)
+        finally:
+            self._building = False
+            pending, self._pending = self._pending, []
+        for method, args in pending:
+            method(*args)
+
+    async def _build(self, dbengine):
+        async with dbengine.acquire() as conn:
+            cursor = await conn.execute(sa.select([ingredient_item.c.ingredient_id, ingredient_item.c.recipe_id]))
+            pairs = [(record[0], record[1]) for record in await cursor.fetchall()]
+            pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+            cursor = await conn.execute(sa.select([ingredient.c.id, ingredient.c.name]))
+            names = {record['name'].strip().lower(): record['id'] for record in await cursor.fetchall()}
+            cursor = await conn.execute(sa.select([recipe.c.id, recipe.c.title, recipe.c.slug]))
+            recipes = {record['id']: (record['title'], record['slug']) for record in await cursor.fetchall()}
+
+        # sort by (ingredient, recipe) and drop repeated pairs, then cut into postings at ingredient borders
+        pairs = np.unique(pairs, axis=0)
+        borders = np.flatnonzero(np.diff(pairs[:, 0])) + 1
+        postings = {}
+        for chunk in np.split(pairs, borders):
+            if len(chunk):
+                postings[int(chunk[0, 0])] = chunk[:, 1].copy()
+        total_ids, total_counts = np.unique(pairs[:, 1], return_counts=True)
+
+        self.postings = postings
+        self.names = names
+        self.recipes = recipes
+        self.totals = dict(zip(total_ids.tolist(), total_counts.tolist()))
+        self._total_ids, self._total_counts = total_ids, total_counts
+        self._totals_stale = False
+        self._built = True
+        self.builds += 1
+
+    def add_recipe(self, recipe_id, title, slug):
+        if self._building:
+            self._pending.append((self.add_recipe, (recipe_id, title, slug)))
+        self.recipes[recipe_id] = (title, slug)
+
+    def add(self, recipe_id, ingredient_id, name):
+        ''' incremental update for a new ingredient_item row, repeated ones are no-op '''
+        if self._building:
+            self._pending.append((self.add, (recipe_id, ingredient_id, name)))
+        self.names.setdefault(name.strip().lower(), ingredient_id)
+        posting = self.postings.get(ingredient_id, EMPTY)
+        position = np.searchsorted(posting, recipe_id)
+        if position < len(posting) and posting[position] == recipe_id:
+            return
+        self.postings[ingredient_id] = np.insert(posting, position, recipe_id)
+        self.totals[recipe_id] = self.totals.get(recipe_id, 0) + 1
+        self._totals_stale = True
+
+    def resolve(self, tokens):
+        ''' ingredient ids from ids or names, w tokens that match nothing '''
+        ingredient_ids, unknown = set(), []
+        for token in tokens:
+            token = token.strip()
+            if token.isdigit() and int(token) in self.postings:
+                ingredient_ids.add(int(token))
+            elif token.lower() in self.names:
+                ingredient_ids.add(self.names[token.lower()])
+            elif token:
+                unknown.append(token)
+        return sorted(ingredient_ids), unknown
+
+    def _recipe_totals(self, recipe_ids):
+        if self._totals_stale:
+            self._total_ids = np.array(sorted(self.totals), dtype=np.int64)
+            self._total_counts = np.array([self.totals[recipe_id] for recipe_id in self._total_ids.tolist()],
+                                          dtype=np.int64)
+            self._totals_stale = False
+        return self._total_counts[np.searchsorted(self._total_ids, recipe_ids)]
+
+    def query(self, ingredient_ids, limit=20, offset=0):
+        ''' recipes w any of ingredients, best coverage of recipe ingredients first '''
+        postings = [self.postings[ingredient_id] for ingredient_id in ingredient_ids if ingredient_id in self.postings]
+        if not postings:
+            return 0, []
+        # each posting has a recipe at most once, so occurrences = matched ingredients
+        recipe_ids, matched = np.unique(np.concatenate(postings), return_counts=True)
+        totals = self._recipe_totals(recipe_ids)
+        coverage = matched / totals
+        # coverage desc, then matched desc, then newer recipe (bigger id) first
+        order = np.lexsort((-recipe_ids, -matched, -coverage))[offset:offset + limit]
+
+        results = []
+        for recipe_id, recipe_matched, recipe_total, recipe_coverage in zip(
+                recipe_ids[order].tolist(), matched[order].tolist(), totals[order].tolist(), coverage[order].tolist()):
+            title, slug = self.recipes.get(recipe_id, (None, None))
+            results.append({
+                'recipe_id': recipe_id,
+                'recipe_title': title,
+                'recipe_slug': slug,
+                'matched': recipe_matched,
+                'total': recipe_total,
+                'missing': recipe_total - recipe_matched,
+                'coverage': recipe_coverage,
+            })
+        return len(recipe_ids), results
+
+    def stats(self):
+        return {
+            'built': self._built,
+            'builds': self.builds,
+            'ingredients': len(self.postings),
+            'recipes': len(self.totals),
+            'memory': sum(posting.nbytes for posting in self.postings.values()),
+        }
+
+
+async def build_index(app, index):
+    ''' failed build is logged, first query tries again; then rebuilt every rebuild_interval if set '''
+    try:
+        await index.ensure_built(app['db_read'])
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        log_exception(app, e)
+    interval = app['config']['ingredient_index']['rebuild_interval']
+    while interval:
+        await asyncio.sleep(interval)
+        try:
+            await index.rebuild(app['db_read'])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log_exception(app, e)
+
+
+async def init_ingredient_index(app):
+    index = app['ingredient_index'] = IngredientIndex()
+    app['metrics']['ingredient_index'] = index.stats
+    # tables may be empty or missing at startup in tests, first query builds the index then
+    if app['testing']:
+        yield
+        return
+    task = app['ingredient_index_build'] = asyncio.ensure_future(build_index(app, index))
+    yield
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
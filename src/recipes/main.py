@@ -5,21 +5,32 @@ import aiohttp_jinja2
 import jinja2
 from aiohttp import web
 
-from .db import close_pg, init_pg
-from .middlewares import setup_middlewares
+from .db import close_pg, init_pg, pool_stats
+from .middlewares import setup_middlewares, setup_user_cache
 from .routes import setup_routes, setup_cors
 from .settings import CONFIG, TEST_CONFIG
 from .admin import setup_admin
 from .helpers import shutdown_ws, init_logstash, init_redis
-
-
-async def init_app(testing=False):
+from .cache import setup_response_cache, setup_recipe_cache, setup_versions
+from .statements import setup_statement_cache
+from .passwords import init_hasher
+from .compression import init_compression
+from .vote_buffer import init_vote_buffer
+from .broadcast import setup_broadcast, init_broadcast
+from .workers import run_workers
+from .ingredient_index import init_ingredient_index
+from .api import setup_export
+from .utils import use_serializer
+
+
+async def init_app(testing=False, config=None):
     app = web.Application()
 
-    app['websockets'] = {}  # TODO do we actually need em?
+    app['metrics'] = {}  # name -> callable returning counters for /api/metrics
 
-    app['config'] = TEST_CONFIG if testing else CONFIG
+    app['config'] = config or (TEST_CONFIG if testing else CONFIG)
     app['testing'] = True if testing else False
+    use_serializer(app['config']['json_serializer'])
 
     # setup Jinja2 template renderer
     aiohttp_jinja2.setup(
@@ -28,14 +39,29 @@ async def init_app(testing=False):
     # create db connection on startup, shutdown on exit
     # app.on_startup.append(init_pg)
     pg = await init_pg(app)
-    setup_admin(app, pg)
-
+    if app['config']['postgres']['backend'] == 'aiopg':
+        # aiohttp_admin works w aiopg.sa engine only
+        setup_admin(app, pg)
+    app['metrics']['db_pools'] = lambda: pool_stats(app)
+
+    app.cleanup_ctx.append(init_hasher)
+    app.cleanup_ctx.append(init_compression)
+    app.cleanup_ctx.append(init_ingredient_index)
     app.on_cleanup.append(close_pg)
     app.on_cleanup.append(shutdown_ws)
 
     if not testing:
         app.cleanup_ctx.append(init_logstash)
         app.cleanup_ctx.append(init_redis)
+    app.cleanup_ctx.append(init_vote_buffer)
+    app.cleanup_ctx.append(init_broadcast)
+    setup_response_cache(app)
+    setup_recipe_cache(app)
+    setup_versions(app)
+    setup_broadcast(app)
+    setup_user_cache(app)
+    setup_statement_cache(app)
+    setup_export(app)
 
     # setup views and routes
     setup_routes(app)
@@ -50,10 +76,11 @@ async def init_app(testing=False):
 def main(argv):
     logging.basicConfig(level=logging.DEBUG)
 
-    app = init_app(argv)
-
     config = CONFIG
-    web.run_app(app,
+    if config['workers']['count'] != 1:
+        run_workers(init_app, config)
+        return
+    web.run_app(init_app(),
                 host=config['host'],
                 port=config['port'])
 
@@ -1,7 +1,10 @@
 import aiohttp_jinja2
 from aiohttp import web
 
-from .db import users
+from .db import user_by_id, read_engine
+from .cache import LRUCache
+from .compression import compression_middleware
+from .exceptions import RecordNotFound
 
 import jwt
 
@@ -51,19 +54,43 @@ async def auth_middleware(request, handler):
         except (jwt.DecodeError, jwt.ExpiredSignatureError):
             return web.json_response({'message': 'Token is invalid'}, status=web.HTTPUnauthorized.status_code)
 
-        async with request.app['db'].acquire() as conn:
-            query = users.select().where(users.c.id == payload['user_id'])
-            ret = await conn.execute(query)
-            user_record = await ret.fetchone()
-            request.user = user_record
+        # only id is known until handler asks for the record w load_user
+        request.user = {'id': payload['user_id']}
     return await handler(request)
 
 
+async def load_user(request):
+    ''' full record of request.user, shared cache by user id, None if the user is deleted '''
+    if not request.user:
+        return None
+    if 'user_record' in request:  # loaded once per request
+        return request['user_record']
+    cache = request.app['user_cache']
+    user = cache.get(request.user['id'])
+    if user is None:
+        try:
+            user = await user_by_id(await read_engine(request.app, request.user), request.user['id'])
+        except RecordNotFound:
+            user = None
+        else:
+            cache.set(user['id'], user)
+    request['user_record'] = user
+    return user
+
+
+def setup_user_cache(app):
+    conf = app['config']['user_cache']
+    cache = app['user_cache'] = LRUCache(maxsize=conf['maxsize'], ttl=conf['ttl'])
+    app['metrics']['user_cache'] = cache.stats
+
+
 def setup_middlewares(app):
     error_middleware = create_error_middleware({
         404: handle_404,
         500: handle_500
     })
+    # outermost, gets final responses and sets request['encoding'] for the response cache
+    app.middlewares.append(compression_middleware)
     app.middlewares.append(error_middleware)
     app.middlewares.append(auth_middleware)
 
@@ -72,5 +99,8 @@ def login_required(func):
     async def wrapper(request):
         if not request.user:
             return web.json_response({'message': 'Auth required'}, status=web.HTTPUnauthorized.status_code)
+        # valid token of a deleted user
+        if await load_user(request) is None:
+            return web.json_response({'message': 'User not found'}, status=web.HTTPUnauthorized.status_code)
         return await func(request)
     return wrapper
@@ -0,0 +1,56 @@
+''' password hashing in a process pool, so a burst of logins does not stall the event loop '''
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.hash import sha256_crypt
+
+from .exceptions import TooManyRequests
+from .helpers import run_sync
+
+
+class PasswordHasher:
+    ''' admission semaphore bounds queued hashing work, callers over the bound get TooManyRequests '''
+
+    def __init__(self, workers, max_pending, admission_timeout):
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.admission = asyncio.Semaphore(max_pending)
+        self.admission_timeout = admission_timeout
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+
+    async def hash(self, password):
+        return await self._run(sha256_crypt.hash, password)
+
+    async def verify(self, password, password_hash):
+        return await self._run(sha256_crypt.verify, password, password_hash)
+
+    async def _run(self, func, *args):
+        try:
+            await asyncio.wait_for(self.admission.acquire(), self.admission_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise TooManyRequests('Too many login attempts, try again later')
+        self.pending += 1
+        try:
+            return await run_sync(func, *args, executor=self.executor)
+        finally:
+            self.pending -= 1
+            self.admission.release()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def stats(self):
+        return {'pending': self.pending, 'max_pending': self.max_pending, 'rejected': self.rejected}
+
+
+async def init_hasher(app):
+    conf = app['config']['password_hashing']
+    hasher = PasswordHasher(workers=conf['workers'],
+                            max_pending=conf['max_pending'],
+                            admission_timeout=conf['admission_timeout'])
+    app['hasher'] = hasher
+    app['metrics']['password_hashing'] = hasher.stats
+    yield
+    hasher.close()
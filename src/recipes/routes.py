@@ -2,7 +2,7 @@ import pathlib
 
 from .views import collect_nonapi, recipes_nonapi, recipe_detail_nonapi
 from .api import register, login, recipes, favored, recipe_detail, vote_recipe, comment_recipe, collect, \
-    current_user, userpic_upload
+    current_user, userpic_upload, metrics, search, by_ingredients, export
 
 import aiohttp_cors
 
@@ -19,11 +19,18 @@ def setup_routes(app):
 
     app.router.add_route('GET', '/api/recipes', recipes)
     app.router.add_route('GET', '/api/recipes/favored', favored)
+    app.router.add_route('GET', '/api/recipes/search', search)
+    app.router.add_route('GET', '/api/recipes/by_ingredients', by_ingredients)
+    app.router.add_route('GET', '/api/recipes/export', export)
     app.router.add_route('GET', '/api/recipes/{recipe_id}', recipe_detail)
     app.router.add_route('POST', '/api/recipes/{recipe_id}/vote', vote_recipe)
+    app.router.add_route('PUT', '/api/recipes/{recipe_id}/vote', vote_recipe)
+    app.router.add_route('DELETE', '/api/recipes/{recipe_id}/vote', vote_recipe)
     app.router.add_route('POST', '/api/recipes/{recipe_id}/comment', comment_recipe)
     app.router.add_route('POST', '/api/recipes/collect', collect)
 
+    app.router.add_route('GET', '/api/metrics', metrics)
+
     # some basic views for collection and list of recipes view
     app.router.add_get('/collect', collect_nonapi, name='collect')
     app.router.add_get('/recipes', recipes_nonapi, name='recipes_nonapi')
@@ -0,0 +1,66 @@
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.elements import BindParameter
+
+
+class StatementCache:
+    ''' compiled sql by statement shape, request values are passed as bind parameters '''
+    ''' shape is whatever changes the sql text: filter names, user or not, favored, cursor direction '''
+
+    def __init__(self, dialect=None):
+        # aiopg.sa compiles w psycopg2 dialect, so pyformat params
+        self.dialect = dialect or postgresql.psycopg2.dialect()
+        self._compiled = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        ''' build is called on miss only and returns sqlalchemy statement '''
+        compiled = self._compiled.get(key)
+        if compiled is None:
+            self.misses += 1
+            compiled = self._compiled[key] = build().compile(dialect=self.dialect)
+        else:
+            self.hits += 1
+        return compiled
+
+    def clear(self):
+        self._compiled.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'statements': len(self._compiled),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+# shapes are bounded by the code, so cache is shared by the process and never evicted
+statements = StatementCache()
+
+
+def bind_values(clauses):
+    ''' values of named bind parameters in where clauses, by parameter name '''
+    values = {}
+    for clause in clauses:
+        for element in visitors.iterate(clause, {}):
+            if isinstance(element, BindParameter) and not element.unique:
+                values[element.key] = element.value
+    return values
+
+
+def where_shape(clauses):
+    ''' part of statement key for where list, names of its bind parameters '''
+    return tuple(bind_values(clauses))
+
+
+async def execute_cached(conn, key, build, params=None):
+    ''' same as conn.execute(build()) but compiles the statement once per key '''
+    compiled = statements.get(key, build)
+    return await conn.execute(compiled.string, compiled.construct_params(params or {}))
+
+
+def setup_statement_cache(app):
+    app['metrics']['statements'] = statements.stats
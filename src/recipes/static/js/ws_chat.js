@@ -37,6 +37,14 @@
              case 'sent':
                log(data.name + ': ' + data.text);
                break;
+             // recipe updates, page is kept current w/o refetching it
+             case 'likes':
+               $('#likes').text(data.likes);
+               break;
+             case 'comment':
+               $('<li>').text(' ' + data.comment.username + ' (' + data.comment.pub_date + '): ' +
+                              data.comment.body + ' ').appendTo('#comments');
+               break;
            }
          };
          conn.onclose = function() {
@@ -1,13 +1,66 @@
 import json
+from datetime import date, time, timedelta
 
+from aiohttp import web
 from faker import Faker
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# Faker instance takes ms to create, too slow for every websocket connect
+fake = Faker()
+
+
+def encode_default(thing):
+    ''' types json has no notion of, orjson encodes date/datetime itself w the same iso format '''
+    if isinstance(thing, timedelta):
+        # interval stays H:MM:SS as clients parse it so, not iso 8601 duration
+        return str(thing)
+    if isinstance(thing, (date, time)):
+        return thing.isoformat()
+    return str(thing)
+
+
+def stdlib_dumps(thing):
+    ''' same bytes as json.dumps(thing, default=str) responses had before, ascii w \\u escapes and spaces '''
+    return json.dumps(thing, default=encode_default).encode()
+
+
+def orjson_dumps(thing):
+    return orjson.dumps(thing, default=encode_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+# both write the same json, orjson does it w/o python calls for dates and strings,
+# compact and w utf-8 text instead of \u escapes
+SERIALIZERS = {'json': stdlib_dumps}
+if orjson is not None:
+    SERIALIZERS['orjson'] = orjson_dumps
+
+json_dumps = orjson_dumps if orjson is not None else stdlib_dumps
+
+
+def use_serializer(name):
+    ''' name from config, stdlib json if orjson is not installed '''
+    global json_dumps
+    json_dumps = SERIALIZERS.get(name, stdlib_dumps)
+
+
+def json_response(data, status=web.HTTPOk.status_code, **kwargs):
+    ''' web.json_response w body serialized to bytes once '''
+    return web.Response(body=json_dumps(data), status=status, content_type='application/json', charset='utf-8',
+                        **kwargs)
+
+
+def ndjson_line(thing):
+    return json_dumps(thing) + b'\n'
+
 
 def json_str_dumps(thing):
     ''' otherwise got problems with serialize date things '''
-    return json.dumps(thing, default=str)
+    return json_dumps(thing).decode()
 
 
 def get_random_name():
-    fake = Faker()
     return fake.name()
@@ -1,7 +1,8 @@
-from passlib.hash import sha256_crypt
-
 from .exceptions import BadRequest, BadRequest_Important
+import sqlalchemy as sa
+
 from .db_tables import recipe, users
+from .statements import execute_cached
 
 
 def validate_comment(data):
@@ -9,10 +10,27 @@ def validate_comment(data):
         raise BadRequest('Missed required param "body"')
 
 
-async def validate_recipe(conn, recipe_id):
-    cursor = await conn.execute(
-            recipe.select()
-            .where(recipe.c.id == recipe_id))
+def make_recipe_exists_query(lock=False):
+    query = sa.select([recipe.c.id]).where(recipe.c.id == sa.bindparam('recipe_id'))
+    if lock:
+        query = query.with_for_update()
+    return query
+
+
+def make_user_by_username_query():
+    return users.select().where(users.c.username == sa.bindparam('username'))
+
+
+def validate_recipe_id(recipe_id):
+    ''' id from url as int, asyncpg does not cast strings to integer params '''
+    if not str(recipe_id).isdigit():
+        raise BadRequest('No recipe with such id')
+    return int(recipe_id)
+
+
+async def validate_recipe(conn, recipe_id, lock=False):
+    cursor = await execute_cached(conn, ('recipe_exists', lock), lambda: make_recipe_exists_query(lock),
+                                  {'recipe_id': recipe_id})
     recipe_record = await cursor.fetchone()
     if not recipe_record:
         raise BadRequest('No recipe with such id')
@@ -23,16 +41,16 @@ async def validate_login(conn, data):
     if any(field not in data for field in required_fields):
         raise BadRequest('Request data does not match required fields')
 
-    return await check_credentials(conn, data['username'], data['password'])
+    ret = await execute_cached(conn, ('user_by_username',), make_user_by_username_query,
+                               {'username': data['username']})
+    return await ret.fetchone()
 
 
-async def check_credentials(conn, username, password):
-    query = users.select().where(users.c.username == username)
-    ret = await conn.execute(query)
-    user_record = await ret.fetchone()
+async def check_credentials(hasher, user_record, password):
+    ''' hashing runs w/o db connection held, see db.login '''
     if user_record:
         hash = user_record['passwd']
-        result = sha256_crypt.verify(password, hash)
+        result = await hasher.verify(password, hash)
         if result:
             return user_record
     raise BadRequest_Important('Wrong credentials')
@@ -46,9 +64,8 @@ async def validate_register(conn, data):
 
     username = data['username']
 
-    cursor = await conn.execute(
-            users.select()
-            .where(users.c.username == username))
+    cursor = await execute_cached(conn, ('user_by_username',), make_user_by_username_query,
+                                  {'username': username})
     user_record = await cursor.fetchone()
     if user_record:
         raise BadRequest('User with this username already exists')
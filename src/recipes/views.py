@@ -5,6 +5,8 @@ from aiohttp import web
 from scrape import collect_recipes
 
 from . import db
+from .broadcast import add_client, remove_client, publish
+from .cache import fill_ttl, recipe_list_tags, COUNT_TTL
 from .utils import get_random_name
 
 
@@ -12,7 +14,12 @@ from .utils import get_random_name
 @aiohttp_jinja2.template('recipes.html')
 async def recipes_nonapi(request):
     try:
-        recipes, count = await db.get_recipe_list(request.app['db'], pagination={'limit': 300}, filters=None)
+        dbengine = await db.read_engine(request.app)
+        recipes, count = await db.get_recipe_list(dbengine, pagination={'limit': 300}, filters=None,
+                                                  assembly=request.app['config']['recipe_assembly'],
+                                                  redis=request.app.get('redis'),
+                                                  count_ttl=await fill_ttl(request.app, recipe_list_tags([], None),
+                                                                           COUNT_TTL))
         return {'recipes': recipes, 'count': count}
     except Exception:
         return {'recipes': None, 'count': None}
@@ -25,37 +32,34 @@ async def recipe_detail_nonapi(request):
     ws_ready = ws_current.can_prepare(request)
     if not ws_ready.ok:
         try:
-            recipe = await db.get_recipe_list(request.app['db'],
-                                              filters=recipe_id,
-                                              many=False)
+            recipe = await db.get_recipe_detail(await db.read_engine(request.app, recipe_id=recipe_id),
+                                                recipe_id,
+                                                assembly=request.app['config']['recipe_assembly'],
+                                                detail_cache=request.app.get('recipe_cache'))
             return aiohttp_jinja2.render_template('recipe_detail.html', request, {'recipe': recipe})
         except Exception:
             return aiohttp_jinja2.render_template('recipe_detail.html', request, {'recipe': None})
 
     await ws_current.prepare(request)
-
     name = get_random_name()
+    # room of the recipe, comment and likes updates of the recipe are pushed to it too, see broadcast
+    room = await db.get_recipe_id(await db.read_engine(request.app), recipe_id) or recipe_id
+    client = await add_client(request.app, ws_current, name, room)
 
-    await ws_current.send_json({'action': 'connect', 'name': name})
-
-    for ws in request.app['websockets'].values():
-        await ws.send_json({'action': 'join', 'name': name})
-    request.app['websockets'][name] = ws_current
-
-    while True:
-        msg = await ws_current.receive()
+    client.send_json({'action': 'connect', 'name': name})
+    await publish(request.app, room, {'action': 'join', 'name': name}, exclude=client)
 
-        if msg.type == aiohttp.WSMsgType.text:
-            for ws in request.app['websockets'].values():
-                if ws is not ws_current:
-                    await ws.send_json(
-                        {'action': 'sent', 'name': name, 'text': msg.data})
-        else:
-            break
-
-    del request.app['websockets'][name]
-    for ws in request.app['websockets'].values():
-        await ws.send_json({'action': 'disconnect', 'name': name})
+    try:
+        while True:
+            msg = await ws_current.receive()
+
+            if msg.type == aiohttp.WSMsgType.text:
+                await publish(request.app, room, {'action': 'sent', 'name': name, 'text': msg.data}, exclude=client)
+            else:
+                break
+    finally:
+        await remove_client(request.app, client)
+    await publish(request.app, room, {'action': 'disconnect', 'name': name})
 
     return ws_current
 
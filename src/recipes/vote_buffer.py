@@ -0,0 +1,284 @@
+''' write-behind votes: recorded in redis at once, flushed to vote table in batches by a background task '''
+''' pending hash keeps final vote per user:recipe and likes delta per recipe until it is flushed '''
+import asyncio
+import time
+from uuid import uuid4
+
+from . import db
+from .events import evict_recipe
+from .exceptions import TooManyRequests
+from .helpers import log_exception
+from .validators import validate_recipe_id
+
+PENDING = 'votes:pending'
+PENDING_LIKES = 'votes:pending_likes'
+# batch being flushed, left here by a crashed flush it is replayed by the next one
+FLUSHING = 'votes:flushing'
+FLUSHING_LIKES = 'votes:flushing_likes'
+# bumped when a flush starts and ends committing, vote state read from db before either is not used after it
+GENERATION = 'votes:generation'
+# set while the batch is being written, db may or may not have it then, so it is not added to db values;
+# left by a crashed flush it stays until the batch is replayed, votes get 429 until then, see VoteBuffer.lock_ms
+COMMITTING = 'votes:committing'
+FLUSH_LOCK = 'votes:flush_lock'
+# db likes per recipe w/o pending and flushing deltas, dropped when a commit starts
+DB_LIKES = 'votes:db_likes'
+
+# ARGV: field, recipe id, mode, max pending, then stored vote, db likes, generation if db was read
+# {-3} db read is needed, {-2} pending is full, {-1} flush committed or committing since db read,
+# {2} vote already was so, {0 or 1 new value, likes of recipe w votes not flushed yet}
+VOTE_SCRIPT = '''
+local committing = redis.call('exists', KEYS[6]) == 1
+if #ARGV > 4 then
+    if committing or (redis.call('get', KEYS[5]) or '0') ~= ARGV[7] then
+        return {-1}
+    end
+    redis.call('hset', KEYS[7], ARGV[2], ARGV[6])
+end
+-- vote not flushed yet is newer than db and is right whatever the flush does
+local previous = redis.call('hget', KEYS[1], ARGV[1]) or redis.call('hget', KEYS[3], ARGV[1]) or ARGV[5]
+local likes = not committing and redis.call('hget', KEYS[7], ARGV[2])
+if not previous or not likes then
+    return {-3}
+end
+local value = '0'
+if ARGV[3] == 'set' or (ARGV[3] == 'toggle' and previous == '0') then
+    value = '1'
+end
+if value == previous then
+    return {2}
+end
+if redis.call('hexists', KEYS[1], ARGV[1]) == 0 and redis.call('hlen', KEYS[1]) >= tonumber(ARGV[4]) then
+    return {-2}
+end
+redis.call('hset', KEYS[1], ARGV[1], value)
+local delta = redis.call('hincrby', KEYS[2], ARGV[2], value == '1' and 1 or -1)
+return {tonumber(value), tonumber(likes) + delta + tonumber(redis.call('hget', KEYS[4], ARGV[2]) or '0')}
+'''
+
+# 0 nothing to flush, 1 pending taken, 2 replay of batch left by a crashed flush
+TAKE_SCRIPT = '''
+if redis.call('exists', KEYS[3]) == 1 then
+    return 2
+end
+if redis.call('exists', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('rename', KEYS[1], KEYS[3])
+if redis.call('exists', KEYS[2]) == 1 then
+    redis.call('rename', KEYS[2], KEYS[4])
+end
+return 1
+'''
+
+RELEASE_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+'''
+
+VOTE_RETRIES = 5
+VOTE_RETRY_DELAY = 0.05  # seconds, commit of a batch is usually over by then
+
+
+def vote_field(user_id, recipe_id):
+    return f'{user_id}:{recipe_id}'
+
+
+class VoteBuffer:
+    ''' at most max_pending votes wait for flush, votes over it get TooManyRequests '''
+
+    def __init__(self, redis, flush_interval_ms, batch_size, max_pending):
+        self.redis = redis
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        # lock outlives a stuck flush, the batch is replayed by whoever takes it next;
+        # votes wait that long after a worker crashed while committing
+        self.lock_ms = max(flush_interval_ms * 10, 10000)
+        self.counters = {
+            'buffered': 0,
+            'db_reads': 0,
+            'rejected': 0,
+            'flushes': 0,
+            'flushed_votes': 0,
+            'replayed_votes': 0,
+            'errors': 0,
+            'last_batch_size': 0,
+            'max_batch_size': 0,
+            'last_flush_ms': 0,
+            'last_flush_interval_ms': 0,
+        }
+        self._last_flush_at = None
+
+    async def vote(self, dbengine, recipe_id, user, mode):
+        ''' same modes and result as db.vote_recipe, dbengine is primary '''
+        ''' db is read only for user's first vote on recipe and recipe's first vote since a flush '''
+        recipe_id = validate_recipe_id(recipe_id)
+        field = vote_field(user['id'], recipe_id)
+        db_state = []
+        for _ in range(VOTE_RETRIES):
+            result = await self.redis.eval(
+                VOTE_SCRIPT,
+                keys=[PENDING, PENDING_LIKES, FLUSHING, FLUSHING_LIKES, GENERATION, COMMITTING, DB_LIKES],
+                args=[field, recipe_id, mode, self.max_pending, *db_state])
+            code = result[0]
+            if code == -3:
+                generation = await self.redis.get(GENERATION) or b'0'
+                stored, likes = await db.get_vote_state(dbengine, recipe_id, user)
+                self.counters['db_reads'] += 1
+                db_state = [int(stored), likes, generation]
+                continue
+            if code == -2:
+                self.counters['rejected'] += 1
+                raise TooManyRequests('Too many votes, try again later')
+            if code == 2:
+                return None
+            if code != -1:
+                self.counters['buffered'] += 1
+                return result[1]
+            db_state = []
+            await asyncio.sleep(VOTE_RETRY_DELAY)
+        raise TooManyRequests('Vote is being saved, try again later')
+
+    async def flush(self, dbengine):
+        ''' one batch per call, returns (user_id, recipe_id, value) of votes written '''
+        token = uuid4().hex
+        locked = await self.redis.set(FLUSH_LOCK, token, pexpire=self.lock_ms, exist=self.redis.SET_IF_NOT_EXIST)
+        if not locked:
+            return []  # other worker is flushing
+        try:
+            taken = await self.redis.eval(TAKE_SCRIPT, keys=[PENDING, PENDING_LIKES, FLUSHING, FLUSHING_LIKES])
+            if not taken:
+                return []
+            started = time.monotonic()
+            pending = await self.redis.hgetall(FLUSHING)
+            votes = []
+            for field, value in pending.items():
+                user_id, recipe_id = field.split(b':')
+                votes.append((int(user_id), int(recipe_id), value == b'1'))
+            await self._commit_started()
+            await db.flush_votes(dbengine, votes, self.batch_size)
+            await self._commit_finished()
+            self._flushed(votes, started, replayed=taken == 2)
+            return votes
+        finally:
+            await self.redis.eval(RELEASE_SCRIPT, keys=[FLUSH_LOCK], args=[token])
+
+    async def _commit_started(self):
+        transaction = self.redis.multi_exec()
+        transaction.set(COMMITTING, 1)
+        transaction.delete(DB_LIKES)
+        transaction.incr(GENERATION)
+        await transaction.execute()
+
+    async def _commit_finished(self):
+        ''' db has these votes now, likes deltas go w them '''
+        transaction = self.redis.multi_exec()
+        transaction.delete(FLUSHING, FLUSHING_LIKES, COMMITTING)
+        transaction.incr(GENERATION)
+        await transaction.execute()
+
+    def _flushed(self, votes, started, replayed):
+        now = time.monotonic()
+        counters = self.counters
+        counters['flushes'] += 1
+        counters['flushed_votes'] += len(votes)
+        if replayed:
+            counters['replayed_votes'] += len(votes)
+        counters['last_batch_size'] = len(votes)
+        counters['max_batch_size'] = max(counters['max_batch_size'], len(votes))
+        counters['last_flush_ms'] = (now - started) * 1000
+        if self._last_flush_at is not None:
+            counters['last_flush_interval_ms'] = (now - self._last_flush_at) * 1000
+        self._last_flush_at = now
+
+    async def run(self, app):
+        ''' first pass replays a batch left by a crash, if any '''
+        while True:
+            try:
+                votes = await self.flush(app['db'])
+                # cached detail has likes read before the flush, w/o pending votes on top they are stale
+                for recipe_id in {recipe_id for _, recipe_id, _ in votes}:
+                    await evict_recipe(app, recipe_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.counters['errors'] += 1
+                log_exception(app, e)
+            await asyncio.sleep(self.flush_interval)
+
+    async def overlay(self, recipes, usr=None):
+        ''' recipes w likes and liked as if pending votes were flushed, changed ones are copied '''
+        ''' recipes are read from db before, a batch being committed may be in them already and is left out '''
+        if not recipes:
+            return recipes
+        recipe_ids = [one_recipe['recipe_id'] for one_recipe in recipes]
+        # one snapshot, batch is either flushing or in db
+        transaction = self.redis.multi_exec()
+        committing = transaction.exists(COMMITTING)
+        pending_likes = transaction.hmget(PENDING_LIKES, *recipe_ids)
+        flushing_likes = transaction.hmget(FLUSHING_LIKES, *recipe_ids)
+        if usr:
+            fields = [vote_field(usr['id'], recipe_id) for recipe_id in recipe_ids]
+            pending_votes = transaction.hmget(PENDING, *fields)
+            flushing_votes = transaction.hmget(FLUSHING, *fields)
+        await transaction.execute()
+
+        pending_likes, flushing_likes = await pending_likes, await flushing_likes
+        if usr:
+            pending_votes, flushing_votes = await pending_votes, await flushing_votes
+        if await committing:
+            flushing_likes = [None] * len(recipe_ids)
+            if usr:
+                flushing_votes = [None] * len(recipe_ids)
+        result = []
+        for position, one_recipe in enumerate(recipes):
+            changes = {}
+            delta = int(pending_likes[position] or 0) + int(flushing_likes[position] or 0)
+            if delta:
+                changes['likes'] = one_recipe['likes'] + delta
+            if usr:
+                value = pending_votes[position] or flushing_votes[position]
+                if value is not None:
+                    changes['liked'] = value == b'1'
+            result.append(dict(one_recipe, **changes) if changes else one_recipe)
+        return result
+
+    def stats(self):
+        return dict(self.counters, flush_interval_ms=self.flush_interval * 1000, batch_size=self.batch_size,
+                    max_pending=self.max_pending)
+
+
+async def apply_pending_votes(app, recipes, usr=None):
+    buffer = app.get('vote_buffer')
+    if buffer is None:
+        return recipes
+    return await buffer.overlay(recipes, usr)
+
+
+async def init_vote_buffer(app):
+    ''' write-behind needs redis, votes go straight to db w/o it '''
+    conf = app['config']['votes']
+    redis = app.get('redis')
+    if not conf['write_behind'] or redis is None:
+        yield
+        return
+    buffer = app['vote_buffer'] = VoteBuffer(redis,
+                                             flush_interval_ms=conf['flush_interval_ms'],
+                                             batch_size=conf['batch_size'],
+                                             max_pending=conf['max_pending'])
+    app['metrics']['vote_buffer'] = buffer.stats
+    task = asyncio.ensure_future(buffer.run(app))
+    yield
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    # what is left is flushed by other workers or on next start
+    try:
+        await buffer.flush(app['db'])
+    except Exception as e:
+        log_exception(app, e)
@@ -0,0 +1,238 @@
+''' pre-fork workers, each w own event loop, db and redis pools and listening socket on the same port (SO_REUSEPORT) '''
+''' SIGHUP replaces workers one by one, SIGTERM / SIGINT stops them, stalled or dead workers are replaced '''
+import asyncio
+import logging
+import os
+import selectors
+import signal
+import time
+
+from aiohttp import web
+
+logger = logging.getLogger('ksg.workers')
+
+CHECK_INTERVAL = 0.5  # seconds, master reacts to signals and dead workers within it
+RESPAWN_DELAY = 1  # seconds before replacing worker that died before it was ready, e.g. db is down
+
+
+class Worker:
+    def __init__(self, pid, heartbeat_fd):
+        self.pid = pid
+        self.heartbeat_fd = heartbeat_fd
+        self.started = self.last_beat = time.monotonic()
+        self.ready = False  # listening, first heartbeat is sent after socket is bound
+        self.retiring = False  # stopped by master, not replaced when it exits
+        self.killed = False
+
+
+async def serve(build_app, config, heartbeat_fd):
+    ''' worker event loop, heartbeats come from it so a blocked loop stops them '''
+    conf = config['workers']
+    app = await build_app()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, config['host'], config['port'], reuse_port=True,
+                       shutdown_timeout=conf['shutdown_timeout'])
+    await site.start()
+
+    # master may be busy, worker loop never waits for it; worker exits on broken pipe if master is gone
+    os.set_blocking(heartbeat_fd, False)
+    stop = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        while not stop.is_set():
+            try:
+                os.write(heartbeat_fd, b'.')
+            except BlockingIOError:
+                pass
+            try:
+                await asyncio.wait_for(stop.wait(), conf['heartbeat_interval'])
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        # stops listening, waits for requests in flight up to shutdown_timeout, then app cleanup
+        await runner.cleanup()
+
+
+class Master:
+    ''' forks and supervises workers, has no event loop and no pools itself '''
+
+    def __init__(self, build_app, config):
+        self.build_app = build_app
+        self.config = config
+        conf = config['workers']
+        self.count = conf['count'] or os.cpu_count()
+        self.heartbeat_timeout = conf['heartbeat_timeout']
+        self.startup_timeout = conf['startup_timeout']
+        self.shutdown_timeout = conf['shutdown_timeout']
+        self.workers = {}  # pid -> Worker
+        self.respawns = []  # monotonic times of delayed spawns
+        self.selector = selectors.DefaultSelector()
+        self.stopping = False
+        self.reload_requested = False
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        logger.info(f'Starting {self.count} workers on {self.config["host"]}:{self.config["port"]}')
+        for _ in range(self.count):
+            self.spawn()
+        while not self.stopping:
+            self.tick()
+            if self.reload_requested:
+                self.reload_requested = False
+                self.rolling_restart()
+        self.stop_all()
+
+    def _on_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def spawn(self):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            self._run_worker(write_fd)  # never returns
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        worker = self.workers[pid] = Worker(pid, read_fd)
+        self.selector.register(read_fd, selectors.EVENT_READ, worker)
+        logger.info(f'Worker {pid} started')
+        return worker
+
+    def _run_worker(self, heartbeat_fd):
+        # nothing of the master is used in worker, loop and pools are created after fork
+        self.selector.close()
+        for worker in self.workers.values():
+            os.close(worker.heartbeat_fd)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)  # reload is done by master
+        code = 0
+        try:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(serve(self.build_app, self.config, heartbeat_fd))
+        except Exception:
+            logger.exception('Worker failed')
+            code = 1
+        finally:
+            os._exit(code)
+
+    def tick(self):
+        for key, _ in self.selector.select(timeout=CHECK_INTERVAL):
+            self._read_heartbeats(key.data)
+        self._reap()
+        self._check_health()
+        now = time.monotonic()
+        due = [at for at in self.respawns if at <= now]
+        for at in due:
+            self.respawns.remove(at)
+            if not self.stopping:
+                self.spawn()
+
+    def _read_heartbeats(self, worker):
+        try:
+            data = os.read(worker.heartbeat_fd, 4096)
+        except BlockingIOError:
+            return
+        if not data:  # worker exited, it is reaped by waitpid
+            self.selector.unregister(worker.heartbeat_fd)
+            return
+        worker.last_beat = time.monotonic()
+        if not worker.ready:
+            worker.ready = True
+            logger.info(f'Worker {worker.pid} is ready')
+
+    def _reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            if worker.heartbeat_fd in self.selector.get_map():
+                self.selector.unregister(worker.heartbeat_fd)
+            os.close(worker.heartbeat_fd)
+            if worker.retiring or self.stopping:
+                logger.info(f'Worker {pid} stopped')
+                continue
+            logger.warning(f'Worker {pid} died w status {status}, replacing it')
+            delay = 0 if worker.ready else RESPAWN_DELAY
+            self.respawns.append(time.monotonic() + delay)
+
+    def _check_health(self):
+        now = time.monotonic()
+        for worker in list(self.workers.values()):
+            if worker.ready:
+                stalled = now - worker.last_beat > self.heartbeat_timeout
+            else:
+                stalled = now - worker.started > self.startup_timeout
+            if stalled and not worker.retiring and not worker.killed:
+                # replaced once reaped
+                logger.warning(f'Worker {worker.pid} sent no heartbeat, killing it')
+                worker.killed = True
+                self._signal(worker, signal.SIGKILL)
+
+    def _signal(self, worker, signum):
+        try:
+            os.kill(worker.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _wait(self, done, timeout):
+        deadline = time.monotonic() + timeout
+        while not done() and not self.stopping and time.monotonic() < deadline:
+            self.tick()
+        return done()
+
+    def rolling_restart(self):
+        ''' new worker is ready before old one stops, workers are forked from master so new code needs its restart '''
+        logger.info('Reloading workers')
+        for old in list(self.workers.values()):
+            if self.stopping:
+                return
+            if old.retiring or old.pid not in self.workers:
+                continue
+            new = self.spawn()
+            # replacement is not respawned if it fails to start, old worker keeps serving instead
+            new.retiring = True
+            self._wait(lambda: new.ready or new.pid not in self.workers, self.startup_timeout)
+            if not new.ready:
+                logger.warning('Worker did not become ready, reload is stopped')
+                if new.pid in self.workers:
+                    self._signal(new, signal.SIGKILL)
+                return
+            new.retiring = False
+            old.retiring = True
+            self._signal(old, signal.SIGTERM)
+            self._wait(lambda: old.pid not in self.workers, self.shutdown_timeout + self.heartbeat_timeout)
+
+    def stop_all(self):
+        logger.info('Stopping workers')
+        for worker in self.workers.values():
+            worker.retiring = True
+            self._signal(worker, signal.SIGTERM)
+        deadline = time.monotonic() + self.shutdown_timeout + CHECK_INTERVAL * 4
+        while self.workers and time.monotonic() < deadline:
+            self.tick()
+        for worker in self.workers.values():
+            logger.warning(f'Worker {worker.pid} did not stop in time, killing it')
+            self._signal(worker, signal.SIGKILL)
+        while self.workers:
+            self.tick()
+
+
+def run_workers(build_app, config):
+    ''' build_app is coroutine function returning the app, called in every worker '''
+    Master(build_app, config).run()
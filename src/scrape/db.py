@@ -1,4 +1,5 @@
 from recipes import db_tables as recipes_db
+from recipes.events import recipe_saved, ingredient_item_saved
 
 import asyncio
 
@@ -41,7 +42,7 @@ async def get_all_sources(dbengine):
         return source_records
 
 
-async def save_recipe(dbengine, task_result, recipe, recipe_source):
+async def save_recipe(dbengine, task_result, recipe, recipe_source, app=None):
     recipe['source'] = recipe_source['id']
     category_code = recipe['category']
 
@@ -95,7 +96,8 @@ async def save_recipe(dbengine, task_result, recipe, recipe_source):
         # async adding ingredient items to recipe
         # use semaphore to limit number of concurrent tasks
         sem = asyncio.Semaphore(3)
-        tasks = [semaphored_function(sem, save_ingredient_item, dbengine, record['id'], ingredient) for ingredient in recipe['ingredients'].items()]
+        tasks = [semaphored_function(sem, save_ingredient_item, dbengine, record['id'], ingredient, app)
+                 for ingredient in recipe['ingredients'].items()]
         try:
             await asyncio.wait(tasks)
         except Exception as e:
@@ -104,8 +106,11 @@ async def save_recipe(dbengine, task_result, recipe, recipe_source):
         task_result.update({'recipes_saved': task_result['recipes_saved'] + 1})
         print('recipe saved: ', record['slug'])
 
+    if app is not None:
+        await recipe_saved(app, record['id'], recipe['category'], title=recipe['title'], slug=record['slug'])
 
-async def save_ingredient_item(dbengine, recipe_id, ingredient):
+
+async def save_ingredient_item(dbengine, recipe_id, ingredient, app=None):
     async with dbengine.acquire() as conn:
         cursor = await conn.execute(recipes_db.ingredient.select()
                                     .where(recipes_db.ingredient.c.name == ingredient[0]))
@@ -133,6 +138,9 @@ async def save_ingredient_item(dbengine, recipe_id, ingredient):
         if not record:
             raise Exception('Error while saving new ingredient_item')
 
+    if app is not None:
+        ingredient_item_saved(app, recipe_id, ingredient_id, ingredient[0])
+
 
 async def semaphored_function(semaphore, function, *func_args):
     async with semaphore:
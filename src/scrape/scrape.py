@@ -124,7 +124,8 @@ class RecipeUpdater:
             # asynchronously variation
             # use semaphore to limit number of concurrent tasks
             sem = asyncio.Semaphore(3)
-            tasks = [db.semaphored_function(sem, db.save_recipe, request.app['db'], result, recipes[i], self.source) for i, entry in enumerate(recipes)]
+            tasks = [db.semaphored_function(sem, db.save_recipe, request.app['db'], result, recipes[i], self.source,
+                                            request.app) for i, entry in enumerate(recipes)]
             try:
                 await asyncio.wait(tasks)
             except Exception as e:
@@ -1,7 +1,11 @@
+import asyncio
+
+import aioredis
 import pytest
 
 from recipes.main import init_app
 from recipes.settings import TEST_CONFIG
+from recipes.backends import BACKENDS
 from init_db import (
     setup_db,
     teardown_db,
@@ -12,12 +16,48 @@ from init_db import (
 
 
 
+@pytest.fixture(params=BACKENDS)
+def backend(request):
+    if request.param == 'asyncpg':
+        pytest.importorskip('asyncpg')
+    return request.param
+
+
 @pytest.fixture
-async def cli(loop, aiohttp_client, db):
-    app = await init_app(testing=True)
+async def cli(loop, aiohttp_client, db, backend):
+    # every test runs against each postgres backend
+    config = dict(TEST_CONFIG, postgres=dict(TEST_CONFIG['postgres'], backend=backend))
+    app = await init_app(testing=True, config=config)
     return await aiohttp_client(app)
 
 
+@pytest.fixture
+async def make_redis_cli(loop, aiohttp_client, db, backend):
+    ''' client of app w redis, config sections are updated by keyword arguments, skipped w/o redis '''
+    conf = TEST_CONFIG['redis']
+    try:
+        redis = await aioredis.create_redis_pool(f'redis://{conf["server"]}:{conf["port"]}', db=conf['db'],
+                                                 minsize=conf['minsize'], maxsize=conf['maxsize'], timeout=2)
+    except (OSError, asyncio.TimeoutError):
+        pytest.skip('redis is not reachable')
+    await redis.flushdb()
+
+    async def close_redis(app):
+        redis.close()
+        await redis.wait_closed()
+
+    async def make(**sections):
+        config = dict(TEST_CONFIG, postgres=dict(TEST_CONFIG['postgres'], backend=backend))
+        for name, values in sections.items():
+            config[name] = dict(config[name], **values)
+        app = await init_app(testing=True, config=config)
+        # before startup, vote buffer and broadcast pick it up
+        app['redis'] = redis
+        app.on_cleanup.append(close_redis)
+        return await aiohttp_client(app)
+    return make
+
+
 @pytest.fixture(scope='module')
 def db():
     setup_db(TEST_CONFIG['postgres'])
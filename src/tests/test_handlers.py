@@ -1,11 +1,33 @@
+import asyncio
 from datetime import datetime, timedelta
 
-from recipes.db_tables import recipe, vote, comment
+import json
+
+import aiohttp
+import pytest
+
+from recipes import db
+from recipes.main import init_app
+from recipes.settings import TEST_CONFIG
+from recipes.statements import statements
+from recipes.cache import (
+    get_cached_count, set_cached_count, invalidate_counts, store_response, invalidate_tags,
+    fill_ttl, RESPONSE_GENERATION, RESPONSE_TTL, RESPONSE_KEY_PREFIX, COUNT_KEYS
+)
+from recipes.events import recipe_saved
+from recipes.ingredient_index import IngredientIndex
+from recipes.vote_buffer import TAKE_SCRIPT, PENDING, PENDING_LIKES, FLUSHING, FLUSHING_LIKES
+from recipes.broadcast import fan_out, likes_event, CLOSE_SLOW_CONSUMER, EVICT_CHANNEL
+from recipes.db_tables import recipe, vote, comment, users, ingredient, ingredient_item
+from recipes.utils import json_str_dumps, SERIALIZERS
 from .schemas import user_schema
 
 import sqlalchemy as sa
 from jsonschema import validate
 
+from init_db import reconcile_likes
+from .conftest import get_token
+
 
 async def test_register(cli, tables_and_data):
     response = await cli.post(
@@ -111,6 +133,24 @@ async def test_current_user(cli, tables_and_data, token):
     assert response_data['username'] == 'test_user'
     validate(instance=response_data, schema=user_schema)
 
+    # user record is cached after first load
+    response = await cli.get(
+        '/api/users/current',
+        headers={'authorization_jwt': token}
+    )
+    assert response.status == 200
+    assert cli.server.app['user_cache'].stats()['hits'] == 1
+
+    # token outlives deleted user
+    async with cli.server.app['db'].acquire() as conn:
+        await conn.execute(users.delete().where(users.c.username == 'test_user'))
+    cli.server.app['user_cache'].pop(response_data['id'])
+    response = await cli.get(
+        '/api/users/current',
+        headers={'authorization_jwt': token}
+    )
+    assert response.status == 401
+
 
 async def test_vote_recipe(cli, tables_and_data, token):
     response = await cli.post(
@@ -149,6 +189,123 @@ async def test_vote_recipe(cli, tables_and_data, token):
     assert response.status == 400  # bad recipe id
 
 
+async def test_vote_set_unset(cli, tables_and_data, token):
+    async def vote_state():
+        async with cli.server.app['db'].acquire() as conn:
+            cursor = await conn.execute(sa.select([vote.c.value])
+                                        .where(vote.c.recipe_id == 340)
+                                        .where(vote.c.user_id == 1))
+            votes = [record[0] for record in await cursor.fetchall()]
+            likes = await conn.scalar(sa.select([recipe.c.likes]).where(recipe.c.id == 340))
+        return votes, likes
+
+    # double clicks
+    responses = await asyncio.gather(*[cli.put('/api/recipes/340/vote', headers={'authorization_jwt': token})
+                                       for _ in range(3)])
+    assert [response.status for response in responses] == [204] * 3
+    assert await vote_state() == ([True], 1)
+
+    for _ in range(2):
+        response = await cli.delete('/api/recipes/340/vote', headers={'authorization_jwt': token})
+        assert response.status == 204
+        assert await vote_state() == ([False], 0)
+
+    response = await cli.post('/api/recipes/340/vote', headers={'authorization_jwt': token})
+    assert response.status == 201
+    assert await vote_state() == ([True], 1)
+
+    for method in (cli.put, cli.delete):
+        response = await method('/api/recipes/1/vote', headers={'authorization_jwt': token})
+        assert response.status == 400  # bad recipe id
+
+
+async def test_vote_buffer(make_redis_cli, tables_and_data):
+    # background flushes are out of the way, test flushes itself
+    cli = await make_redis_cli(votes={'write_behind': True, 'flush_interval_ms': 600000})
+    app = cli.server.app
+    buffer = app['vote_buffer']
+    token = await get_token(cli)
+    headers = {'authorization_jwt': token}
+
+    async def likes(recipe_id):
+        async with app['db'].acquire() as conn:
+            return await conn.scalar(sa.select([recipe.c.likes]).where(recipe.c.id == recipe_id))
+
+    async def detail(recipe_id):
+        response = await cli.get(f'/api/recipes/{recipe_id}', headers=headers)
+        assert response.status == 200
+        response_data = await response.json()
+        return response_data['likes'], response_data['liked']
+
+    # vote is in redis only, responses show it on top of db values
+    response = await cli.post('/api/recipes/340/vote', headers=headers)
+    assert response.status == 201
+    response = await cli.put('/api/recipes/340/vote', headers=headers)
+    assert response.status == 204
+    assert buffer.stats()['db_reads'] == 1  # repeated vote is decided in redis
+    assert await likes(340) == 0
+    assert await detail(340) == (1, True)
+    response = await cli.get('/api/recipes?limit=140', headers=headers)
+    one_recipe = [one_recipe for one_recipe in (await response.json())['results'] if one_recipe['recipe_id'] == 340]
+    assert one_recipe and one_recipe[0]['likes'] == 1
+
+    assert await buffer.flush(app['db']) == [(1, 340, True)]
+    assert await likes(340) == 1
+    app['recipe_cache'].evict(340)  # as the flush task does
+    assert await detail(340) == (1, True)  # not counted twice
+
+    # flush crashed after db commit, batch is in db and still in redis
+    response = await cli.post('/api/recipes/341/vote', headers=headers)
+    assert response.status == 201
+    assert await app['redis'].eval(TAKE_SCRIPT, keys=[PENDING, PENDING_LIKES, FLUSHING, FLUSHING_LIKES]) == 1
+    await buffer._commit_started()
+    await db.flush_votes(app['db'], [(1, 341, True)], 500)
+    assert await detail(341) == (1, True)
+    response = await cli.delete('/api/recipes/341/vote', headers=headers)
+    assert response.status == 429  # vote state is unknown until the batch is replayed
+
+    # next flush replays the batch, likes are not changed twice
+    assert await buffer.flush(app['db']) == [(1, 341, True)]
+    assert buffer.stats()['replayed_votes'] == 1
+    assert await likes(341) == 1
+    assert await detail(341) == (1, True)
+    response = await cli.delete('/api/recipes/341/vote', headers=headers)
+    assert response.status == 204
+    assert await detail(341) == (0, False)
+
+    # likes for websocket event come from redis after the first read
+    reads = buffer.stats()['db_reads']
+    assert await buffer.vote(app['db'], 342, {'id': 1}, 'set') == 1
+    assert await buffer.vote(app['db'], 342, {'id': 1}, 'toggle') == 0
+    assert buffer.stats()['db_reads'] == reads + 1
+
+
+async def test_reconcile_likes(cli, tables_and_data, token):
+    for recipe_id in [340, 348]:
+        response = await cli.post(
+            f'/api/recipes/{recipe_id}/vote',
+            headers={'authorization_jwt': token}
+        )
+        assert response.status == 201
+
+    async with cli.server.app['db'].acquire() as conn:
+        cursor = await conn.execute(sa.select([recipe.c.id, recipe.c.likes])
+                                    .where(recipe.c.id.in_([340, 348, 350])))
+        likes = {record['id']: record['likes'] for record in await cursor.fetchall()}
+        assert likes == {340: 1, 348: 1, 350: 0}
+
+        # counter drifted from votes
+        await conn.execute(recipe.update().values(likes=5))
+
+    reconcile_likes()
+
+    async with cli.server.app['db'].acquire() as conn:
+        cursor = await conn.execute(sa.select([recipe.c.id, recipe.c.likes])
+                                    .where(recipe.c.id.in_([340, 348, 350])))
+        likes = {record['id']: record['likes'] for record in await cursor.fetchall()}
+        assert likes == {340: 1, 348: 1, 350: 0}
+
+
 async def test_comment_recipe(cli, tables_and_data, token):
     response = await cli.post(
         '/api/recipes/348/comment'
@@ -402,6 +559,318 @@ async def test_recipes(cli, tables_and_data, token):
             assert 'I love this so much![2]' in [comment['body'] for comment in one_recipe['comments']]
 
 
+async def test_recipes_cursor(cli, tables_and_data):
+    response = await cli.get('/api/recipes?cursor=&limit=50')
+    assert response.status == 200
+    response_data = await response.json()
+    assert 'prev' in response_data
+    assert response_data['prev'] is None  # first page
+    assert len(response_data['results']) == 50
+    first_page_ids = [one_recipe['recipe_id'] for one_recipe in response_data['results']]
+    recipe_ids = list(first_page_ids)
+
+    # walk through all pages w next cursors
+    while response_data['next']:
+        response = await cli.get(response_data['next'])
+        assert response.status == 200
+        response_data = await response.json()
+        recipe_ids += [one_recipe['recipe_id'] for one_recipe in response_data['results']]
+    assert len(recipe_ids) == len(set(recipe_ids))  # no repeats
+    assert len(recipe_ids) == response_data['count']  # no skips
+
+    # second page and back w prev cursor
+    response = await cli.get('/api/recipes?cursor=&limit=50')
+    response_data = await response.json()
+    response = await cli.get(response_data['next'])
+    response_data = await response.json()
+    assert [one_recipe['recipe_id'] for one_recipe in response_data['results']] == recipe_ids[50:100]
+    response = await cli.get(response_data['prev'])
+    assert response.status == 200
+    response_data = await response.json()
+    assert [one_recipe['recipe_id'] for one_recipe in response_data['results']] == first_page_ids
+
+    # nothing before the first page, way back forward is still there
+    response = await cli.get(response_data['prev'])
+    assert response.status == 200
+    response_data = await response.json()
+    assert response_data['results'] == []
+    assert response_data['prev'] is None
+    response = await cli.get(response_data['next'])
+    response_data = await response.json()
+    assert [one_recipe['recipe_id'] for one_recipe in response_data['results']] == first_page_ids
+
+    # filters are kept in cursor links
+    response = await cli.get('/api/recipes?cursor=&limit=5&category=2')
+    response_data = await response.json()
+    assert 'category=2' in response_data['next']
+    response = await cli.get(response_data['next'])
+    response_data = await response.json()
+    for one_recipe in response_data['results']:
+        assert one_recipe['recipe_category_id'] == 2
+
+    response = await cli.get('/api/recipes?cursor=notacursor')
+    assert response.status == 400  # bad cursor
+
+
+async def test_recipe_assembly(cli, tables_and_data, token):
+    def normalized(recipes):
+        # nested lists have no defined order, dates become strings
+        recipes = json.loads(json_str_dumps(recipes))
+        for one_recipe in recipes:
+            one_recipe['ingredients'].sort(key=lambda ingredient: ingredient['name'])
+            one_recipe['comments'].sort(key=lambda comment: comment['body'])
+        return recipes
+
+    for body in ['first comment', 'second comment']:
+        response = await cli.post(
+            '/api/recipes/340/comment',
+            headers={'authorization_jwt': token},
+            json={'body': body}
+        )
+        assert response.status == 201
+
+    dbengine = cli.server.app['db']
+    for pagination in [{'limit': 20}, {'limit': 140}, {'limit': 20, 'offset': 200}]:
+        recipes, count = await db.get_recipe_list(dbengine, pagination)
+        assembled_recipes, assembled_count = await db.get_recipe_list(dbengine, pagination, assembly='json')
+        assert count == assembled_count
+        assert normalized(recipes) == normalized(assembled_recipes)
+
+    one_recipe = await db.get_recipe_list(dbengine, filters='340', many=False)
+    assembled_recipe = await db.get_recipe_list(dbengine, filters='340', many=False, assembly='json')
+    assert normalized([one_recipe]) == normalized([assembled_recipe])
+    assert len(assembled_recipe['comments']) == 2
+
+
+async def test_search(cli, tables_and_data, token):
+    response = await cli.get('/api/recipes/search')
+    assert response.status == 400  # no query
+
+    response = await cli.get('/api/recipes/search?q=суп&limit=140')
+    assert response.status == 200
+    response_data = await response.json()
+    assert 'count' in response_data
+    assert 'next' in response_data
+    assert response_data['count'] > 0
+    assert 340 in [one_recipe['recipe_id'] for one_recipe in response_data['results']]
+    ranks = [one_recipe['rank'] for one_recipe in response_data['results']]
+    assert ranks == sorted(ranks, reverse=True)
+    for one_recipe in response_data['results']:
+        assert 'ingredients' in one_recipe
+        assert 'comments' in one_recipe
+
+    # typo falls back to trigram title match
+    response = await cli.get('/api/recipes/search?q=сырнй&limit=140')
+    assert response.status == 200
+    response_data = await response.json()
+    assert 340 in [one_recipe['recipe_id'] for one_recipe in response_data['results']]
+
+    # list filters apply to search as well
+    response = await cli.get('/api/recipes/search?q=суп&category=2')
+    assert response.status == 200
+    response_data = await response.json()
+    for one_recipe in response_data['results']:
+        assert one_recipe['recipe_category_id'] == 2
+
+    response = await cli.get('/api/recipes/search?q=zzzzzzzzzz')
+    assert response.status == 200
+    response_data = await response.json()
+    assert response_data['count'] == 0
+    assert response_data['results'] == []
+
+    response = await cli.get('/api/recipes/search?q=суп', headers={'authorization_jwt': token})
+    assert response.status == 200
+    response_data = await response.json()
+    assert 'liked' in response_data['results'][0]
+
+
+async def test_by_ingredients(cli, tables_and_data):
+    response = await cli.get('/api/recipes/by_ingredients')
+    assert response.status == 400  # no ingredients
+
+    # Соль, Лук репчатый by names and Морковь by id
+    response = await cli.get('/api/recipes/by_ingredients?ingredients=соль,Лук репчатый,17,unknown thing')
+    assert response.status == 200
+    response_data = await response.json()
+    assert response_data['unknown'] == ['unknown thing']
+    assert len(response_data['results']) == 20
+    coverages = [one_recipe['coverage'] for one_recipe in response_data['results']]
+    assert coverages == sorted(coverages, reverse=True)
+
+    # matched and total agree w database
+    one_recipe = response_data['results'][0]
+    async with cli.server.app['db'].acquire() as conn:
+        cursor = await conn.execute(sa.select([sa.func.count(sa.distinct(ingredient_item.c.ingredient_id))])
+                                    .where(ingredient_item.c.recipe_id == one_recipe['recipe_id']))
+        assert (await cursor.fetchone())[0] == one_recipe['total']
+        cursor = await conn.execute(sa.select([sa.func.count(sa.distinct(ingredient_item.c.ingredient_id))])
+                                    .where(ingredient_item.c.recipe_id == one_recipe['recipe_id'])
+                                    .where(ingredient_item.c.ingredient_id.in_([3, 4, 17])))
+        assert (await cursor.fetchone())[0] == one_recipe['matched']
+
+    # incremental update
+    cli.server.app['ingredient_index'].add(340, 100500, 'Новый ингредиент')
+    response = await cli.get('/api/recipes/by_ingredients?ingredients=новый ингредиент')
+    response_data = await response.json()
+    assert response_data['count'] == 1
+    assert response_data['results'][0]['recipe_id'] == 340
+
+    # update while index is being built is not lost w what the build read
+    index = IngredientIndex()
+    build = asyncio.ensure_future(index.build(cli.server.app['db_read']))
+    await asyncio.sleep(0)
+    index.add(341, 100501, 'Ингредиент во время сборки')
+    await build
+    assert index.query([100501])[1][0]['recipe_id'] == 341
+
+    # rows written by another worker show up w the next rebuild
+    app_index = cli.server.app['ingredient_index']
+    builds = app_index.stats()['builds']
+    async with cli.server.app['db'].acquire() as conn:
+        # sample data sets ids explicitly, sequences are behind
+        await conn.execute(ingredient.insert().values(id=100502, name='Ингредиент другого воркера'))
+        await conn.execute(ingredient_item.insert().values(id=100502, recipe_id=342, ingredient_id=100502))
+    await app_index.rebuild(cli.server.app['db_read'])
+    assert app_index.stats()['builds'] == builds + 1
+    assert app_index.resolve(['ингредиент другого воркера'])[0] == [100502]
+    assert app_index.query([100502])[1][0]['recipe_id'] == 342
+
+
+async def test_statement_cache(cli, tables_and_data):
+    # same filter shape w other values reuses compiled statements
+    response = await cli.get('/api/recipes?category=1&prep_time=60')
+    assert response.status == 200
+    stats = statements.stats()
+    response = await cli.get('/api/recipes?category=2,3&prep_time=30')
+    assert response.status == 200
+    response_data = await response.json()
+    assert response_data['results']
+    for one_recipe in response_data['results']:
+        assert one_recipe['category_id'] in (2, 3)  # values are not baked into cached sql
+    assert statements.stats()['misses'] == stats['misses']
+    assert statements.stats()['hits'] > stats['hits']
+
+
+@pytest.mark.usefixtures('db')
+async def test_read_your_writes(aiohttp_client, backend, tables_and_data):
+    # test database plays both replicas
+    conf = TEST_CONFIG['postgres']
+    dsn = 'postgresql://{user}:{password}@{host}:{port}/{database}'.format(**conf)
+    config = dict(TEST_CONFIG, postgres=dict(conf, backend=backend, replicas=[dsn, dsn]))
+    client = await aiohttp_client(await init_app(testing=True, config=config))
+    app = client.server.app
+    token = await get_token(client)
+    assert len(app['db_read'].engines) == 2
+    assert await db.read_engine(app, {'id': 1}) is app['db_read']
+
+    response = await client.get('/api/recipes', headers={'authorization_jwt': token})
+    assert response.status == 200
+    response = await client.post('/api/recipes/340/vote', headers={'authorization_jwt': token})
+    assert response.status == 201
+    assert await db.read_engine(app, {'id': 1}) is app['db']  # voter reads from primary for a while
+    assert await db.read_engine(app, {'id': 2}) is app['db_read']
+    assert await db.read_engine(app) is app['db_read']
+    response = await client.get('/api/recipes/340', headers={'authorization_jwt': token})
+    assert (await response.json())['liked'] is True
+
+    # anonymous reads of changed recipe fill shared caches, they go to primary for a while too
+    assert await db.read_engine(app, recipe_id=340) is app['db']
+    assert await db.read_engine(app, recipe_id='syrnyi-sup-po-frantsuzski-s-kuritsei') is app['db']  # slug seen above
+    assert await db.read_engine(app, recipe_id=341) is app['db_read']
+    async with app['db'].acquire() as conn:
+        slug = await conn.scalar(sa.select([recipe.c.slug]).where(recipe.c.id == 341))
+    assert await db.read_engine(app, recipe_id=slug) is app['db_read']  # unseen slug is looked up
+    assert await db.read_engine(app, recipe_id='no-such-recipe') is app['db']  # might be not replicated yet
+    # lists stay on replicas, their cache fills w changed recipe are short-lived
+    assert await db.read_engine(app) is app['db_read']
+    assert await fill_ttl(app, ['recipe:340', 'list'], RESPONSE_TTL) == conf['pin_seconds']
+    assert await fill_ttl(app, ['recipe:341', 'list'], RESPONSE_TTL) == RESPONSE_TTL
+
+
+async def test_read_your_writes_shared(make_redis_cli, tables_and_data):
+    # pins are in redis, every worker sees them
+    conf = TEST_CONFIG['postgres']
+    dsn = 'postgresql://{user}:{password}@{host}:{port}/{database}'.format(**conf)
+    client = await make_redis_cli(postgres={'replicas': [dsn]})
+    app = client.server.app
+    token = await get_token(client)
+    response = await client.post('/api/recipes/340/vote', headers={'authorization_jwt': token})
+    assert response.status == 201
+    redis = app['redis']
+    assert await redis.exists('pin:user:1', 'pin:recipe:340') == 2
+    assert not await redis.exists('pin:list')  # vote does not add recipes to lists
+    assert 0 < await redis.ttl('pin:user:1') <= conf['pin_seconds']
+    assert await db.read_engine(app, {'id': 1}) is app['db']
+    assert await db.read_engine(app, recipe_id=340) is app['db']
+    assert await db.read_engine(app, {'id': 2}, recipe_id=341) is app['db_read']
+    assert len(app['db_pins']) == 0  # nothing in process
+
+    # new recipe in a list, list reads stay on replica, w response cached for the lag only
+    await recipe_saved(app, 341, 2)
+    assert await redis.exists('pin:list', 'pin:category:2') == 2
+    assert await db.read_engine(app) is app['db_read']
+    response = await client.get('/api/recipes?category=2')
+    assert response.status == 200
+    assert 'ETag' not in response.headers  # body may miss the change, not revalidated
+    assert 0 < await redis.ttl(RESPONSE_KEY_PREFIX + '/api/recipes?category=2') <= conf['pin_seconds']
+
+
+async def test_json_serializers(cli, tables_and_data):
+    recipes, count = await db.get_recipe_list(cli.server.app['db'], pagination={'limit': 300})
+    payload = {'count': count, 'results': recipes}
+    assert SERIALIZERS['json'](payload) == json.dumps(payload, default=str).encode()  # bytes as before
+    bodies = [json.loads(dumps(payload)) for dumps in SERIALIZERS.values()]
+    assert all(body == bodies[0] for body in bodies)  # serializers are interchangeable
+
+    response = await cli.get('/api/recipes?limit=300')
+    assert response.status == 200
+    assert response.content_type == 'application/json'
+    response_data = await response.json()
+    assert [r['recipe_id'] for r in response_data['results']] == [r['recipe_id'] for r in recipes]
+    for one_recipe, recipe_record in zip(response_data['results'], recipes):
+        pub_date, prep_time = recipe_record['recipe_pub_date'], recipe_record['recipe_prep_time']
+        assert one_recipe['recipe_pub_date'] == (pub_date.isoformat() if pub_date else None)
+        assert one_recipe['recipe_prep_time'] == (str(prep_time) if prep_time is not None else None)  # H:MM:SS
+
+
+async def test_export(cli, tables_and_data):
+    async with cli.server.app['db'].acquire() as conn:
+        count = await conn.scalar(sa.select([sa.func.count()]).select_from(recipe))
+
+    response = await cli.get('/api/recipes/export')
+    assert response.status == 200
+    assert response.content_type == 'application/x-ndjson'
+    lines = (await response.read()).splitlines()
+    assert len(lines) == count
+    recipes = [json.loads(line) for line in lines]
+    ids = [one_recipe['recipe_id'] for one_recipe in recipes]
+    assert ids == sorted(ids)
+    for one_recipe in recipes:
+        assert 'ingredients' in one_recipe
+
+    response = await cli.get('/api/recipes/export?category=1')
+    assert response.status == 200
+    for line in (await response.read()).splitlines():
+        assert json.loads(line)['recipe_category_id'] == 1
+
+    response = await cli.get(f'/api/recipes/export?since={ids[9]}')
+    assert response.status == 200
+    assert [json.loads(line)['recipe_id'] for line in (await response.read()).splitlines()] == ids[10:]
+
+    response = await cli.get('/api/recipes/export?since=yesterday')
+    assert response.status == 400
+
+    # each export holds a read connection till the end, ones over the limit are rejected
+    slots = cli.server.app['export_slots']
+    for _ in range(TEST_CONFIG['export_max_concurrent']):
+        await slots.acquire()
+    response = await cli.get('/api/recipes/export')
+    assert response.status == 429
+    for _ in range(TEST_CONFIG['export_max_concurrent']):
+        slots.release()
+    assert cli.server.app['export_stats'] == {'active': 0, 'rejected': 1, 'timed_out': 0}
+
+
 async def test_favored(cli, tables_and_data, token):
     response = await cli.get('/api/recipes/favored')
     assert response.status == 401  # no authorization
@@ -512,3 +981,309 @@ async def test_recipe_detail(cli, tables_and_data, token):
     response_data = await response.json()
     assert len(response_data['comments']) == 1
 
+
+
+async def test_recipe_detail_cache(cli, tables_and_data, token):
+    recipe_cache = cli.server.app['recipe_cache']
+
+    response = await cli.get('/api/recipes/340')
+    assert response.status == 200
+    assert recipe_cache.stats()['misses'] == 1
+    response = await cli.get('/api/recipes/340')
+    assert response.status == 200
+    response = await cli.get('/api/recipes/syrnyi-sup-po-frantsuzski-s-kuritsei')  # same recipe by slug
+    assert response.status == 200
+    response_data = await response.json()
+    assert response_data['recipe_id'] == 340
+    assert recipe_cache.stats()['hits'] == 2
+    assert recipe_cache.stats()['memory'] > 0
+
+    # cached entry is shared, liked is per user
+    response = await cli.post('/api/recipes/340/vote', headers={'authorization_jwt': token})
+    assert response.status == 201
+    assert recipe_cache.stats()['entries'] == 0  # evicted on vote
+    response = await cli.get('/api/recipes/340', headers={'authorization_jwt': token})
+    response_data = await response.json()
+    assert response_data['liked'] is True
+    assert response_data['likes'] == 1
+    response = await cli.get('/api/recipes/340')
+    response_data = await response.json()
+    assert 'liked' not in response_data
+    assert response_data['likes'] == 1
+
+
+async def test_conditional_get(cli, tables_and_data, token):
+    response = await cli.get('/api/recipes')
+    assert response.status == 200
+    assert 'Last-Modified' not in response.headers  # until the second of the change is over
+    await asyncio.sleep(1)
+    response = await cli.get('/api/recipes')
+    etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+    assert etag.startswith('W/')
+
+    response = await cli.get('/api/recipes', headers={'If-None-Match': etag})
+    assert response.status == 304
+    assert await response.read() == b''
+    assert response.headers['ETag'] == etag
+    response = await cli.get('/api/recipes?category=1', headers={'If-Modified-Since': last_modified})
+    assert response.status == 304
+
+    # liked flags differ per user, so do etags
+    response = await cli.get('/api/recipes', headers={'authorization_jwt': token, 'If-None-Match': etag})
+    assert response.status == 200
+    user_etag = response.headers['ETag']
+    assert user_etag != etag
+    response = await cli.get('/api/recipes', headers={'authorization_jwt': token, 'If-None-Match': user_etag})
+    assert response.status == 304
+
+    response = await cli.get('/api/recipes/340')
+    detail_etag = response.headers['ETag']
+    response = await cli.get('/api/recipes/syrnyi-sup-po-frantsuzski-s-kuritsei',
+                             headers={'If-None-Match': detail_etag})
+    assert response.status == 304  # slug resolved to the same recipe
+    response = await cli.get('/api/recipes/341', headers={'If-None-Match': detail_etag})
+    assert response.status == 200
+
+    response = await cli.post('/api/recipes/340/vote', headers={'authorization_jwt': token})
+    assert response.status == 201
+    for url, old_etag in (('/api/recipes', etag), ('/api/recipes/340', detail_etag)):
+        response = await cli.get(url, headers={'If-None-Match': old_etag})
+        assert response.status == 200
+        assert response.headers['ETag'] != old_etag
+    response = await cli.get('/api/recipes', headers={'If-Modified-Since': last_modified})
+    assert response.status == 200  # changed after the date
+    assert cli.server.app['conditional_stats']['not_modified'] == 4
+
+
+async def test_response_cache(make_redis_cli, tables_and_data, token):
+    cli = await make_redis_cli()
+    app = cli.server.app
+    redis = app['redis']
+    stats = app['response_cache_stats']
+
+    response = await cli.get('/api/recipes/340')
+    assert (await response.json())['likes'] == 0
+    response = await cli.get('/api/recipes/340')
+    assert (await response.json())['likes'] == 0
+    assert stats['misses'] == 1 and stats['hits'] == 1
+
+    # authenticated responses are not cached
+    response = await cli.get('/api/recipes/340', headers={'authorization_jwt': token})
+    assert response.status == 200
+    assert stats['misses'] == 1 and stats['hits'] == 1
+
+    response = await cli.put('/api/recipes/340/vote', headers={'authorization_jwt': token})
+    assert response.status == 204
+    response = await cli.get('/api/recipes/340')
+    assert (await response.json())['likes'] == 1  # invalidated by vote
+    assert stats['misses'] == 2
+
+    # body computed before invalidation of its tag is not stored
+    generation = int(await redis.get(RESPONSE_GENERATION) or 0)
+    await invalidate_tags(redis, ['recipe:341'])
+    assert not await store_response(redis, 'response_variants:stale', b'{}', ['recipe:341'], generation)
+    assert not await redis.exists('response_variants:stale')
+    assert await store_response(redis, 'response_variants:fresh', b'{}', ['recipe:341'], generation + 1)
+
+
+async def test_count_cache(make_redis_cli, tables_and_data, token):
+    cli = await make_redis_cli()
+    redis = cli.server.app['redis']
+    async with cli.server.app['db'].acquire() as conn:
+        total = await conn.scalar(sa.select([sa.func.count()]).select_from(recipe))
+
+    response = await cli.get('/api/recipes?count=estimate')
+    assert response.status == 200
+    assert (await response.json())['count'] > 0
+    assert await redis.scard(COUNT_KEYS) == 0  # estimates are not cached
+
+    response = await cli.get('/api/recipes')
+    assert (await response.json())['count'] == total
+    assert (await get_cached_count(redis, None))[0] == total
+    response = await cli.get('/api/recipes?limit=5&count=estimate')
+    assert (await response.json())['count'] == total  # cached exact count is better than estimate
+
+    # count computed before invalidation is not stored
+    _, generation = await get_cached_count(redis, None)
+    await invalidate_counts(redis)
+    await set_cached_count(redis, None, total + 1, generation)
+    assert (await get_cached_count(redis, None))[0] is None
+
+
+async def test_compression(cli, tables_and_data, token):
+    response = await cli.get('/api/recipes?limit=50', headers={'Accept-Encoding': 'gzip'})
+    assert response.status == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    response_data = await response.json()  # decompressed by client
+    assert len(response_data['results']) == 50
+    stats = cli.server.app['compression_stats']
+    assert stats['compressed'] == 1
+    assert stats['bytes_out'] < stats['bytes_in']
+
+    response = await cli.get('/api/recipes?limit=50', headers={'Accept-Encoding': 'gzip;q=0, identity'})
+    assert 'Content-Encoding' not in response.headers
+    assert 'Accept-Encoding' in response.headers['Vary']
+
+    # under min_size
+    response = await cli.get('/api/users/current', headers={'authorization_jwt': token, 'Accept-Encoding': 'gzip'})
+    assert response.status == 200
+    assert 'Content-Encoding' not in response.headers
+    assert stats['compressed'] == 1
+
+
+async def test_recipe_updates_push(cli, tables_and_data, token):
+    ws = await cli.ws_connect('/recipes/syrnyi-sup-po-frantsuzski-s-kuritsei')  # recipe 340 by slug
+    assert (await ws.receive_json())['action'] == 'connect'
+    other_ws = await cli.ws_connect('/recipes/341')
+    assert (await other_ws.receive_json())['action'] == 'connect'
+
+    response = await cli.put('/api/recipes/340/vote', headers={'authorization_jwt': token})
+    assert response.status == 204
+    assert await ws.receive_json() == {'action': 'likes', 'recipe_id': 340, 'likes': 1}
+    response = await cli.put('/api/recipes/340/vote', headers={'authorization_jwt': token})
+    assert response.status == 204  # nothing changed, nothing pushed
+
+    response = await cli.post('/api/recipes/340/comment', headers={'authorization_jwt': token},
+                              json={'body': 'Tasty'})
+    assert response.status == 201
+    event = await ws.receive_json()
+    assert event['action'] == 'comment'
+    assert event['comment']['body'] == 'Tasty'
+    assert event['comment']['username'] == 'test_user'
+
+    with pytest.raises(asyncio.TimeoutError):
+        await other_ws.receive_json(timeout=0.2)  # other recipe
+    await ws.close()
+    await other_ws.close()
+
+
+async def test_ws_rooms(cli, tables_and_data):
+    app = cli.server.app
+    ws = await cli.ws_connect('/recipes/340')
+    name = (await ws.receive_json())['name']
+    same_ws = await cli.ws_connect('/recipes/syrnyi-sup-po-frantsuzski-s-kuritsei')
+    same_name = (await same_ws.receive_json())['name']
+    other_ws = await cli.ws_connect('/recipes/341')
+    await other_ws.receive_json()
+    assert await ws.receive_json() == {'action': 'join', 'name': same_name}
+    assert len(app['websockets'][340]) == 2
+    assert len(app['websockets'][341]) == 1
+
+    await ws.send_str('Hello')
+    assert await same_ws.receive_json() == {'action': 'sent', 'name': name, 'text': 'Hello'}
+    with pytest.raises(asyncio.TimeoutError):
+        await other_ws.receive_json(timeout=0.2)  # chat of other recipe
+
+    await other_ws.close()
+    await ws.close()
+    assert await same_ws.receive_json() == {'action': 'disconnect', 'name': name}
+    assert 341 not in app['websockets']  # empty room is removed
+    assert list(app['websockets']) == [340]
+    await same_ws.close()
+
+
+async def test_ws_redis_rooms(make_redis_cli, tables_and_data):
+    cli = await make_redis_cli(websockets={'backend': 'redis'})
+    backend = cli.server.app['broadcast']
+
+    async def chat():
+        ws = await cli.ws_connect('/recipes/340')
+        await ws.receive_json()
+        other_ws = await cli.ws_connect('/recipes/340')
+        other_name = (await other_ws.receive_json())['name']
+        assert (await ws.receive_json(timeout=2))['action'] == 'join'
+        return ws, other_ws, other_name
+
+    ws, other_ws, other_name = await chat()
+    # redis drops pub/sub connection, room is subscribed again on a new one
+    await cli.server.app['redis'].execute(b'CLIENT', b'KILL', b'TYPE', b'pubsub')
+    for _ in range(50):
+        if backend.counters['resubscribed']:
+            break
+        await asyncio.sleep(0.1)
+    assert backend.stats()['lost'] == 0
+    await other_ws.send_str('Hello')
+    assert await ws.receive_json(timeout=2) == {'action': 'sent', 'name': other_name, 'text': 'Hello'}
+
+    # room is left and joined again
+    await ws.close()
+    await other_ws.close()
+    ws, other_ws, other_name = await chat()
+    await other_ws.send_str('Hello again')
+    assert (await ws.receive_json(timeout=2))['text'] == 'Hello again'
+    await ws.close()
+    await other_ws.close()
+
+
+async def test_evict_shared(make_redis_cli, tables_and_data):
+    # default memory websockets backend w several workers, evictions go over redis anyway
+    cli = await make_redis_cli()
+    app = cli.server.app
+    assert app['config']['websockets']['backend'] == 'memory'
+    token = await get_token(cli)
+    recipe_cache = app['recipe_cache']
+    response = await cli.get('/api/recipes/340')
+    assert response.status == 200
+    response = await cli.get('/api/users/current', headers={'authorization_jwt': token})
+    assert response.status == 200
+    assert recipe_cache.stats()['entries'] == 1
+    assert app['user_cache'].stats()['entries'] == 1
+
+    # as published by another worker after its change
+    for key in ('recipe:340', 'user:1'):
+        await app['redis'].publish(EVICT_CHANNEL, key)
+    for _ in range(50):
+        if app['broadcast'].counters['evictions'] == 2:
+            break
+        await asyncio.sleep(0.1)
+    assert recipe_cache.stats()['entries'] == 0
+    assert app['user_cache'].stats()['entries'] == 0
+
+    # rooms stay in the worker
+    ws = await cli.ws_connect('/recipes/340')
+    assert (await ws.receive_json())['action'] == 'connect'
+    assert app['broadcast'].stats()['subscriptions'] == 0
+    await ws.close()
+
+
+async def test_ws_slow_consumer(cli, tables_and_data):
+    app = cli.server.app
+    queue_size = app['config']['websockets']['send_queue_size']
+    ws = await cli.ws_connect('/recipes/340')
+    assert (await ws.receive_json())['action'] == 'connect'
+    fast_ws = await cli.ws_connect('/recipes/340')
+    assert (await fast_ws.receive_json())['action'] == 'connect'
+    assert (await ws.receive_json())['action'] == 'join'
+
+    slow = list(app['websockets'][340].values())[0]  # clients are kept in connection order
+    slow.writer.cancel()  # stalled client, nothing leaves its queue
+    for likes in range(queue_size + 1):
+        fan_out(app, 340, likes_event(340, likes))
+        assert (await fast_ws.receive_json())['likes'] == likes  # others are not held up
+
+    stats = app['ws_stats']
+    assert stats['dropped'] == 1
+    assert stats['disconnected'] == 1
+    assert (await ws.receive()).type == aiohttp.WSMsgType.CLOSE
+    assert ws.close_code and ws.close_code == CLOSE_SLOW_CONSUMER
+    await fast_ws.close()
+
+
+async def test_metrics(cli, tables_and_data, token):
+    response = await cli.get('/api/metrics')
+    assert response.status == 401  # no authorization
+
+    response = await cli.get('/api/metrics', headers={'authorization_jwt': token})
+    assert response.status == 403  # not a superuser
+
+    async with cli.server.app['db'].acquire() as conn:
+        await conn.execute(users.update().where(users.c.id == 1).values(superuser=True))
+    cli.server.app['user_cache'].pop(1)  # record w superuser=False was cached by previous request
+    response = await cli.get('/api/metrics', headers={'authorization_jwt': token})
+    assert response.status == 200
+    response_data = await response.json()
+    assert response_data['response_cache'] == {'hits': 0, 'misses': 0, 'variant_hits': 0, 'stale_skips': 0}  # no redis
+    assert response_data['websockets']['clients'] == 0
+    assert response_data['websockets']['backend'] == 'memory'  # no redis in tests
+    assert 'hit_ratio' in response_data['recipe_cache']